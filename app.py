@@ -1,121 +1,183 @@
 import streamlit as st
-import json
-import os
 from datetime import datetime
 from uuid import uuid4
 import time
-import hashlib
-
-# Page configuration
-st.set_page_config(
-    page_title="Global Chat",
-    page_icon="🌐",
-    layout="wide",
-    initial_sidebar_state="expanded"
+from collections import deque
+import io
+import json
+
+import chat_cache
+import chat_core
+import chat_export
+import chat_writer
+import durability
+import live_updates
+import message_render
+import metrics
+import presence
+import rate_limit
+import refresh_scheduler
+import retention
+import rooms
+import stores
+from chat_core import (
+    bulk_moderate, count_users, create_user, delete_user, format_search_hit, get_user,
+    hash_password, load_admin_settings, record_login, search_users, set_user_status,
+    update_admin_settings,
 )
 
+# Messages each session keeps in its rolling display window
+CHAT_WINDOW_SIZE = 50
 
-def format_message_time():
-    return datetime.now().strftime("%H:%M:%S")
+# Archived messages fetched per "Load older messages" click
+CHAT_HISTORY_PAGE_SIZE = 50
 
+# Message search hits shown in the admin panel and in the chat sidebar
+SEARCH_RESULTS_LIMIT = 50
+SIDEBAR_SEARCH_RESULTS = 10
 
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+# Names listed under "Who's online"; the count above it is always exact
+ONLINE_LIST_LIMIT = 50
 
+# Admin user list
+USERS_PAGE_SIZE = 25
+USER_STATUS_FILTERS = {"All": None, "Active": "active", "Banned": "banned"}
+BULK_ACTIONS = ["Ban", "Unban", "Delete users", "Delete all their messages"]
 
-def load_users():
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-        if os.path.exists("database/users.json"):
-            with open("database/users.json", "r") as f:
-                return json.load(f)
-        return {}
-    except Exception:
-        return {}
 
+# The chat helpers below are chat_core's, with the session's room filled in
 
-def load_admin_settings():
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-        if os.path.exists("database/admin_settings.json"):
-            with open("database/admin_settings.json", "r") as f:
-                return json.load(f)
-        return {"auto_refresh_interval": 2}  # Default 2 seconds
-    except Exception:
-        return {"auto_refresh_interval": 2}
+def current_room():
+    return st.session_state.get("room", rooms.DEFAULT_ROOM)
 
 
-def save_admin_settings(settings):
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-        with open("database/admin_settings.json", "w") as f:
-            json.dump(settings, f, indent=2)
-    except Exception:
-        pass
+def room_store(room=None):
+    # The store shard of a room, the session's own room by default
+    return chat_core.room_store(room or current_room())
 
 
-def save_users(users):
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-        with open("database/users.json", "w") as f:
-            json.dump(users, f, indent=2)
-    except Exception:
-        pass
+def save_global_chat_message(message, room=None):
+    chat_core.save_global_chat_message(message, room or current_room())
 
 
-def save_global_chat_message(message):
+def load_global_chat(room=None):
     try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
+        return chat_core.load_global_chat(room or current_room())
+    except stores.StoreError as e:
+        st.error(f"Error loading messages: {e}")
+        return []
 
-        global_chat_file = "database/global_chat.json"
 
-        if os.path.exists(global_chat_file):
-            with open(global_chat_file, "r") as f:
-                global_chat = json.load(f)
-        else:
-            global_chat = {"messages": []}
+def count_global_chat(room=None):
+    return chat_core.count_global_chat(room or current_room())
+
+
+def delete_global_chat_message(message_id, room=None):
+    return chat_core.delete_global_chat_message(message_id, room or current_room())
+
+
+def load_global_chat_since(cursor):
+    return chat_core.load_global_chat_since(cursor, CHAT_WINDOW_SIZE, current_room())
+
+
+def load_deleted_since(position):
+    return chat_core.load_deleted_since(position, current_room())
+
+
+def drop_deleted_messages():
+    # Takes messages deleted since the last sync out of the window and loaded history
+    deleted, position, purged = load_deleted_since(st.session_state.tombstone_position)
+    st.session_state.tombstone_position = position
+    if purged:
+        reset_chat_window()
+        st.session_state.tombstone_position = position
+    elif deleted:
+        deleted = set(deleted)
+        st.session_state.chat_window = deque(
+            (m for m in st.session_state.chat_window if m.get("message_id") not in deleted),
+            maxlen=CHAT_WINDOW_SIZE)
+        st.session_state.chat_older = [m for m in st.session_state.chat_older
+                                       if m.get("message_id") not in deleted]
+
+
+def sync_chat_window():
+    # Keeps the last CHAT_WINDOW_SIZE messages in session state, pulling only what is new
+    drop_deleted_messages()
+    new_messages, cursor, reset = load_global_chat_since(st.session_state.chat_cursor)
+    window = st.session_state.chat_window
+    if reset or len(new_messages) >= CHAT_WINDOW_SIZE:
+        # Loaded history no longer joins up with the window
+        st.session_state.chat_older = []
+        st.session_state.chat_history_done = False
+    if reset:
+        st.session_state.chat_window = window = deque(maxlen=CHAT_WINDOW_SIZE)
+    elif st.session_state.chat_older:
+        # Messages pushed out of the window stay visible above it
+        overflow = len(window) + len(new_messages) - CHAT_WINDOW_SIZE
+        for _ in range(min(max(overflow, 0), len(window))):
+            st.session_state.chat_older.append(window.popleft())
+    window.extend(new_messages)
+    st.session_state.chat_cursor = cursor
+    return st.session_state.chat_window
+
+
+def load_older_messages():
+    # One page from before the oldest message on screen; runs as a button callback
+    older = st.session_state.chat_older
+    window = st.session_state.chat_window
+    oldest = older[0] if older else (window[0] if window else None)
+    if oldest is None or "seq" not in oldest:
+        st.session_state.chat_history_done = True
+        return
+    page = chat_core.load_global_chat_before(oldest["seq"], CHAT_HISTORY_PAGE_SIZE, current_room())
+    older[:0] = page
+    if len(page) < CHAT_HISTORY_PAGE_SIZE:
+        st.session_state.chat_history_done = True
+    st.session_state.chat_version = None
 
-        global_chat["messages"].append(message)
 
-        # Keep only last 1000 messages
-        if len(global_chat["messages"]) > 1000:
-            global_chat["messages"] = global_chat["messages"][-1000:]
+def search_global_chat(query, user=None, limit=SEARCH_RESULTS_LIMIT, room=None):
+    # Returns (matches newest first, seconds taken)
+    return chat_core.search_global_chat(query, user, limit, room or current_room())
 
-        with open(global_chat_file, "w") as f:
-            json.dump(global_chat, f, indent=2)
-    except Exception:
-        pass
 
+def heartbeat(username):
+    presence.get_tracker(stores.DATABASE_DIR).heartbeat(st.session_state.presence_id, username)
 
-def load_global_chat():
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
 
-        global_chat_file = "database/global_chat.json"
+def online_users():
+    # Cached sorted tuple; only rebuilt when someone comes online or goes offline
+    return presence.get_tracker(stores.DATABASE_DIR).users()
 
-        if os.path.exists(global_chat_file):
-            with open(global_chat_file, "r") as f:
-                global_chat = json.load(f)
-            return global_chat.get("messages", [])
-        return []
-    except Exception:
-        return []
 
+def count_archived_chat(room=None):
+    return chat_core.count_archived_chat(room or current_room())
+
+
+def clear_global_chat(room=None):
+    chat_core.clear_global_chat(room or current_room())
+
+
+def reset_chat_window():
+    st.session_state.chat_cursor = None
+    st.session_state.tombstone_position = None
+    st.session_state.chat_window = deque(maxlen=CHAT_WINDOW_SIZE)
+    st.session_state.chat_version = None
+    st.session_state.chat_older = []
+    st.session_state.chat_history_done = False
+    st.session_state.refresh_level = 0
+
+
+def leave_deleted_room():
+    # The session's room was deleted while it was in it: back to the main room
+    st.session_state.room = rooms.DEFAULT_ROOM
+    reset_chat_window()
 
-def clear_global_chat():
-    try:
-        global_chat_file = "database/global_chat.json"
-        if os.path.exists(global_chat_file):
-            with open(global_chat_file, "w") as f:
-                json.dump({"messages": []}, f, indent=2)
-    except Exception:
-        pass
+
+def change_room():
+    # Selectbox callback: the new room starts from its own latest messages
+    st.session_state.room = st.session_state.room_choice
+    reset_chat_window()
 
 
 def initialize_session():
@@ -125,8 +187,14 @@ def initialize_session():
         st.session_state.current_user = None
     if "is_admin" not in st.session_state:
         st.session_state.is_admin = False
-    if "last_global_check" not in st.session_state:
-        st.session_state.last_global_check = time.time()
+    if "chat_cursor" not in st.session_state:
+        reset_chat_window()
+        st.session_state.room = rooms.DEFAULT_ROOM
+        st.session_state.chat_tick_ended_at = None
+        st.session_state.refresh_interval = None
+        st.session_state.refresh_changed_at = 0.0
+    if "presence_id" not in st.session_state:
+        st.session_state.presence_id = uuid4().hex
 
 
 def login_form():
@@ -145,16 +213,20 @@ def login_form():
             with st.form("login_form"):
                 username = st.text_input("Username", placeholder="Enter username")
                 password = st.text_input("Password", type="password", placeholder="Enter password")
-                login_button = st.form_submit_button("Login", use_container_width=True)
+                login_button = st.form_submit_button("Login", width="stretch")
 
                 if login_button:
-                    users = load_users()
-                    if username in users:
-                        stored_password = users[username]["password"]
+                    user = get_user(username)
+                    if user is not None:
+                        stored_password = user["password"]
                         if stored_password == hash_password(password):
-                            if users[username].get("status", "active") == "banned":
+                            if user.get("status", "active") == "banned":
                                 st.error("Your account has been banned. Please contact admin.")
                             else:
+                                try:
+                                    record_login(username)
+                                except stores.StoreError:
+                                    pass  # A missed last_login update should not block login
                                 st.session_state.authenticated = True
                                 st.session_state.current_user = username
                                 st.session_state.is_admin = False
@@ -172,29 +244,32 @@ def login_form():
                 new_email = st.text_input("Email", placeholder="Enter your email")
                 new_username = st.text_input("Username", placeholder="Choose a username")
                 new_password = st.text_input("Password", type="password", placeholder="Choose a password")
-                signup_button = st.form_submit_button("Sign Up", use_container_width=True)
+                signup_button = st.form_submit_button("Sign Up", width="stretch")
 
                 if signup_button:
                     if new_name and new_email and new_username and new_password:
-                        users = load_users()
-                        if new_username not in users:
-                            users[new_username] = {
-                                "name": new_name,
-                                "email": new_email,
-                                "password": hash_password(new_password),
-                                "status": "active",
-                                "created_at": datetime.now().isoformat(),
-                                "last_login": datetime.now().isoformat()
-                            }
-                            save_users(users)
-                            st.session_state.authenticated = True
-                            st.session_state.current_user = new_username
-                            st.session_state.is_admin = False
-                            st.success("Account created successfully! Logging you in...")
-                            time.sleep(1)
-                            st.rerun()
+                        user_data = {
+                            "name": new_name,
+                            "email": new_email,
+                            "password": hash_password(new_password),
+                            "status": "active",
+                            "created_at": datetime.now().isoformat(),
+                            "last_login": datetime.now().isoformat()
+                        }
+                        try:
+                            created = create_user(new_username, user_data)
+                        except stores.StoreError as e:
+                            st.error(f"Could not create account: {e}")
                         else:
-                            st.error("Username already exists")
+                            if created:
+                                st.session_state.authenticated = True
+                                st.session_state.current_user = new_username
+                                st.session_state.is_admin = False
+                                st.success("Account created successfully! Logging you in...")
+                                time.sleep(1)
+                                st.rerun()
+                            else:
+                                st.error("Username already exists")
                     else:
                         st.error("Please fill in all fields")
 
@@ -202,7 +277,7 @@ def login_form():
             with st.form("admin_form"):
                 admin_username = st.text_input("Admin Username", placeholder="Enter admin username")
                 admin_password = st.text_input("Admin Password", type="password", placeholder="Enter admin password")
-                admin_login_button = st.form_submit_button("Admin Login", use_container_width=True)
+                admin_login_button = st.form_submit_button("Admin Login", width="stretch")
 
                 if admin_login_button:
                     if admin_username == "Admin" and admin_password == "Shuvo@123":
@@ -217,25 +292,116 @@ def login_form():
 
 
 def logout():
+    presence.get_tracker(stores.DATABASE_DIR).leave(st.session_state.presence_id)
     st.session_state.authenticated = False
     st.session_state.current_user = None
     st.session_state.is_admin = False
     st.rerun()
 
 
+def change_user_page(step):
+    st.session_state.user_page = max(0, st.session_state.user_page + step)
+
+
+def reset_user_selection(usernames=()):
+    # Checkbox keys include the epoch, so a new epoch redraws every box from the selection
+    st.session_state.selected_users = set(usernames)
+    st.session_state.selection_epoch = st.session_state.get("selection_epoch", 0) + 1
+
+
+def toggle_user_selection(username):
+    st.session_state.selected_users ^= {username}
+
+
+def apply_bulk_action():
+    # Runs as a button callback, before the script body, so the batch costs one rerun
+    action = st.session_state.bulk_action
+    usernames = sorted(st.session_state.selected_users)
+    try:
+        changed, elapsed = bulk_moderate(action, usernames)
+    except stores.StoreError as e:
+        st.session_state.bulk_result = ("error", f"{action} failed: {e}")
+    else:
+        unit = "messages" if action == "Delete all their messages" else "users"
+        st.session_state.bulk_result = (
+            "success",
+            f"{action}: {changed} {unit} changed for {len(usernames)} selected "
+            f"in one commit ({elapsed * 1000:.1f} ms)"
+        )
+        reset_user_selection()
+
+
 def admin_panel():
     st.title("Admin Panel")
 
-    tab1, tab2, tab3 = st.tabs(["User Management", "Chat Management", "Settings"])
+    tab1, tab2, tab3, tab4 = st.tabs(["User Management", "Chat Management", "Rooms", "Settings"])
 
     with tab1:
         st.subheader("User Management")
 
-        users = load_users()
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            search = st.text_input("Search users", placeholder="Username, name or email prefix")
+        with col2:
+            status_filter = st.selectbox("Status", list(USER_STATUS_FILTERS))
+
+        # New filters start again from the first page
+        filters = (search, status_filter)
+        if st.session_state.get("user_filters") != filters:
+            st.session_state.user_filters = filters
+            st.session_state.user_page = 0
+
+        total_users, page_users = search_users(
+            search, USER_STATUS_FILTERS[status_filter],
+            st.session_state.user_page * USERS_PAGE_SIZE, USERS_PAGE_SIZE
+        )
+        page_count = max(1, -(-total_users // USERS_PAGE_SIZE))
+        st.session_state.user_page = min(st.session_state.user_page, page_count - 1)
+
+        if "selected_users" not in st.session_state:
+            reset_user_selection()
+        selected = st.session_state.selected_users
+        epoch = st.session_state.selection_epoch
+
+        col1, col2, col3, col4 = st.columns([2, 1.5, 1, 1])
+        with col1:
+            st.selectbox("Bulk action", BULK_ACTIONS, key="bulk_action")
+        with col2:
+            st.button(f"Apply to {len(selected)} selected", disabled=not selected,
+                      on_click=apply_bulk_action, width="stretch")
+        with col3:
+            st.button("Select page", on_click=reset_user_selection,
+                      args=(selected | {username for username, _ in page_users},),
+                      width="stretch")
+        with col4:
+            st.button("Clear selection", disabled=not selected, on_click=reset_user_selection,
+                      width="stretch")
+
+        if "bulk_result" in st.session_state:
+            kind, text = st.session_state.pop("bulk_result")
+            if kind == "error":
+                st.error(text)
+            else:
+                st.success(text)
 
-        if users:
-            for username, user_data in users.items():
-                col1, col2, col3, col4 = st.columns([2, 1.5, 1, 1])
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col1:
+            st.button("← Previous", disabled=st.session_state.user_page == 0,
+                      on_click=change_user_page, args=(-1,), width="stretch")
+        with col2:
+            st.caption(f"Page {st.session_state.user_page + 1} of {page_count} • {total_users} users")
+        with col3:
+            st.button("Next →", disabled=st.session_state.user_page >= page_count - 1,
+                      on_click=change_user_page, args=(1,), width="stretch")
+
+        if page_users:
+            for username, user_data in page_users:
+                col0, col1, col2, col3, col4 = st.columns([0.3, 2, 1.5, 1, 1])
+
+                with col0:
+                    st.checkbox("Select", value=username in selected, key=f"select_{epoch}_{username}",
+                                on_change=toggle_user_selection, args=(username,),
+                                label_visibility="collapsed")
 
                 with col1:
                     st.write(f"**{user_data['name']}** ({username})")
@@ -259,23 +425,32 @@ def admin_panel():
                 with col3:
                     if user_data.get('status', 'active') == 'active':
                         if st.button("Ban", key=f"ban_{username}"):
-                            users[username]['status'] = 'banned'
-                            save_users(users)
-                            st.success(f"User {username} has been banned")
-                            st.rerun()
+                            try:
+                                set_user_status(username, 'banned')
+                            except stores.StoreError as e:
+                                st.error(f"Could not ban {username}: {e}")
+                            else:
+                                st.success(f"User {username} has been banned")
+                                st.rerun()
                     else:
                         if st.button("Unban", key=f"unban_{username}"):
-                            users[username]['status'] = 'active'
-                            save_users(users)
-                            st.success(f"User {username} has been unbanned")
-                            st.rerun()
+                            try:
+                                set_user_status(username, 'active')
+                            except stores.StoreError as e:
+                                st.error(f"Could not unban {username}: {e}")
+                            else:
+                                st.success(f"User {username} has been unbanned")
+                                st.rerun()
 
                 with col4:
                     if st.button("Delete", key=f"delete_{username}"):
-                        del users[username]
-                        save_users(users)
-                        st.success(f"User {username} has been deleted")
-                        st.rerun()
+                        try:
+                            delete_user(username)
+                        except stores.StoreError as e:
+                            st.error(f"Could not delete {username}: {e}")
+                        else:
+                            st.success(f"User {username} has been deleted")
+                            st.rerun()
 
                 st.divider()
         else:
@@ -284,16 +459,94 @@ def admin_panel():
     with tab2:
         st.subheader("Chat Management")
 
-        global_messages = load_global_chat()
+        admin_rooms = rooms.list_rooms()
+        admin_room = st.selectbox("Room", admin_rooms, format_func=lambda r: f"#{r}",
+                                  key="admin_room")
+        global_messages = load_global_chat(admin_room)
 
         col1, col2 = st.columns([1, 1])
         with col1:
             st.metric("Total Messages", len(global_messages))
+            st.caption(f"{count_archived_chat(admin_room)} older messages in the archive")
         with col2:
             if st.button("Clear All Messages", type="secondary"):
-                clear_global_chat()
-                st.success("All messages cleared!")
-                st.rerun()
+                try:
+                    clear_global_chat(admin_room)
+                except stores.StoreError as e:
+                    st.error(f"Could not clear messages: {e}")
+                else:
+                    st.success("All messages cleared!")
+                    st.rerun()
+
+        st.subheader("Search Messages")
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            message_query = st.text_input("Search messages",
+                                          placeholder="Words, prefix* or from:username")
+        with col2:
+            message_user = st.text_input("From user", placeholder="Any user")
+        if message_query.strip() or message_user.strip():
+            try:
+                matches, elapsed = search_global_chat(message_query, message_user.strip(),
+                                                      room=admin_room)
+            except stores.StoreError as e:
+                st.error(f"Search failed: {e}")
+            else:
+                st.caption(f"{len(matches)} matches in {elapsed * 1000:.1f} ms (newest first, "
+                           f"up to {SEARCH_RESULTS_LIMIT})")
+                for msg in matches:
+                    st.text(format_search_hit(msg))
+
+        st.subheader("Export and Import")
+        col1, col2 = st.columns([1, 1])
+        with col1:
+            data_kind = st.radio("Data", ["messages", "users"], horizontal=True, key="data_kind",
+                                 format_func=lambda kind: (f"Messages in #{admin_room}"
+                                                           if kind == "messages" else "Users"))
+        with col2:
+            export_format = st.radio("Export format", chat_export.FORMATS, horizontal=True,
+                                     key="export_format")
+        export_filters = {}
+        if data_kind == "messages":
+            col1, col2, col3 = st.columns([2, 1, 1])
+            with col1:
+                export_user = st.text_input("Only from user", placeholder="Any user",
+                                            key="export_user")
+            with col2:
+                export_since = st.date_input("Sent on or after", value=None, key="export_since")
+            with col3:
+                export_until = st.date_input("Sent before", value=None, key="export_until")
+            export_filters = {
+                "room": admin_room,
+                "user": export_user.strip() or None,
+                "since": export_since.isoformat() if export_since else None,
+                "until": export_until.isoformat() if export_until else None,
+            }
+        # Built only when clicked, streamed from the store into a temporary file
+        st.download_button(
+            f"Download {data_kind} ({export_format.upper()})",
+            lambda: chat_export.export_file(data_kind, export_format, **export_filters),
+            file_name=f"chat-{data_kind}.{export_format}",
+            mime="text/csv" if export_format == "csv" else "application/jsonl",
+            on_click="ignore",
+        )
+        upload = st.file_uploader(f"Import {data_kind} from a JSONL or CSV file",
+                                  type=["jsonl", "csv"], key="import_file")
+        if upload is not None and st.button(f"Import {data_kind}"):
+            records = chat_export.read_records(io.TextIOWrapper(upload, encoding="utf-8",
+                                                                newline=""),
+                                               chat_export.guess_format(upload.name))
+            try:
+                if data_kind == "messages":
+                    counts = chat_export.import_messages(records, admin_room)
+                    live_updates.notifier_for(admin_room).notify()
+                else:
+                    counts = chat_export.import_users(records)
+            except stores.StoreError as e:
+                st.error(f"Import failed: {e}")
+            else:
+                st.success(f"Imported {counts['imported']} {data_kind} in {counts['seconds']:.1f} s; "
+                           f"{counts['skipped']} already present, {counts['invalid']} invalid")
 
         st.subheader("Recent Messages")
         if global_messages:
@@ -309,42 +562,396 @@ def admin_panel():
                 with col2:
                     st.text(f"{user_id}: {content[:50]}...")
                 with col3:
-                    if st.button("🗑️", key=f"del_msg_{msg.get('message_id', str(uuid4()))}"):
-                        # Remove specific message (simplified implementation)
-                        st.info("Message deletion feature can be implemented")
+                    message_id = msg.get("message_id")
+                    if message_id and st.button("🗑️", key=f"del_msg_{message_id}",
+                                                help="Delete this message"):
+                        try:
+                            deleted = delete_global_chat_message(message_id, admin_room)
+                        except stores.StoreError as e:
+                            st.error(f"Could not delete the message: {e}")
+                        else:
+                            if deleted:
+                                st.rerun()
+                            st.info("That message was already deleted or has expired.")
 
     with tab3:
+        st.subheader("Rooms")
+        st.caption("Each room keeps its messages, archive and search index in its own "
+                   "storage shard, so rooms do not wait on each other's writes.")
+
+        room_settings = rooms.room_configs(load_admin_settings())
+        for room, config in room_settings.items():
+            col1, col2, col3, col4 = st.columns([2, 2, 2, 1])
+            with col1:
+                st.markdown(f"**#{room}**")
+                try:
+                    st.caption(f"{count_global_chat(room)} messages, "
+                               f"{count_archived_chat(room)} archived")
+                except stores.StoreError as e:
+                    st.caption(f"Unavailable: {e}")
+            with col2:
+                max_messages = st.number_input(
+                    "Messages kept live", min_value=50, max_value=100000, step=50,
+                    value=int(config.get("max_messages", 1000)), key=f"room_retention_{room}",
+                    help="Older messages are moved out by the next compaction"
+                )
+            with col3:
+                if max_messages != config.get("max_messages", 1000):
+                    if st.button("Save", key=f"room_save_{room}"):
+                        try:
+                            rooms.set_room_retention(room, max_messages)
+                        except (ValueError, OSError) as e:
+                            st.error(str(e))
+                        else:
+                            st.rerun()
+            with col4:
+                if room != rooms.DEFAULT_ROOM and st.button("🗑️", key=f"room_delete_{room}",
+                                                            help="Delete the room and its messages"):
+                    try:
+                        rooms.delete_room(room)
+                    except (ValueError, OSError) as e:
+                        st.error(str(e))
+                    else:
+                        st.rerun()
+
+        with st.form("create_room", clear_on_submit=True):
+            col1, col2 = st.columns([2, 1])
+            with col1:
+                new_room = st.text_input("New room", placeholder="e.g. random")
+            with col2:
+                new_retention = st.number_input("Messages kept live", min_value=50,
+                                                max_value=100000, step=50, value=1000)
+            if st.form_submit_button("Create room"):
+                try:
+                    rooms.create_room(new_room.strip().lower(), new_retention)
+                except (ValueError, OSError) as e:
+                    st.error(str(e))
+                else:
+                    st.success(f"Room #{new_room.strip().lower()} created!")
+                    st.rerun()
+
+    with tab4:
         st.subheader("Application Settings")
 
         admin_settings = load_admin_settings()
 
-        # Auto-refresh interval setting
+        # Auto-refresh bounds and load thresholds
         st.markdown("**Auto-Refresh Settings**")
-        current_interval = admin_settings.get("auto_refresh_interval", 2)
-
-        new_interval = st.slider(
-            "Auto-refresh interval (seconds)",
-            min_value=1,
-            max_value=10,
-            value=current_interval,
-            step=1,
-            help="How often the chat refreshes automatically for all users"
+        current_bounds = refresh_scheduler.refresh_bounds(admin_settings)
+        current_latency = admin_settings.get("refresh_latency_threshold_ms", 250)
+        current_sessions = admin_settings.get("refresh_session_threshold", 200)
+
+        new_bounds = st.slider(
+            "Auto-refresh interval bounds (seconds)",
+            min_value=0.5,
+            max_value=refresh_scheduler.MAX_INTERVAL,
+            value=current_bounds,
+            step=0.5,
+            help="Active chats refresh at the lower bound. Idle chats double their interval "
+                 "up to the upper bound, which stays within a third of the presence timeout "
+                 "so idle users still show as online."
         )
+        col1, col2 = st.columns(2)
+        with col1:
+            new_latency = st.number_input(
+                "Slow down above rerun p95 (ms)", min_value=0, value=int(current_latency), step=50,
+                help="Intervals stretch in proportion once the p95 of chat reruns passes this. "
+                     "0 turns it off."
+            )
+        with col2:
+            new_sessions = st.number_input(
+                "Slow down above live sessions", min_value=0, value=int(current_sessions), step=50,
+                help="Intervals stretch in proportion once this process serves more sessions. "
+                     "0 turns it off."
+            )
+
+        if (new_bounds, new_latency, new_sessions) != (current_bounds, current_latency,
+                                                       current_sessions):
+            try:
+                update_admin_settings({"auto_refresh_min_interval": new_bounds[0],
+                                       "auto_refresh_max_interval": new_bounds[1],
+                                       "refresh_latency_threshold_ms": new_latency,
+                                       "refresh_session_threshold": new_sessions})
+            except stores.StoreError as e:
+                st.error(f"Could not save settings: {e}")
+            else:
+                st.success("Auto-refresh settings updated!")
+                st.rerun()
 
-        if new_interval != current_interval:
-            admin_settings["auto_refresh_interval"] = new_interval
-            save_admin_settings(admin_settings)
-            st.success(f"Auto-refresh interval updated to {new_interval} seconds!")
-            st.rerun()
+        load_factor, latency_ms, sessions = refresh_scheduler.monitor.state(current_latency,
+                                                                           current_sessions)
+        st.info(f"Chats refresh every {current_bounds[0]:g}–{current_bounds[1]:g} seconds. "
+                f"Load stretch: ×{load_factor:.1f} (rerun p95 {latency_ms:.0f} ms, "
+                f"{sessions} live sessions)")
+
+        # Rate limits
+        st.markdown("**Rate Limits**")
+        limit_keys = ("rate_limit_user_per_minute", "rate_limit_user_burst",
+                      "rate_limit_global_per_minute", "rate_limit_global_burst")
+        current_limits = tuple(int(admin_settings.get(key, 0)) for key in limit_keys)
+        col1, col2 = st.columns(2)
+        with col1:
+            user_rate = st.number_input("Messages per minute per user", min_value=0,
+                                        value=current_limits[0], help="0 means unlimited")
+            global_rate = st.number_input("Messages per minute in total", min_value=0,
+                                          value=current_limits[2], help="0 means unlimited")
+        with col2:
+            user_burst = st.number_input("Burst per user", min_value=1,
+                                         value=max(1, current_limits[1]))
+            global_burst = st.number_input("Burst in total", min_value=1,
+                                           value=max(1, current_limits[3]))
+        new_limits = (user_rate, user_burst, global_rate, global_burst)
+        if new_limits != current_limits:
+            try:
+                update_admin_settings(dict(zip(limit_keys, new_limits)))
+            except stores.StoreError as e:
+                st.error(f"Could not save settings: {e}")
+            else:
+                st.success("Rate limits updated!")
+                st.rerun()
 
-        st.info(f"Current auto-refresh interval: {current_interval} seconds")
+        limit_stats = rate_limit.limiter.stats()
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("Messages Allowed", limit_stats["allowed"])
+        with col2:
+            st.metric("Throttled (per user)", limit_stats["throttled_user"])
+        with col3:
+            st.metric("Throttled (total limit)", limit_stats["throttled_global"])
+        if limit_stats["top_throttled"]:
+            st.caption("Most throttled users since the server started")
+            st.dataframe([{"User": username, "Rejected sends": count}
+                          for username, count in limit_stats["top_throttled"]],
+                         width="stretch", hide_index=True)
+        st.caption("Limits apply per server process.")
+
+        # Retention and compaction
+        st.markdown("**Retention**")
+        current_retention = (float(admin_settings.get("retention_max_age_days", 0)),
+                             int(admin_settings.get("retention_max_live_kb", 0)),
+                             bool(admin_settings.get("retention_archive", True)),
+                             bool(admin_settings.get("archive_compression", False)))
+        col1, col2 = st.columns(2)
+        with col1:
+            max_age_days = st.number_input(
+                "Expire messages older than (days)", min_value=0.0,
+                value=current_retention[0], step=1.0, help="0 means no age limit"
+            )
+            keep_archive = st.checkbox(
+                "Move expired messages to the archive", value=current_retention[2],
+                help="When off, expired messages are deleted for good"
+            )
+        with col2:
+            max_live_kb = st.number_input(
+                "Live messages per room (KB)", min_value=0, value=current_retention[1],
+                step=64, help="Oldest messages expire first once a room's live store is "
+                              "larger. 0 means no size limit."
+            )
+            compress_archive = st.checkbox(
+                "Compress the archive", value=current_retention[3],
+                help="Archive segments are stored gzipped; existing ones are compressed by "
+                     "the next compaction"
+            )
+        new_retention = (max_age_days, max_live_kb, keep_archive, compress_archive)
+        if new_retention != current_retention:
+            try:
+                update_admin_settings(dict(zip(("retention_max_age_days", "retention_max_live_kb",
+                                                "retention_archive", "archive_compression"),
+                                               new_retention)))
+            except stores.StoreError as e:
+                st.error(f"Could not save settings: {e}")
+            else:
+                st.success("Retention settings updated!")
+                st.rerun()
+
+        if st.button("Run compaction now"):
+            results = retention.engine.run(force=True)
+            st.success(f"Compacted {len(results)} rooms: "
+                       f"{sum(r['expired'] for r in results)} messages expired, "
+                       f"{sum(r['bytes_reclaimed'] for r in results) / 1024:.1f} KB reclaimed")
+
+        retention_stats = retention.engine.stats()
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.metric("Compactions", retention_stats["runs"])
+        with col2:
+            st.metric("Messages Expired", retention_stats["expired"])
+        with col3:
+            st.metric("Reclaimed", f"{retention_stats['bytes_reclaimed'] / 1024:.1f} KB")
+        with col4:
+            st.metric("Compaction Time", f"{retention_stats['seconds'] * 1000:.0f} ms")
+        if retention_stats["rooms"]:
+            st.dataframe([{"Room": room,
+                           "Last run": datetime.fromtimestamp(result["at"]).strftime("%H:%M:%S"),
+                           "Took (ms)": round(result["seconds"] * 1000, 1),
+                           "Expired": result["expired"],
+                           "Deleted purged": result["purged"],
+                           "Segments compressed": result["compressed_segments"],
+                           "Size before (KB)": round(result["bytes_before"] / 1024, 1),
+                           "Size after (KB)": round(result["bytes_after"] / 1024, 1)}
+                          for room, result in retention_stats["rooms"].items()],
+                         width="stretch", hide_index=True)
+        st.caption(f"Each room also keeps at most its own message cap (Rooms tab). Compaction "
+                   f"runs in the background after busy commits and every "
+                   f"{retention.RETENTION_INTERVAL:g} s; the figures are for this server process.")
+
+        # Durability (set per server process with CHAT_DURABILITY)
+        st.markdown("**Durability**")
+        sync_stats = durability.policy.stats()
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.metric("Mode", sync_stats["mode"])
+        with col2:
+            st.metric("Fsyncs", sync_stats["syncs"])
+        with col3:
+            st.metric("Fsync Time", f"{sync_stats['sync_seconds'] * 1000:.0f} ms")
+        with col4:
+            st.metric("Fsync Errors", sync_stats["errors"])
+        if sync_stats["last_error"]:
+            st.error(f"A background fsync failed, so recent writes may not be on disk: "
+                     f"{sync_stats['last_error']}")
+        if sync_stats["mode"] == "interval":
+            st.caption(f"Files are fsynced in the background every {sync_stats['interval_ms']:g} ms; "
+                       f"a power cut can lose what was committed since.")
 
         st.markdown("---")
         st.markdown("System Information")
-        st.metric("Current Refresh Rate", f"{current_interval}s")
-        st.metric("Active Users", len(load_users()))
+        st.metric("Refresh Bounds", f"{current_bounds[0]:g}–{current_bounds[1]:g}s")
+        st.metric("Active Users", count_users())
         st.metric("Total Messages", len(load_global_chat()))
 
+        cache_stats = chat_cache.global_chat_cache.stats()
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("Chat Cache Hits", cache_stats["hits"])
+        with col2:
+            st.metric("Chat Cache Misses", cache_stats["misses"])
+        with col3:
+            st.metric("Chat Cache Hit Rate", f"{cache_stats['hit_rate']:.0%}")
+
+        render_stats = message_render.render_cache.stats()
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("Rendered Messages Cached", render_stats["size"])
+        with col2:
+            st.metric("Render Cache Hits", render_stats["hits"])
+        with col3:
+            st.metric("Render Cache Misses", render_stats["misses"])
+
+        st.markdown("**Rerun Timing**")
+        snapshot = metrics.registry.snapshot()
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("Reruns/sec", f"{snapshot['reruns_per_second']:.2f}")
+        with col2:
+            st.metric("Active Script Threads", snapshot["active_script_threads"])
+        if snapshot["phases"]:
+            st.caption(f"Per phase over the last {snapshot['window_seconds'] // 60} minutes, "
+                       "across all sessions in this process")
+            st.dataframe(
+                [{"Phase": name, "Count": p["count"], "Mean (ms)": round(p["mean_ms"], 2),
+                  "p50 (ms)": round(p["p50_ms"], 2), "p95 (ms)": round(p["p95_ms"], 2),
+                  "p99 (ms)": round(p["p99_ms"], 2)}
+                 for name, p in snapshot["phases"].items()],
+                width="stretch", hide_index=True
+            )
+            phase = st.selectbox("Histogram", list(snapshot["phases"]))
+            bounds = [f"≤{b:g} ms" for b in snapshot["bucket_bounds_ms"]] + ["more"]
+            counts = snapshot["phases"][phase]["buckets"]
+            used = [i for i, n in enumerate(counts) if n]
+            if used:
+                st.dataframe([{"Duration": bounds[i], "Runs": counts[i]}
+                              for i in range(used[0], used[-1] + 1)],
+                             width="stretch", hide_index=True)
+        st.download_button("Download metrics (JSON)", json.dumps(snapshot, indent=2),
+                           file_name="chat-metrics.json", mime="application/json")
+
+
+def refresh_settings():
+    # (fastest interval, slowest interval, load stretch factor)
+    settings = load_admin_settings()
+    low, high = refresh_scheduler.refresh_bounds(settings)
+    factor = refresh_scheduler.monitor.factor(settings.get("refresh_latency_threshold_ms"),
+                                              settings.get("refresh_session_threshold"))
+    return low, high, factor
+
+
+def schedule_refresh(active):
+    # Picks this session's next interval. run_every is only read when a full run registers
+    # the fragment, so a changed interval costs one full rerun; intervals move in doublings,
+    # which keeps that to a few reruns per idle period.
+    state = st.session_state
+    level = state.refresh_level
+    # The run a full rerun makes straight away is not an idle tick
+    if active or time.monotonic() - state.refresh_changed_at >= state.refresh_interval * 0.9:
+        level = refresh_scheduler.next_level(level, active)
+    low, high, factor = refresh_settings()
+    state.refresh_level = min(level, refresh_scheduler.max_level(low, high))
+    if refresh_scheduler.refresh_interval(state.refresh_level, low, high, factor) != \
+            state.refresh_interval:
+        st.rerun()
+
+
+def chat_messages(current_user):
+    # Runs as a fragment. Ticks where nothing was committed only compare a counter and
+    # redraw the session's window; the store is read only after a change notification.
+    metrics.registry.count_rerun()
+    ended_at = st.session_state.chat_tick_ended_at
+    if ended_at is not None:
+        # Time this session spent waiting for its next tick
+        metrics.registry.record("sleep", time.perf_counter() - ended_at)
+    try:
+        with metrics.registry.phase("fragment"):
+            render_chat_messages(current_user)
+    finally:
+        st.session_state.chat_tick_ended_at = time.perf_counter()
+
+
+def render_chat_messages(current_user):
+    heartbeat(current_user)
+    version = live_updates.notifier_for(current_room()).version
+    active = version != st.session_state.chat_version
+    if active:
+        st.session_state.chat_version = version
+        try:
+            with metrics.registry.phase("sync_chat"):
+                sync_chat_window()
+                st.session_state.chat_total = count_global_chat()
+        except ValueError:
+            if current_room() in rooms.list_rooms():
+                raise
+            # Deleted by an admin since the last full run; the fragment alone cannot recover
+            leave_deleted_room()
+            st.rerun()
+        st.session_state.chat_updated_at = datetime.now().strftime("%H:%M:%S")
+        with metrics.registry.phase("render"):
+            st.session_state.chat_html = message_render.render_transcript(
+                st.session_state.chat_older + list(st.session_state.chat_window), current_user
+            )
+    chat_window = st.session_state.chat_window
+
+    if chat_window:
+        st.subheader("")
+
+        st.button("Load older messages", on_click=load_older_messages,
+                  disabled=st.session_state.chat_history_done)
+
+        # Status info
+        col1_status, col2_status = st.columns([2, 1])
+        with col1_status:
+            st.info(f" {st.session_state.chat_total} messages • Live updates: ON "
+                    f"({st.session_state.refresh_interval:g}s)")
+        with col2_status:
+            st.caption(f"Last update: {st.session_state.chat_updated_at}")
+
+        # Message display: loaded history plus the last 50 messages as one pre-rendered block
+        st.markdown(st.session_state.chat_html, unsafe_allow_html=True)
+        st.markdown("<div style='height: 20px;'></div>", unsafe_allow_html=True)
+    else:
+        st.markdown("Welcome to Global Chat!")
+
+    schedule_refresh(active)
+
 
 def global_chat_interface():
     # Custom CSS for chat styling
@@ -421,134 +1028,121 @@ def global_chat_interface():
     col1, col2 = st.columns([3, 1])
     with col1:
         st.title("Global Chat")
-        st.caption("Your messages on right, others on left")
+        st.caption(f"#{current_room()} • Your messages on right, others on left")
     with col2:
-        if st.button("Logout", use_container_width=True):
+        if st.button("Logout", width="stretch"):
             logout()
 
     st.markdown("---")
 
+    heartbeat(st.session_state.current_user)
+
+    available_rooms = rooms.list_rooms()
+    if current_room() not in available_rooms:
+        leave_deleted_room()
+
     # Sidebar
     with st.sidebar:
         st.title("Chat Info")
 
+        st.selectbox("Room", available_rooms, index=available_rooms.index(current_room()),
+                     key="room_choice", on_change=change_room, format_func=lambda r: f"#{r}")
+
         # User info
-        users = load_users()
-        if st.session_state.current_user in users:
-            user_name = users[st.session_state.current_user]["name"]
+        user = get_user(st.session_state.current_user)
+        if user is not None:
+            user_name = user["name"]
             st.success(f"Welcome, {user_name}")
         else:
             st.success(f"Welcome, {st.session_state.current_user}")
 
         if st.session_state.is_admin:
             st.info("Admin Access")
-            if st.button("Admin Panel", use_container_width=True):
+            if st.button("Admin Panel", width="stretch"):
                 st.session_state.show_admin = True
                 st.rerun()
 
         st.markdown("---")
 
         # Chat statistics
-        global_messages = load_global_chat()
-        st.metric("Total Messages", len(global_messages))
-        st.metric("Online Users", len(users))
+        total_messages = count_global_chat()
+        st.metric("Total Messages", total_messages)
+        online = online_users()
+        st.metric("Online Users", len(online))
+        with st.expander("Who's online"):
+            st.text("\n".join(online[:ONLINE_LIST_LIMIT]))
+            if len(online) > ONLINE_LIST_LIMIT:
+                st.caption(f"and {len(online) - ONLINE_LIST_LIMIT} more")
 
         # Admin can see auto-refresh settings, users cannot
         if st.session_state.is_admin:
-            admin_settings = load_admin_settings()
-            refresh_interval = admin_settings.get("auto_refresh_interval", 2)
-            st.info(f"Auto-refresh: {refresh_interval}s")
+            low, high = refresh_scheduler.refresh_bounds(load_admin_settings())
+            st.info(f"Auto-refresh: {low:g}–{high:g}s")
 
         if st.button("Refresh Now"):
+            st.session_state.chat_version = None
             st.rerun()
 
+        st.markdown("---")
+        chat_query = st.text_input("Search chat", placeholder="Words, prefix* or from:username")
+        if chat_query.strip():
+            try:
+                matches, _ = search_global_chat(chat_query, limit=SIDEBAR_SEARCH_RESULTS)
+            except stores.StoreError as e:
+                st.error(f"Search failed: {e}")
+            else:
+                if not matches:
+                    st.caption("No matching messages")
+                for msg in matches:
+                    st.text(format_search_hit(msg))
+
     # Check if user is banned
-    users = load_users()
-    if (st.session_state.current_user in users and
-            users[st.session_state.current_user].get("status", "active") == "banned"):
+    if user is not None and user.get("status", "active") == "banned":
         st.error("Your account has been banned. You cannot send messages.")
         st.stop()
 
-    # Auto-refresh logic
-    admin_settings = load_admin_settings()
-    refresh_interval = admin_settings.get("auto_refresh_interval", 2)
-
-    current_time = time.time()
-    time_since_last_check = current_time - st.session_state.last_global_check
-
-    if time_since_last_check >= refresh_interval:
-        st.session_state.last_global_check = current_time
-        st.rerun()
-
-    # Load and display messages
-    global_messages = load_global_chat()
+    # Live updates: only the message area reruns, on this session's adaptive interval
+    live_updates.watch_store(room_store(), current_room())
     current_user = st.session_state.current_user
+    if live_updates.notifier_for(current_room()).version != st.session_state.chat_version:
+        st.session_state.refresh_level = 0
+    low, high, load_factor = refresh_settings()
+    st.session_state.refresh_interval = refresh_scheduler.refresh_interval(
+        st.session_state.refresh_level, low, high, load_factor)
+    st.session_state.refresh_changed_at = time.monotonic()
 
-    if global_messages:
-        st.subheader("")
+    st.fragment(chat_messages, run_every=st.session_state.refresh_interval)(current_user)
 
-        # Status info
-        col1_status, col2_status = st.columns([2, 1])
-        with col1_status:
-            st.info(f" {len(global_messages)} messages • Auto-refresh: ON ({refresh_interval}s)")
-        with col2_status:
-            current_time_str = datetime.now().strftime("%H:%M:%S")
-            st.caption(f"Last update: {current_time_str}")
-
-        # Message display
-        st.markdown('<div class="chat-container">', unsafe_allow_html=True)
-
-        # Show last 50 messages
-        for message in global_messages[-50:]:
-            content = message.get("content", "")
-            timestamp = message.get("timestamp", "")
-            message_user = message.get("user_id", "")
-
-            is_current_user = (message_user == current_user)
-
-            if is_current_user:
-                st.markdown(f"""
-                <div class="message-row-right">
-                    <div class="message-content">
-                        <div>{content}</div>
-                        <div class="message-time">{timestamp}</div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-            else:
-                st.markdown(f"""
-                <div class="message-row-left">
-                    <div class="message-content">
-                        <div><strong>{message_user}:</strong> {content}</div>
-                        <div class="message-time">{timestamp}</div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-
-        st.markdown('</div>', unsafe_allow_html=True)
-        st.markdown("<div style='height: 20px;'></div>", unsafe_allow_html=True)
-    else:
-        st.markdown("Welcome to Global Chat!")
     # Chat input (only if user is not banned)
     if global_prompt := st.chat_input("Type your message..."):
-        user_message = {
-            "role": "user",
-            "content": global_prompt,
-            "timestamp": format_message_time(),
-            "message_id": str(uuid4()),
-            "user_id": current_user
-        }
-
-        save_global_chat_message(user_message)
-        st.session_state.last_global_check = time.time()
-        st.rerun()
-
-    # Auto-refresh at the end
-    time.sleep(refresh_interval)
-    st.rerun()
+        user_message = chat_core.new_message(current_user, global_prompt)
+
+        try:
+            save_global_chat_message(user_message)
+        except rate_limit.RateLimited as e:
+            st.warning(f"Message not sent. {e}")
+        except chat_writer.WriteFailed as e:
+            st.error(str(e))
+        else:
+            st.rerun()
 
 
 def main():
+    # Page configuration
+    st.set_page_config(
+        page_title="Global Chat",
+        page_icon="🌐",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
+    metrics.registry.count_rerun()
+    metrics.start_export(stores.DATABASE_DIR)
+    retention.engine.start()
+    with metrics.registry.phase("script"):
+        run_script()
+
+
+def run_script():
     initialize_session()
 
     # Check authentication
@@ -562,7 +1156,7 @@ def main():
         with col1:
             pass
         with col2:
-            if st.button("← Back", use_container_width=True):
+            if st.button("← Back", width="stretch"):
                 st.session_state.show_admin = False
                 st.rerun()
         admin_panel()
@@ -0,0 +1,433 @@
+"""Headless load benchmark for the storage and render paths.
+
+Simulates concurrent chat sessions against a throwaway store, without Streamlit, and
+writes the results as JSON:
+
+    python benchmark.py --backend jsonl --sessions 50 --duration 10 --output run.json
+    python benchmark.py --backend jsonl --compare run.json
+
+Each session loops over the calls behind the app's helpers: save_global_chat_message (the
+group-commit writer), the fragment's poll (messages_since, then rendering its window),
+load_global_chat (the shared snapshot), logging in, and load_users. With --rooms N the
+sessions are spread over N rooms, each a storage shard with its own writer, the way
+rooms.py lays them out. --durability picks the fsync policy (see durability.py);
+"all" runs the benchmark once per mode and prints their throughput side by side.
+
+    python benchmark.py --import-time
+
+measures instead how long a fresh interpreter takes to import chat_core, the Streamlit-free
+module behind both front ends, and fails past --max-import-ms.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from functools import partial
+from uuid import uuid4
+
+import chat_writer
+import durability
+import message_render
+import retention
+import rooms
+import stores
+
+# Relative weight of each operation in a session's loop
+DEFAULT_MIX = {"send": 1.0, "poll": 4.0, "load_chat": 0.5, "login": 0.2, "load_users": 0.02}
+
+WINDOW_SIZE = 50
+
+# Fresh interpreters timed by --import-time; the fastest run is reported
+IMPORT_TIME_RUNS = 5
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(durations, errors, elapsed):
+    durations = sorted(durations)
+    return {
+        "count": len(durations),
+        "errors": errors,
+        "throughput_per_s": round(len(durations) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(durations, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(durations, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(durations, 0.99) * 1000, 3),
+        "max_ms": round(durations[-1] * 1000, 3) if durations else 0.0,
+    }
+
+
+def directory_size(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def all_message_ids(store):
+    # Retained and archived, in pages, so the check works past the 1000-message cap
+    ids = set()
+    seq = 0
+    while True:
+        page = store.messages_after(seq, 1000)
+        if not page:
+            return ids
+        ids.update(m.get("message_id") for m in page)
+        seq = page[-1]["seq"]
+
+
+class Session(threading.Thread):
+    def __init__(self, bench, number):
+        super().__init__(name=f"bench-session-{number}", daemon=True)
+        self.bench = bench
+        self.username = f"user{number % bench.user_count}"
+        self.store, self.writer = bench.rooms[number % len(bench.rooms)]
+        self.random = random.Random(number)
+        self.cursor = None
+        self.window = deque(maxlen=WINDOW_SIZE)
+        self.durations = {op: [] for op in bench.mix}
+        self.durations["render"] = []
+        self.errors = dict.fromkeys(self.durations, 0)
+        self.acknowledged = []
+
+    def run(self):
+        operations = list(self.bench.mix)
+        weights = [self.bench.mix[op] for op in operations]
+        self.bench.start.wait()
+        while not self.bench.stop.is_set():
+            op = self.random.choices(operations, weights)[0]
+            started = time.perf_counter()
+            try:
+                getattr(self, op)()
+            except Exception:
+                self.errors[op] += 1
+            else:
+                self.durations[op].append(time.perf_counter() - started)
+            if self.bench.think_time:
+                time.sleep(self.random.uniform(0, 2 * self.bench.think_time))
+
+    def send(self):
+        message = {
+            "role": "user",
+            "content": f"benchmark message from {self.username} " + "x" * self.bench.message_size,
+            "timestamp": datetime.now().strftime("%H:%M:%S"),
+            "message_id": str(uuid4()),
+            "user_id": self.username,
+        }
+        self.writer.submit(message)
+        self.acknowledged.append(message["message_id"])
+
+    def poll(self):
+        new_messages, self.cursor, reset = self.store.messages_since(self.cursor, WINDOW_SIZE)
+        if reset:
+            self.window.clear()
+        self.window.extend(new_messages)
+        if new_messages or reset:
+            started = time.perf_counter()
+            message_render.render_transcript(self.window, self.username)
+            self.durations["render"].append(time.perf_counter() - started)
+
+    def load_chat(self):
+        self.store.snapshot()
+
+    def login(self):
+        user = self.bench.store.get_user(self.username)
+        if user is None:
+            raise LookupError(self.username)
+        self.bench.store.update_user(self.username, {"last_login": datetime.now().isoformat()})
+
+    def load_users(self):
+        self.bench.store.load_users()
+
+
+class Benchmark:
+    def __init__(self, backend, directory, sessions, duration, users, mix, think_time,
+                 message_size, room_count=1, processes=1):
+        self.backend = backend
+        self.directory = directory
+        self.session_count = sessions
+        self.duration = duration
+        self.user_count = users
+        self.mix = mix
+        self.think_time = think_time
+        self.message_size = message_size
+        self.processes = processes
+        # Users live in the default store; every extra room is a shard under rooms/
+        self.store = stores.create_store(backend, directory)
+        self.rooms = []
+        self.retention = retention.RetentionEngine(
+            room_stores=lambda: [(number, room[0]) for number, room in enumerate(self.rooms)],
+            settings=self.store.cached_settings)
+        for number in range(room_count):
+            store = self.store if number == 0 else stores.create_store(
+                backend, rooms.room_directory(f"room{number}", directory))
+            # Same commit path as the app: the search index catches up after every commit and
+            # compaction runs in the background
+            writer = chat_writer.GroupCommitWriter(
+                store.append_messages, on_commit=partial(self._after_commit, number, store))
+            self.rooms.append((store, writer))
+        self.start = threading.Event()
+        self.stop = threading.Event()
+
+    def _after_commit(self, number, store):
+        store.update_search_index()
+        self.retention.request(number)
+
+    def seed_users(self):
+        users = {f"user{i}": {"name": f"User {i}", "email": f"user{i}@example.com",
+                              "password": "", "status": "active",
+                              "created_at": datetime.now().isoformat(), "last_login": None}
+                 for i in range(self.user_count)}
+        self.store.save_users(users)
+
+    def run_sessions(self, first, count):
+        # Sessions first..first+count-1 in this process; returns their raw measurements
+        sessions = [Session(self, i) for i in range(first, first + count)]
+        for session in sessions:
+            session.start()
+        started = time.perf_counter()
+        self.start.set()
+        time.sleep(self.duration)
+        self.stop.set()
+        for session in sessions:
+            session.join()
+        ops = list(self.mix) + ["render"]
+        return {
+            "elapsed": time.perf_counter() - started,
+            "durations": {op: [d for s in sessions for d in s.durations[op]] for op in ops},
+            "errors": {op: sum(s.errors[op] for s in sessions) for op in ops},
+            "acknowledged": [m for s in sessions for m in s.acknowledged],
+            "commits": sum(writer.stats()["commits"] for _, writer in self.rooms),
+        }
+
+    def run(self):
+        self.seed_users()
+        syncs_before = durability.policy.stats()
+        if self.processes == 1:
+            parts = [self.run_sessions(0, self.session_count)]
+        else:
+            # Separate server processes sharing the store directory, like several
+            # Streamlit servers behind one load balancer
+            per_process = -(-self.session_count // self.processes)
+            jobs = [(self.backend, self.directory, self.duration, self.user_count, self.mix,
+                     self.think_time, self.message_size, len(self.rooms), first,
+                     min(per_process, self.session_count - first))
+                    for first in range(0, self.session_count, per_process)]
+            with multiprocessing.get_context("spawn").Pool(len(jobs)) as pool:
+                parts = pool.map(_run_worker, jobs)
+        elapsed = max(part["elapsed"] for part in parts)
+
+        operations = {}
+        for op in parts[0]["durations"]:
+            durations = [d for part in parts for d in part["durations"][op]]
+            errors = sum(part["errors"][op] for part in parts)
+            operations[op] = summarize(durations, errors, elapsed)
+
+        acknowledged = [m for part in parts for m in part["acknowledged"]]
+        stored = set()
+        for store, _ in self.rooms:
+            stored |= all_message_ids(store)
+        lost = sum(1 for message_id in acknowledged if message_id not in stored)
+        commits = sum(part["commits"] for part in parts)
+        durability.policy.flush()
+        syncs = durability.policy.stats()
+        return {
+            "config": {
+                "backend": self.backend,
+                "sessions": self.session_count,
+                "rooms": len(self.rooms),
+                "processes": len(parts),
+                "duration_s": self.duration,
+                "users": self.user_count,
+                "mix": self.mix,
+                "think_time_s": self.think_time,
+                "message_size": self.message_size,
+                "durability": syncs["mode"],
+            },
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+            },
+            "elapsed_s": round(elapsed, 3),
+            "operations": operations,
+            "messages": {
+                "acknowledged": len(acknowledged),
+                "send_errors": operations["send"]["errors"] if "send" in operations else 0,
+                "lost": lost,
+                "commits": commits,
+                "avg_batch": round(len(acknowledged) / commits, 2) if commits else 0.0,
+            },
+            "store_bytes": directory_size(self.directory),
+            # This process's fsyncs, including the final flush of what "interval" had pending
+            "fsync": {
+                "count": syncs["syncs"] - syncs_before["syncs"],
+                "seconds": round(syncs["sync_seconds"] - syncs_before["sync_seconds"], 3),
+                "errors": syncs["errors"] - syncs_before["errors"],
+            },
+        }
+
+
+def _run_worker(job):
+    (backend, directory, duration, users, mix, think_time, message_size, room_count,
+     first, count) = job
+    bench = Benchmark(backend, directory, count, duration, users, mix, think_time,
+                      message_size, room_count)
+    return bench.run_sessions(first, count)
+
+
+def measure_import_time(module="chat_core", runs=IMPORT_TIME_RUNS):
+    # Cumulative import time of `module` in ms, from -X importtime in fresh interpreters,
+    # and the heavy modules it pulled in along the way
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = (f"import sys, {module}; "
+            "print(' '.join(m for m in ('streamlit', 'stores', 'sqlite3', 'watchdog') "
+            "if m in sys.modules))")
+    best = None
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=here,
+                                capture_output=True, text=True, check=True)
+        # Lines read "import time: self [us] | cumulative | imported package"
+        for line in result.stderr.splitlines():
+            fields = [field.strip() for field in line.split("|")]
+            if len(fields) == 3 and fields[2] == module:
+                ms = int(fields[1]) / 1000
+                best = ms if best is None else min(best, ms)
+    return {
+        "module": module,
+        "import_ms": round(best, 1),
+        "runs": runs,
+        "heavy_modules_loaded": result.stdout.split(),
+    }
+
+
+def parse_mix(text):
+    mix = dict(DEFAULT_MIX)
+    for part in filter(None, (p.strip() for p in text.split(","))):
+        op, _, weight = part.partition("=")
+        if op not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown operation {op!r}")
+        mix[op] = float(weight)
+    return {op: weight for op, weight in mix.items() if weight > 0}
+
+
+def compare(previous, current):
+    # One line per operation: p95 latency and throughput relative to the earlier run
+    lines = []
+    for op, now in current["operations"].items():
+        before = previous.get("operations", {}).get(op)
+        if not before:
+            continue
+
+        def change(key):
+            if not before[key]:
+                return "n/a"
+            return f"{(now[key] - before[key]) / before[key]:+.1%}"
+
+        lines.append(f"{op:<11} p95 {before['p95_ms']:>9.3f} -> {now['p95_ms']:>9.3f} ms "
+                     f"({change('p95_ms')})   throughput {before['throughput_per_s']:>9.1f} -> "
+                     f"{now['throughput_per_s']:>9.1f}/s ({change('throughput_per_s')})")
+    lost_before = previous.get("messages", {}).get("lost", 0)
+    lines.append(f"lost messages {lost_before} -> {current['messages']['lost']}")
+    return "\n".join(lines)
+
+
+def compare_durability(runs):
+    # One line per durability mode: send throughput and latency, and what the fsyncs cost
+    lines = []
+    for mode, run in runs.items():
+        send = run["operations"].get("send", {})
+        lines.append(f"{mode:<9} send {send.get('throughput_per_s', 0.0):>8.1f}/s   "
+                     f"p50 {send.get('p50_ms', 0.0):>8.3f} ms   "
+                     f"p95 {send.get('p95_ms', 0.0):>8.3f} ms   "
+                     f"fsyncs {run['fsync']['count']:>6} ({run['fsync']['seconds']:.2f} s)   "
+                     f"lost {run['messages']['lost']}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=("json", "jsonl", "sqlite"),
+                        default=stores.STORE_BACKEND)
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--users", type=int, default=1000, help="registered users to seed")
+    parser.add_argument("--rooms", type=int, default=1, help="rooms to spread sessions over")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="server processes to spread sessions over")
+    parser.add_argument("--mix", type=parse_mix, default=dict(DEFAULT_MIX),
+                        help="operation weights, e.g. send=1,poll=4,load_chat=0.5,login=0.2,load_users=0")
+    parser.add_argument("--think-time", type=float, default=0.01,
+                        help="mean pause between a session's operations, in seconds")
+    parser.add_argument("--message-size", type=int, default=80)
+    parser.add_argument("--directory", help="store directory (default: a temporary one)")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--durability", choices=durability.DURABILITY_MODES + ("all",),
+                        default=durability.policy.mode,
+                        help="fsync policy, or all to compare every mode")
+    parser.add_argument("--import-time", action="store_true",
+                        help="only measure how long importing chat_core takes")
+    parser.add_argument("--max-import-ms", type=float, default=50.0,
+                        help="with --import-time, fail when the import is slower than this")
+    args = parser.parse_args(argv)
+
+    if args.import_time:
+        results = measure_import_time()
+        print(json.dumps(results, indent=2))
+        too_slow = results["import_ms"] > args.max_import_ms
+        return 1 if too_slow or results["heavy_modules_loaded"] else 0
+
+    modes = durability.DURABILITY_MODES if args.durability == "all" else (args.durability,)
+    runs = {}
+    for mode in modes:
+        durability.policy.configure(mode)
+        # Inherited by --processes workers
+        os.environ["CHAT_DURABILITY"] = mode
+        directory = args.directory or tempfile.mkdtemp(prefix="chat-bench-")
+        if args.directory and len(modes) > 1:
+            directory = os.path.join(args.directory, mode)
+        try:
+            runs[mode] = Benchmark(args.backend, directory, args.sessions, args.duration,
+                                   args.users, args.mix, args.think_time, args.message_size,
+                                   args.rooms, args.processes).run()
+        finally:
+            if not args.directory:
+                shutil.rmtree(directory, ignore_errors=True)
+    results = runs[modes[0]] if len(modes) == 1 else {"durability": runs}
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if len(modes) > 1:
+        print(compare_durability(runs), file=sys.stderr)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            print(compare(json.load(f), results), file=sys.stderr)
+    return 1 if any(run["messages"]["lost"] for run in runs.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,446 @@
+"""Local message broker for running several app server processes side by side.
+
+    python broker.py serve --listen unix:database/broker.sock
+    CHAT_BROKER=unix:database/broker.sock streamlit run app.py --server.port 8501
+    CHAT_BROKER=unix:database/broker.sock streamlit run app.py --server.port 8502
+
+The broker is the only process that writes messages: it sequences and persists them
+through the normal store of each room (group-committed), then pushes a commit event to
+every subscribed app process, which wakes its sessions at once instead of waiting for a
+file watcher. Users and settings are still written by the app processes directly.
+
+    python broker.py check --workers 4 --messages 100
+
+starts a broker and several worker processes in a scratch directory, checks that every
+message was stored once and in order and reports delivery latency; it exits with 1 when a
+check fails. Workers send and read through the same writer, notifier and store calls as
+the app's sessions.
+"""
+import argparse
+import json
+import os
+import queue
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+
+import broker_client
+import chat_core
+import chat_writer
+import live_updates
+import retention
+import rooms
+import stores
+
+DEFAULT_ADDRESS = "unix:" + os.path.join(stores.DATABASE_DIR, "broker.sock")
+
+# A subscriber whose socket has not taken a send for this long is dropped; it reconnects
+SEND_TIMEOUT = 5.0
+
+# How often a check worker compares its room's change counter
+WORKER_CHECK_INTERVAL = 0.002
+
+MESSAGE_FIELDS = ("role", "content", "timestamp", "message_id", "user_id", "sent_at")
+
+
+class _Connection:
+    # Everything sent to one app process is queued for a thread of its own, so a process
+    # that stops reading stalls that thread, never the commit thread of a room
+    def __init__(self, sock):
+        self.sock = sock
+        self._queue = queue.Queue()
+        self._sending_since = None
+        self.alive = True
+        threading.Thread(target=self._send_loop, name="broker-send", daemon=True).start()
+
+    def send(self, payload):
+        if not self.alive:
+            return
+        since = self._sending_since
+        if since is not None and time.monotonic() - since > SEND_TIMEOUT:
+            self.close()
+            return
+        self._queue.put(broker_client.encode(payload))
+
+    def _send_loop(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            self._sending_since = time.monotonic()
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.close()
+                return
+            self._sending_since = None
+
+    def close(self):
+        # Also ends the handler's read loop; the client reconnects
+        if not self.alive:
+            return
+        self.alive = False
+        self._queue.put(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class Broker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._writers = {}
+        self._subscribers = set()
+        self.appended = 0
+
+    def writer(self, room):
+        writer = self._writers.get(room)
+        if writer is None:
+            with self._lock:
+                writer = self._writers.get(room)
+                if writer is None:
+                    writer = self._writers[room] = chat_writer.GroupCommitWriter(
+                        partial(self._commit, room), on_commit=partial(self._committed, room))
+        return writer
+
+    def _commit(self, room, messages):
+        rooms.get_room_store(room).append_messages(messages)
+
+    def _committed(self, room):
+        event = {"event": "commit", "room": room}
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for connection in subscribers:
+            connection.send(event)
+            if not connection.alive:
+                self.unsubscribe(connection)
+        retention.engine.request(room)
+        try:
+            rooms.get_room_store(room).update_search_index()
+        except stores.StoreError:
+            pass
+
+    def subscribe(self, connection):
+        with self._lock:
+            self._subscribers.add(connection)
+
+    def unsubscribe(self, connection):
+        with self._lock:
+            self._subscribers.discard(connection)
+
+    def append(self, request, reply):
+        # Queues every message with the room's writer and replies once all are committed
+        room = request.get("room", rooms.DEFAULT_ROOM)
+        messages = request.get("messages")
+        if not isinstance(messages, list) or not all(isinstance(m, dict) for m in messages):
+            reply({"ok": False, "error": "messages must be a list of objects"})
+            return
+        try:
+            rooms.get_room_store(room)
+        except stores.StoreError as e:
+            reply({"ok": False, "error": str(e)})
+            return
+        if not messages:
+            reply({"ok": True, "count": 0})
+            return
+        remaining = [len(messages)]
+        errors = []
+        lock = threading.Lock()
+
+        def done(error):
+            with lock:
+                if error is not None:
+                    errors.append(error)
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            if errors:
+                reply({"ok": False, "error": f"Message could not be saved: {errors[0]}"})
+            else:
+                self.appended += len(messages)
+                reply({"ok": True, "count": len(messages)})
+
+        writer = self.writer(room)
+        for message in messages:
+            # Seqs are the broker's to hand out
+            writer.enqueue({key: message[key] for key in MESSAGE_FIELDS if key in message}, done)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        broker = self.server.broker
+        connection = _Connection(self.request)
+        self.request.settimeout(None)
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    connection.send({"ok": False, "error": "invalid JSON"})
+                    continue
+                reply = partial(_reply, connection, request.get("id"))
+                op = request.get("op")
+                if op == "subscribe":
+                    broker.subscribe(connection)
+                elif op == "append":
+                    broker.append(request, reply)
+                elif op == "ping":
+                    reply({"ok": True})
+                else:
+                    reply({"ok": False, "error": f"unknown op {op!r}"})
+        except OSError:
+            pass
+        finally:
+            broker.unsubscribe(connection)
+            connection.close()
+
+
+def _reply(connection, request_id, payload):
+    if request_id is not None:
+        connection.send(dict(payload, id=request_id))
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TcpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(address, broker):
+    family, target = broker_client.parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(target):
+            # Left behind by a broker that did not shut down cleanly
+            os.remove(target)
+        server = _UnixServer(target, _Handler)
+    else:
+        server = _TcpServer(target, _Handler)
+    server.broker = broker
+    return server
+
+
+def serve(address):
+    server = make_server(address, Broker())
+    print(f"Broker listening on {address}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        family, target = broker_client.parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(target):
+            os.remove(target)
+
+
+# -- check
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_worker(address, index, workers, count, start_at, interval):
+    # One app process, wired the way app.py and chat_core are: sends go through the room's
+    # BrokerWriter, and reads follow the room's ChangeNotifier, fed by the broker's commit
+    # events and the store watcher. Times how long every other worker's messages take to
+    # show up in this process's reads.
+    room = rooms.DEFAULT_ROOM
+    if live_updates.broker is None or broker_client.BROKER_ADDRESS != address:
+        raise SystemExit(f"CHAT_BROKER must be set to {address}")
+    live_updates.watch_store(rooms.get_room_store(room), room)
+    notifier = live_updates.notifier_for(room)
+    writer = chat_writer.get_chat_writer(room)
+    expected = workers * count
+    seen = {}
+    latencies = []
+    out_of_order = 0
+    done = threading.Event()
+
+    def read_loop():
+        # A session's fragment tick, only much more often: compare the counter, and read
+        # what is new once it moved
+        nonlocal out_of_order
+        cursor = None
+        seen_version = None
+        last_n = {}
+        while not done.is_set():
+            version = notifier.version
+            if version == seen_version:
+                time.sleep(WORKER_CHECK_INTERVAL)
+                continue
+            seen_version = version
+            now = time.time()
+            messages, cursor, _ = chat_core.load_global_chat_since(cursor, expected + 1, room)
+            for message in messages:
+                try:
+                    body = json.loads(message["content"])
+                except (KeyError, ValueError):
+                    continue
+                key = (body["worker"], body["n"])
+                if key in seen:
+                    continue
+                seen[key] = message.get("seq")
+                if body["n"] < last_n.get(body["worker"], -1):
+                    out_of_order += 1
+                last_n[body["worker"]] = body["n"]
+                if body["worker"] != index:
+                    latencies.append(now - body["sent"])
+            if len(seen) >= expected:
+                done.set()
+
+    reader = threading.Thread(target=read_loop, daemon=True)
+    reader.start()
+    time.sleep(max(0.0, start_at - time.time()))
+    errors = 0
+    for n in range(count):
+        message = chat_core.new_message(f"worker{index}",
+                                        json.dumps({"worker": index, "n": n, "sent": time.time()}))
+        message["message_id"] = f"w{index}-{n}"
+        try:
+            writer.submit(message)
+        except chat_writer.WriteFailed:
+            errors += 1
+        time.sleep(interval)
+    done.wait(30)
+    done.set()
+    reader.join()
+    live_updates.broker.close()
+    return {"worker": index, "errors": errors, "seen": len(seen), "out_of_order": out_of_order,
+            "latencies": latencies}
+
+
+def wait_for_broker(address, timeout=10.0):
+    deadline = time.time() + timeout
+    while True:
+        client = broker_client.BrokerClient(address)
+        try:
+            client.request({"op": "ping"})
+            return
+        except broker_client.BrokerError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+        finally:
+            client.close()
+
+
+def check(workers, count, interval, max_p95_ms, address=None):
+    directory = tempfile.mkdtemp(prefix="chat-broker-check-")
+    address = address or "unix:" + os.path.join(directory, "broker.sock")
+    script = os.path.abspath(__file__)
+    env = dict(os.environ, CHAT_BROKER=address)
+    broker_process = subprocess.Popen([sys.executable, script, "serve", "--listen", address],
+                                      cwd=directory, env=env, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_broker(address)
+        start_at = time.time() + 2.0
+        worker_processes = [
+            subprocess.Popen([sys.executable, script, "worker", "--listen", address,
+                              "--index", str(i), "--workers", str(workers),
+                              "--messages", str(count), "--start-at", repr(start_at),
+                              "--interval", repr(interval)],
+                             cwd=directory, env=env, stdout=subprocess.PIPE, text=True)
+            for i in range(workers)
+        ]
+        results = [json.loads(p.communicate(timeout=120)[0]) for p in worker_processes]
+        stored = []
+        store = stores.create_store(stores.STORE_BACKEND,
+                                    os.path.join(directory, stores.DATABASE_DIR))
+        seq = 0
+        while True:
+            page = store.messages_after(seq, 1000)
+            if not page:
+                break
+            stored += page
+            seq = page[-1]["seq"]
+    finally:
+        broker_process.terminate()
+        broker_process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    failures = []
+    expected = workers * count
+    ids = [m.get("message_id") for m in stored]
+    if len(stored) != expected or len(set(ids)) != expected:
+        failures.append(f"stored {len(stored)} messages ({len(set(ids))} unique), "
+                        f"expected {expected}")
+    seqs = [m.get("seq") for m in stored]
+    if any(b <= a for a, b in zip(seqs, seqs[1:])):
+        failures.append("seqs are not strictly increasing")
+    last = {}
+    for message in stored:
+        body = json.loads(message["content"])
+        if body["n"] <= last.get(body["worker"], -1):
+            failures.append(f"worker {body['worker']}'s messages are out of order")
+            break
+        last[body["worker"]] = body["n"]
+    for result in results:
+        if result["errors"]:
+            failures.append(f"worker {result['worker']}: {result['errors']} sends failed")
+        if result["seen"] != expected:
+            failures.append(f"worker {result['worker']} saw {result['seen']} of {expected}")
+        if result["out_of_order"]:
+            failures.append(f"worker {result['worker']} saw {result['out_of_order']} "
+                            f"messages out of order")
+    latencies = [l * 1000 for result in results for l in result["latencies"]]
+    p95 = _percentile(latencies, 0.95)
+    if max_p95_ms and p95 > max_p95_ms:
+        failures.append(f"p95 delivery latency {p95:.1f} ms is above {max_p95_ms} ms")
+
+    print(f"{workers} workers x {count} messages via {address.partition(':')[0]} "
+          f"({stores.STORE_BACKEND} store): {len(stored)} stored")
+    print(f"delivery latency ms: p50 {_percentile(latencies, 0.5):.1f}  p95 {p95:.1f}  "
+          f"p99 {_percentile(latencies, 0.99):.1f}  max {max(latencies, default=0):.1f}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("OK" if not failures else "FAILED")
+    return 0 if not failures else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="run the broker")
+    serve_parser.add_argument("--listen", default=broker_client.BROKER_ADDRESS or DEFAULT_ADDRESS,
+                              help="unix:PATH or tcp:HOST:PORT")
+    check_parser = commands.add_parser("check", help="check ordering and delivery latency")
+    check_parser.add_argument("--workers", type=int, default=4)
+    check_parser.add_argument("--messages", type=int, default=100, help="per worker")
+    check_parser.add_argument("--interval", type=float, default=0.005,
+                              help="pause between a worker's sends, in seconds")
+    check_parser.add_argument("--max-p95-ms", type=float, default=500.0)
+    check_parser.add_argument("--listen", help="address to test (default: a scratch socket)")
+    worker_parser = commands.add_parser("worker")  # started by check
+    worker_parser.add_argument("--listen", required=True)
+    worker_parser.add_argument("--index", type=int, required=True)
+    worker_parser.add_argument("--workers", type=int, required=True)
+    worker_parser.add_argument("--messages", type=int, required=True)
+    worker_parser.add_argument("--start-at", type=float, required=True)
+    worker_parser.add_argument("--interval", type=float, required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        serve(args.listen)
+        return 0
+    if args.command == "check":
+        return check(args.workers, args.messages, args.interval, args.max_p95_ms, args.listen)
+    print(json.dumps(run_worker(args.listen, args.index, args.workers, args.messages,
+                                args.start_at, args.interval)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
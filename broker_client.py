@@ -0,0 +1,163 @@
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+
+# "unix:/path/to/broker.sock" or "tcp:127.0.0.1:8765"; empty means no broker, and every
+# process writes to the store files itself
+BROKER_ADDRESS = os.environ.get("CHAT_BROKER", "")
+
+# How long a send waits for the broker to confirm the commit
+REQUEST_TIMEOUT = 10.0
+RECONNECT_INTERVAL = 1.0
+
+
+class BrokerError(OSError):
+    pass
+
+
+def parse_address(address):
+    # (socket family, address) from "unix:PATH" or "tcp:HOST:PORT"
+    kind, _, rest = address.partition(":")
+    if kind == "unix" and rest:
+        return socket.AF_UNIX, rest
+    if kind == "tcp":
+        host, _, port = rest.rpartition(":")
+        if host and port.isdigit():
+            return socket.AF_INET, (host, int(port))
+    raise ValueError(f"Broker address must be unix:PATH or tcp:HOST:PORT, not {address!r}")
+
+
+def encode(payload):
+    return (json.dumps(payload, separators=(",", ":"), ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class BrokerClient:
+    # One connection per app process, shared by every session. Requests are pipelined:
+    # each carries an id and the reader thread hands replies back to the waiting callers,
+    # while commit events go to on_commit(room). A dropped connection is re-opened in the
+    # background; after a reconnect on_commit is called with None, because events may have
+    # been missed.
+    def __init__(self, address, on_commit=None, timeout=REQUEST_TIMEOUT):
+        self.family, self.address = parse_address(address)
+        self.on_commit = on_commit
+        self.timeout = timeout
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._pending = {}  # request id -> [Event, reply]
+        self._sock = None
+        self._reader = None
+        self._closed = False
+
+    def _connect(self):
+        # Caller holds self._lock
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        if self.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(encode({"op": "subscribe"}))
+        self._sock = sock
+        self._reader = threading.Thread(target=self._read, args=(sock,), name="chat-broker-reader",
+                                        daemon=True)
+        self._reader.start()
+
+    def _ensure_connected(self):
+        with self._lock:
+            if self._sock is None:
+                try:
+                    self._connect()
+                except OSError as e:
+                    raise BrokerError(f"Broker unavailable at {self.address}: {e}") from e
+            return self._sock
+
+    def start(self):
+        # Connects now and keeps reconnecting, so commit events flow before the first send
+        threading.Thread(target=self._keep_connected, name="chat-broker-connect",
+                         daemon=True).start()
+
+    def _keep_connected(self):
+        while not self._closed:
+            try:
+                self._ensure_connected()
+            except BrokerError:
+                pass
+            time.sleep(RECONNECT_INTERVAL)
+
+    def _read(self, sock):
+        buffer = b""
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                buffer += data
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    self._dispatch(json.loads(line))
+        except (OSError, ValueError):
+            pass
+        self._disconnected(sock)
+
+    def _dispatch(self, payload):
+        if "event" in payload:
+            if payload["event"] == "commit" and self.on_commit is not None:
+                self.on_commit(payload.get("room"))
+            return
+        with self._lock:
+            waiter = self._pending.pop(payload.get("id"), None)
+        if waiter is not None:
+            waiter[1] = payload
+            waiter[0].set()
+
+    def _disconnected(self, sock):
+        with self._lock:
+            if self._sock is sock:
+                self._sock = None
+            pending, self._pending = self._pending, {}
+        sock.close()
+        for waiter in pending.values():
+            waiter[1] = {"ok": False, "error": "connection to the broker was lost"}
+            waiter[0].set()
+        if self.on_commit is not None and not self._closed:
+            self.on_commit(None)
+
+    def request(self, payload):
+        # Sends one request and waits for its reply; raises BrokerError on failure
+        sock = self._ensure_connected()
+        request_id = next(self._ids)
+        waiter = [threading.Event(), None]
+        with self._lock:
+            self._pending[request_id] = waiter
+        try:
+            with self._send_lock:
+                sock.sendall(encode(dict(payload, id=request_id)))
+        except OSError as e:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise BrokerError(f"Could not reach the broker: {e}") from e
+        if not waiter[0].wait(self.timeout):
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise BrokerError("The broker did not answer in time")
+        reply = waiter[1]
+        if not reply.get("ok"):
+            raise BrokerError(reply.get("error", "request failed"))
+        return reply
+
+    def append(self, room, messages):
+        # Returns once the broker has committed the messages to the room's store
+        return self.request({"op": "append", "room": room, "messages": list(messages)})
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            sock, self._sock = self._sock, None
+        if sock is not None:
+            sock.close()
@@ -0,0 +1,355 @@
+import gzip
+import json
+import os
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+import durability
+from locking import FileLock
+
+SEGMENT_MAX_MESSAGES = 250
+SEGMENT_SUFFIX = ".jsonl"
+OFFSETS_SUFFIX = ".idx"
+# Sealed segments written while compression is on; offsets refer to the uncompressed data
+COMPRESSED_SUFFIX = ".gz"
+
+# Offset tables kept in memory; each one covers a single sealed segment
+OFFSETS_CACHE_SIZE = 32
+# Decompressed segments kept in memory, so paging through one costs a single inflate
+DATA_CACHE_SIZE = 4
+
+
+def encode_record(record):
+    return json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n"
+
+
+def parse_lines(data):
+    messages = []
+    for line in data.splitlines():
+        try:
+            messages.append(json.loads(line))
+        except ValueError:
+            continue
+    return messages
+
+
+def line_offsets(data):
+    # Byte offset of every line start, plus the end of the data
+    offsets = [0]
+    position = data.find(b"\n")
+    while position != -1:
+        offsets.append(position + 1)
+        position = data.find(b"\n", position + 1)
+    return offsets
+
+
+class ChatArchive:
+    # Messages trimmed from the live store. Sealed segments never change and come with an
+    # offsets file, so a page of history is one seek and one read no matter how long the
+    # archive is. index.jsonl lists the sealed segments; open.jsonl collects the next one.
+    # Gzipped segments are inflated whole instead, and the last few are kept in memory.
+    def __init__(self, directory, segment_max_messages=SEGMENT_MAX_MESSAGES, compress=False):
+        self.directory = directory
+        self.segment_max_messages = segment_max_messages
+        # Whether segments sealed from now on are gzipped; older ones keep their format
+        self.compress = compress
+        self.index_file = os.path.join(directory, "index.jsonl")
+        self.open_file = os.path.join(directory, "open" + SEGMENT_SUFFIX)
+        self._file_lock = FileLock(os.path.join(directory, "archive"))
+        self._lock = threading.RLock()
+        self._segments = []  # [first_seq, last_seq, count, name], oldest first
+        self._first_seqs = []
+        self._index_offset = 0
+        self._index_ino = None
+        self._open_size = 0
+        self._open_messages = []
+        self._offsets = OrderedDict()
+        self._data = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+
+    # -- reading
+
+    def _sync(self):
+        # One stat per file when nothing changed. Appends keep the index inode; a rewrite
+        # (removal or clear) replaces it, and then every cached offset table is stale too.
+        try:
+            st = os.stat(self.index_file)
+            index_ino, index_size = st.st_ino, st.st_size
+        except FileNotFoundError:
+            index_ino, index_size = None, 0
+        if index_ino != self._index_ino or index_size < self._index_offset:
+            self._index_ino = index_ino
+            self._segments = []
+            self._first_seqs = []
+            self._index_offset = 0
+            self._offsets.clear()
+            self._data.clear()
+        if index_size > self._index_offset:
+            with open(self.index_file, "rb") as f:
+                f.seek(self._index_offset)
+                data = f.read()
+            end = data.rfind(b"\n") + 1
+            for entry in parse_lines(data[:end]):
+                self._segments.append([entry["first_seq"], entry["last_seq"], entry["count"],
+                                       entry["name"]])
+                self._first_seqs.append(entry["first_seq"])
+            self._index_offset += end
+        try:
+            open_size = os.path.getsize(self.open_file)
+        except FileNotFoundError:
+            open_size = 0
+        if open_size != self._open_size:
+            try:
+                with open(self.open_file, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                data = b""
+            data = data[:data.rfind(b"\n") + 1]
+            sealed_seq = self._segments[-1][1] if self._segments else 0
+            # A seal interrupted before open.jsonl was removed leaves already sealed messages
+            self._open_messages = [m for m in parse_lines(data) if m.get("seq", 0) > sealed_seq]
+            self._open_size = open_size
+
+    @property
+    def last_seq(self):
+        with self._lock:
+            self._sync()
+            if self._open_messages:
+                return self._open_messages[-1].get("seq", 0)
+            return self._segments[-1][1] if self._segments else 0
+
+    @property
+    def first_seq(self):
+        with self._lock:
+            self._sync()
+            if self._segments:
+                return self._segments[0][0]
+            return self._open_messages[0].get("seq", 0) if self._open_messages else None
+
+    def __len__(self):
+        with self._lock:
+            self._sync()
+            return sum(s[2] for s in self._segments) + len(self._open_messages)
+
+    def _segment_offsets(self, name):
+        offsets = self._offsets.get(name)
+        if offsets is None:
+            with open(os.path.join(self.directory, name + OFFSETS_SUFFIX), "r") as f:
+                offsets = json.load(f)
+            self._offsets[name] = offsets
+            if len(self._offsets) > OFFSETS_CACHE_SIZE:
+                self._offsets.popitem(last=False)
+        else:
+            self._offsets.move_to_end(name)
+        return offsets
+
+    def read_before(self, seq, limit):
+        # The newest `limit` archived messages with a seq below `seq`, oldest first. Reads at
+        # most one partial segment per boundary crossed, never the whole archive.
+        with self._lock:
+            self._sync()
+            page = [m for m in self._open_messages if m.get("seq", 0) < seq][-limit:]
+            index = bisect_left(self._first_seqs, seq) - 1
+            while len(page) < limit and index >= 0:
+                name = self._segments[index][3]
+                stop = bisect_left(self._segment_offsets(name)["seqs"], seq)
+                page[:0] = self._read_lines(name, max(0, stop - (limit - len(page))), stop)
+                index -= 1
+            return page
+
+    def read_after(self, seq, limit):
+        # The oldest `limit` archived messages with a seq above `seq`
+        with self._lock:
+            self._sync()
+            page = []
+            index = max(0, bisect_right(self._first_seqs, seq) - 1)
+            while len(page) < limit and index < len(self._segments):
+                name = self._segments[index][3]
+                seqs = self._segment_offsets(name)["seqs"]
+                start = bisect_right(seqs, seq)
+                page += self._read_lines(name, start, min(len(seqs), start + limit - len(page)))
+                index += 1
+            if len(page) < limit:
+                page += [m for m in self._open_messages if m.get("seq", 0) > seq][:limit - len(page)]
+            return page
+
+    def read_seqs(self, seqs):
+        # {seq: message} for the requested seqs that are archived; one short read per message
+        found = {}
+        with self._lock:
+            self._sync()
+            open_messages = {m.get("seq"): m for m in self._open_messages}
+            for seq in seqs:
+                if seq in open_messages:
+                    found[seq] = open_messages[seq]
+                    continue
+                index = bisect_right(self._first_seqs, seq) - 1
+                if index < 0 or seq > self._segments[index][1]:
+                    continue
+                name = self._segments[index][3]
+                segment_seqs = self._segment_offsets(name)["seqs"]
+                position = bisect_left(segment_seqs, seq)
+                if position < len(segment_seqs) and segment_seqs[position] == seq:
+                    found[seq] = self._read_lines(name, position, position + 1)[0]
+        return found
+
+    def _read_lines(self, name, start, stop):
+        # Messages start..stop of a sealed segment, read with one seek
+        if start >= stop:
+            return []
+        offsets = self._segment_offsets(name)["offsets"]
+        if name.endswith(COMPRESSED_SUFFIX):
+            return parse_lines(self._segment_data(name)[offsets[start]:offsets[stop]])
+        with open(os.path.join(self.directory, name), "rb") as f:
+            f.seek(offsets[start])
+            return parse_lines(f.read(offsets[stop] - offsets[start]))
+
+    def _segment_data(self, name):
+        # The uncompressed bytes of a sealed segment
+        data = self._data.get(name)
+        if data is None:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                data = f.read()
+            if name.endswith(COMPRESSED_SUFFIX):
+                data = gzip.decompress(data)
+                self._data[name] = data
+                if len(self._data) > DATA_CACHE_SIZE:
+                    self._data.popitem(last=False)
+        else:
+            self._data.move_to_end(name)
+        return data
+
+    def size_bytes(self):
+        # Bytes on disk, offsets files and index included
+        total = 0
+        for entry in os.scandir(self.directory):
+            try:
+                total += entry.stat().st_size
+            except FileNotFoundError:
+                continue
+        return total
+
+    # -- writing
+
+    def append(self, messages):
+        # Messages at or below the last archived seq are already here (a retried trim)
+        with self._file_lock, self._lock:
+            self._sync()
+            last_seq = self.last_seq
+            messages = [m for m in messages if m.get("seq", 0) > last_seq]
+            while messages:
+                room = self.segment_max_messages - len(self._open_messages)
+                batch, messages = messages[:room], messages[room:]
+                data = "".join(encode_record(m) for m in batch).encode("utf-8")
+                with open(self.open_file, "ab") as f:
+                    f.write(data)
+                    durability.policy.written(f)
+                self._open_messages.extend(batch)
+                self._open_size += len(data)
+                if len(self._open_messages) >= self.segment_max_messages:
+                    self._seal()
+
+    def _write_segment(self, name, messages):
+        data = "".join(encode_record(m) for m in messages).encode("utf-8")
+        path = os.path.join(self.directory, name)
+        with durability.atomic_write(path, "wb") as f:
+            f.write(gzip.compress(data) if name.endswith(COMPRESSED_SUFFIX) else data)
+        offsets = {"seqs": [m.get("seq", 0) for m in messages], "offsets": line_offsets(data)}
+        with durability.atomic_write(path + OFFSETS_SUFFIX) as f:
+            json.dump(offsets, f, separators=(",", ":"))
+        self._offsets.pop(name, None)
+        self._data.pop(name, None)
+
+    def _seal(self):
+        messages = self._open_messages
+        first_seq, last_seq = messages[0].get("seq", 0), messages[-1].get("seq", 0)
+        name = f"{first_seq:012d}{SEGMENT_SUFFIX}"
+        if self.compress:
+            name += COMPRESSED_SUFFIX
+        self._write_segment(name, messages)
+        entry = {"first_seq": first_seq, "last_seq": last_seq, "count": len(messages), "name": name}
+        with open(self.index_file, "ab") as f:
+            f.write(encode_record(entry).encode("utf-8"))
+            durability.policy.written(f)
+        os.remove(self.open_file)
+        self._sync()
+
+    def remove_messages(self, predicate, seqs=None):
+        # Moderation only: rewrites the segments holding matching messages and the index.
+        # With `seqs`, the seqs of every match, other segments are not even read.
+        with self._file_lock, self._lock:
+            self._sync()
+            removed = 0
+            segments = []
+            if seqs is not None:
+                seqs = sorted(seqs)
+            for first_seq, last_seq, count, name in self._segments:
+                path = os.path.join(self.directory, name)
+                if seqs is not None and (bisect_right(seqs, last_seq)
+                                         == bisect_left(seqs, first_seq)):
+                    segments.append({"first_seq": first_seq, "last_seq": last_seq,
+                                     "count": count, "name": name})
+                    continue
+                messages = parse_lines(self._segment_data(name))
+                kept = [m for m in messages if not predicate(m)]
+                removed += len(messages) - len(kept)
+                if len(kept) != len(messages):
+                    self._write_segment(name, kept)
+                if kept:
+                    segments.append({"first_seq": first_seq, "last_seq": last_seq,
+                                     "count": len(kept), "name": name})
+                else:
+                    os.remove(path)
+                    os.remove(path + OFFSETS_SUFFIX)
+            kept = [m for m in self._open_messages if not predicate(m)]
+            removed += len(self._open_messages) - len(kept)
+            if removed:
+                self._rewrite_index(segments, kept)
+            return removed
+
+    def compress_segments(self):
+        # Gzips every sealed segment that is still plain text; returns how many were
+        with self._file_lock, self._lock:
+            self._sync()
+            segments = []
+            plain = []
+            for first_seq, last_seq, count, name in self._segments:
+                if not name.endswith(COMPRESSED_SUFFIX):
+                    messages = parse_lines(self._segment_data(name))
+                    plain.append(name)
+                    name += COMPRESSED_SUFFIX
+                    self._write_segment(name, messages)
+                segments.append({"first_seq": first_seq, "last_seq": last_seq, "count": count,
+                                 "name": name})
+            if plain:
+                self._rewrite_index(segments, self._open_messages)
+                # Only once the index points at the compressed copies
+                for name in plain:
+                    for path in (name, name + OFFSETS_SUFFIX):
+                        try:
+                            os.remove(os.path.join(self.directory, path))
+                        except FileNotFoundError:
+                            pass
+            return len(plain)
+
+    def _rewrite_index(self, segments, open_messages):
+        with durability.atomic_write(self.open_file, encoding="utf-8") as f:
+            f.writelines(encode_record(m) for m in open_messages)
+        with durability.atomic_write(self.index_file, encoding="utf-8") as f:
+            f.writelines(encode_record(s) for s in segments)
+        self._index_ino = None
+        self._open_size = -1
+        self._sync()
+
+    def clear(self):
+        with self._file_lock, self._lock:
+            self._sync()
+            for segment in self._segments:
+                for path in (segment[3], segment[3] + OFFSETS_SUFFIX):
+                    try:
+                        os.remove(os.path.join(self.directory, path))
+                    except FileNotFoundError:
+                        pass
+            self._offsets.clear()
+            self._rewrite_index([], [])
@@ -0,0 +1,133 @@
+import os
+import sys
+import threading
+import weakref
+from collections.abc import Mapping
+
+MESSAGE_FIELDS = ("role", "content", "timestamp", "message_id", "user_id", "sent_at", "seq")
+# Repeated across messages, so one string object per distinct value is enough
+INTERNED_FIELDS = ("role", "timestamp", "user_id")
+
+_MISSING = object()
+
+
+def file_version(path):
+    # Cheap change detector: any rewrite bumps the mtime and usually the size or inode
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class Message(Mapping):
+    # Read-only message record: one slot per known field instead of a dict, with the
+    # repeated strings interned. Reads like the dict it was built from (get, [], in, dict()).
+    __slots__ = MESSAGE_FIELDS + ("_extra", "__weakref__")
+
+    def __init__(self, data):
+        known = 0
+        for key in MESSAGE_FIELDS:
+            value = data.get(key, _MISSING)
+            if value is not _MISSING:
+                known += 1
+                if key in INTERNED_FIELDS and type(value) is str:
+                    value = sys.intern(value)
+            setattr(self, key, value)
+        self._extra = None
+        if len(data) > known:
+            self._extra = {k: v for k, v in data.items() if k not in MESSAGE_FIELDS}
+
+    def __getitem__(self, key):
+        if key in MESSAGE_FIELDS:
+            value = getattr(self, key)
+            if value is not _MISSING:
+                return value
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in MESSAGE_FIELDS:
+            value = getattr(self, key)
+            return default if value is _MISSING else value
+        if self._extra is not None:
+            return self._extra.get(key, default)
+        return default
+
+    def __iter__(self):
+        for key in MESSAGE_FIELDS:
+            if getattr(self, key) is not _MISSING:
+                yield key
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"Message({dict(self)!r})"
+
+
+# Records by message_id, so every session's window and the shared snapshot hold the same
+# objects whichever backend read them; a record goes away with the last reference to it
+_records = weakref.WeakValueDictionary()
+
+
+def freeze_message(message):
+    if type(message) is Message:
+        return message
+    message_id = message.get("message_id")
+    if message_id is None:
+        return Message(message)
+    record = _records.get(message_id)
+    if record is None or record.get("seq") != message.get("seq"):
+        record = _records[message_id] = Message(message)
+    return record
+
+
+def freeze_messages(messages):
+    return tuple(freeze_message(m) for m in messages)
+
+
+def messages_after(messages, message_id):
+    # Scans back from the newest message; returns None when the cursor is no longer present
+    for index in range(len(messages) - 1, -1, -1):
+        if messages[index].get("message_id") == message_id:
+            return messages[index + 1:]
+    return None
+
+
+class VersionedCache:
+    def __init__(self, freeze=freeze_messages):
+        self._freeze = freeze
+        self._lock = threading.Lock()
+        self._version = None
+        self._snapshot = ()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version, load):
+        with self._lock:
+            if version is not None and version == self._version:
+                self.hits += 1
+                return self._snapshot
+            self.misses += 1
+            # Parsing under the lock means concurrent misses wait for one parse
+            snapshot = self._freeze(load())
+            self._version = version
+            self._snapshot = snapshot
+            return snapshot
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+# One snapshot per process, shared by every Streamlit session
+global_chat_cache = VersionedCache()
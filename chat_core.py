@@ -0,0 +1,195 @@
+"""Chat, user and settings operations shared by app.py, gc.py and headless tools.
+
+Nothing here imports Streamlit, and the storage layer (stores, rooms, the writers and
+their watchers) is only imported by the first call that needs it, so importing this
+module stays cheap for scripts and workers that use a few of its functions:
+
+    python benchmark.py --import-time
+
+Chat functions take a room and default to the main one; the front ends pass the room
+of the session.
+"""
+import hashlib
+import time
+from datetime import datetime
+from uuid import uuid4
+
+
+def hash_password(password):
+    return hashlib.sha256(password.encode()).hexdigest()
+
+
+def new_message(user_id, content):
+    # timestamp is what the chat shows; sent_at dates the message for exports
+    now = datetime.now()
+    return {
+        "role": "user",
+        "content": content,
+        "timestamp": now.strftime("%H:%M:%S"),
+        "message_id": str(uuid4()),
+        "user_id": user_id,
+        "sent_at": now.isoformat(timespec="seconds"),
+    }
+
+
+def user_store():
+    # Users and settings live in the main store, whatever the room
+    import stores
+    return stores.get_store()
+
+
+def room_store(room=None):
+    # The store shard of a room; raises ValueError for one that does not exist
+    import rooms
+    return rooms.get_room_store(room or rooms.DEFAULT_ROOM)
+
+
+def _notify(room):
+    import live_updates
+    live_updates.notifier_for(room).notify()
+
+
+# Users and settings
+
+def load_users():
+    import metrics
+    with metrics.registry.phase("load_users"):
+        return user_store().load_users()
+
+
+def load_admin_settings():
+    # Read-only and shared by every session; only re-read after a settings change
+    import metrics
+    with metrics.registry.phase("load_admin_settings"):
+        return user_store().cached_settings()
+
+
+def save_users(users):
+    user_store().save_users(users)
+
+
+def update_admin_settings(changes):
+    return user_store().update_settings(changes)
+
+
+def get_user(username):
+    return user_store().get_user(username)
+
+
+def count_users():
+    return user_store().count_users()
+
+
+def search_users(query, status, offset, limit):
+    return user_store().search_users(query, status, offset, limit)
+
+
+def create_user(username, user_data):
+    return user_store().create_user(username, user_data)
+
+
+def set_user_status(username, status):
+    user_store().update_user(username, {"status": status})
+
+
+def delete_user(username):
+    user_store().delete_user(username)
+
+
+def record_login(username):
+    user_store().update_user(username, {"last_login": datetime.now().isoformat()})
+
+
+def bulk_moderate(action, usernames):
+    # One storage commit for the whole selection; returns (records changed, seconds)
+    import rooms
+    store = user_store()
+    start = time.perf_counter()
+    if action == "Ban":
+        changed = store.update_users_bulk(usernames, {"status": "banned"})
+    elif action == "Unban":
+        changed = store.update_users_bulk(usernames, {"status": "active"})
+    elif action == "Delete users":
+        changed = store.delete_users_bulk(usernames)
+    else:
+        changed = 0
+        for room, shard in rooms.room_stores():
+            changed += shard.delete_messages_by_users(usernames)
+            _notify(room)
+    return changed, time.perf_counter() - start
+
+
+# Chat
+
+def save_global_chat_message(message, room=None):
+    # Raises RateLimited when the sender or the whole server is over its limit, and
+    # WriteFailed on error; concurrent sends to a room are batched into one locked commit
+    import chat_writer
+    import rate_limit
+    import rooms
+    rate_limit.limiter.configure(load_admin_settings())
+    rate_limit.limiter.acquire(message["user_id"])
+    chat_writer.get_chat_writer(room or rooms.DEFAULT_ROOM).submit(message)
+
+
+def load_global_chat(room=None):
+    # Returns the room's process-wide read-only snapshot; only re-read when the room changes.
+    # Raises StoreError when the store cannot be read.
+    import metrics
+    with metrics.registry.phase("load_global_chat"):
+        return room_store(room).snapshot()
+
+
+def count_global_chat(room=None):
+    return room_store(room).count_messages()
+
+
+def count_archived_chat(room=None):
+    return room_store(room).count_archived_messages()
+
+
+def load_global_chat_since(cursor, limit, room=None):
+    # Returns (new_messages, new_cursor, reset); reset means the cursor is stale and the
+    # caller should drop its window and start over from the returned tail
+    return room_store(room).messages_since(cursor, limit)
+
+
+def load_global_chat_before(seq, limit, room=None):
+    # Up to `limit` messages from just before `seq`, oldest first
+    return room_store(room).messages_before(seq, limit)
+
+
+def load_deleted_since(position, room=None):
+    # Returns (message_ids deleted since position, new position, purged); purged means
+    # compaction rewrote the tombstones and the caller should start its window over
+    return room_store(room).tombstones.since(position)
+
+
+def delete_global_chat_message(message_id, room=None):
+    # One tombstone; every session drops the message on its next sync, and the space is
+    # reclaimed by the next compaction
+    import rooms
+    room = room or rooms.DEFAULT_ROOM
+    deleted = room_store(room).delete_message(message_id)
+    if deleted:
+        _notify(room)
+    return deleted
+
+
+def clear_global_chat(room=None):
+    import rooms
+    room = room or rooms.DEFAULT_ROOM
+    room_store(room).clear_messages()
+    _notify(room)
+
+
+def search_global_chat(query, user=None, limit=50, room=None):
+    # Returns (matches newest first, seconds taken)
+    start = time.perf_counter()
+    matches = room_store(room).search_messages(query, user or None, limit)
+    return matches, time.perf_counter() - start
+
+
+def format_search_hit(message):
+    return (f"[{message.get('timestamp', '')}] {message.get('user_id', '')}: "
+            f"{message.get('content', '')}")
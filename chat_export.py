@@ -0,0 +1,277 @@
+"""Streaming export and import of chat history and users, as JSONL or CSV.
+
+    python chat_export.py export messages --user alice --since 2026-10-01 -o chat.jsonl
+    python chat_export.py export users --format csv -o users.csv
+    python chat_export.py import messages chat.jsonl --room support
+    python chat_export.py import users users.csv
+
+Exports read the store one page at a time, archive included, so their memory use does not
+grow with the history. Imports commit in batches and let retention move each room's
+overflow to its archive between batches, so the live store stays at its usual size
+whatever the file holds. Imported messages get new seqs after the room's current ones.
+Messages whose id is still in the live store are skipped, and so are existing usernames;
+messages already moved to the archive are not looked up.
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import tempfile
+import time
+from datetime import datetime
+from uuid import uuid4
+
+import chat_core
+import retention
+import rooms
+
+FORMATS = ("jsonl", "csv")
+
+# Columns of the CSV files, and the fields an import takes from either format
+MESSAGE_FIELDS = ("seq", "message_id", "user_id", "role", "timestamp", "sent_at", "content")
+USER_FIELDS = ("username", "name", "email", "password", "status", "created_at", "last_login")
+
+EXPORT_PAGE_SIZE = 1000
+IMPORT_BATCH_SIZE = 500
+
+
+def parse_time(value):
+    # "2026-10-18" or "2026-10-18T09:30" to the sortable form messages carry in sent_at
+    return datetime.fromisoformat(value).isoformat(timespec="seconds")
+
+
+def iter_messages(store, user=None, since=None, until=None, page_size=EXPORT_PAGE_SIZE):
+    # Oldest first, without deleted messages. since/until bound sent_at (until exclusive);
+    # with either set, messages from before sent_at existed are left out.
+    since = parse_time(since) if since else None
+    until = parse_time(until) if until else None
+    deleted = store.tombstones.deleted_ids()
+    seq = 0
+    while True:
+        page = store.messages_after(seq, page_size)
+        if not page:
+            return
+        seq = page[-1]["seq"]
+        for message in page:
+            if message.get("message_id") in deleted:
+                continue
+            if user is not None and message.get("user_id") != user:
+                continue
+            if since or until:
+                sent_at = message.get("sent_at")
+                if not sent_at or (since and sent_at < since) or (until and sent_at >= until):
+                    continue
+            yield dict(message)
+
+
+def iter_users(store, page_size=EXPORT_PAGE_SIZE):
+    # Ordered by username, one page of the user directory at a time
+    offset = 0
+    while True:
+        _, page = store.search_users("", None, offset, page_size)
+        for username, user in page:
+            yield dict(user, username=username)
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+def jsonl_lines(records):
+    for record in records:
+        yield json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n"
+
+
+def csv_lines(records, fields):
+    # One row at a time through a small buffer; fields outside `fields` are dropped
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fields, extrasaction="ignore")
+    writer.writeheader()
+    for record in records:
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(record)
+    yield buffer.getvalue()
+
+
+def export_lines(kind, fmt="jsonl", room=None, user=None, since=None, until=None):
+    # The export as a stream of text lines; kind is "messages" or "users"
+    if kind == "messages":
+        records = iter_messages(chat_core.room_store(room), user, since, until)
+        fields = MESSAGE_FIELDS
+    else:
+        records = iter_users(chat_core.user_store())
+        fields = USER_FIELDS
+    return csv_lines(records, fields) if fmt == "csv" else jsonl_lines(records)
+
+
+def export_file(kind, fmt="jsonl", **filters):
+    # The export spooled to an unnamed temporary file, rewound; for download buttons
+    f = tempfile.TemporaryFile()
+    for line in export_lines(kind, fmt, **filters):
+        f.write(line.encode("utf-8"))
+    f.seek(0)
+    return f
+
+
+def read_records(lines, fmt="jsonl"):
+    # Dicts from an iterable of text lines; raises ValueError on the first bad line
+    if fmt == "csv":
+        for row in csv.DictReader(lines):
+            yield {key: value for key, value in row.items() if key is not None and value != ""}
+        return
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if not isinstance(record, dict):
+            raise ValueError(f"Line {number} is not a JSON object")
+        yield record
+
+
+def message_from_record(record):
+    # The stored form of an imported message, or None when it has no sender or text
+    if not record.get("user_id") or record.get("content") is None:
+        return None
+    message = {
+        "role": record.get("role") or "user",
+        "content": str(record["content"]),
+        "timestamp": record.get("timestamp") or "",
+        "message_id": record.get("message_id") or str(uuid4()),
+        "user_id": str(record["user_id"]),
+    }
+    if record.get("sent_at"):
+        message["sent_at"] = record["sent_at"]
+    return message
+
+
+def user_from_record(record):
+    # (username, user) for an imported user, or None without a username
+    username = record.get("username")
+    if not username:
+        return None
+    user = {field: record[field] for field in USER_FIELDS[1:] if record.get(field) is not None}
+    user.setdefault("status", "active")
+    return str(username), user
+
+
+def import_messages(records, room=None, batch_size=IMPORT_BATCH_SIZE):
+    # Returns counts of imported, skipped (already present) and invalid records
+    room = room or rooms.DEFAULT_ROOM
+    store = chat_core.room_store(room)
+    engine = retention.RetentionEngine(room_stores=lambda: [(room, store)])
+    started = time.perf_counter()
+    counts = {"imported": 0, "skipped": 0, "invalid": 0, "batches": 0}
+    batch = {}
+    for record in records:
+        message = message_from_record(record)
+        if message is None:
+            counts["invalid"] += 1
+        elif (message["message_id"] in batch
+              or store.message_index.lookup(message["message_id"]) is not None):
+            counts["skipped"] += 1
+        else:
+            batch[message["message_id"]] = message
+            if len(batch) >= batch_size:
+                _commit_messages(store, engine, batch, counts)
+    if batch:
+        _commit_messages(store, engine, batch, counts)
+    store.update_search_index()
+    counts["seconds"] = round(time.perf_counter() - started, 3)
+    return counts
+
+
+def _commit_messages(store, engine, batch, counts):
+    store.append_messages(list(batch.values()))
+    counts["imported"] += len(batch)
+    counts["batches"] += 1
+    batch.clear()
+    # Moves what is over the room's cap to the archive before the next batch
+    engine.run(full=False)
+
+
+def import_users(records, batch_size=IMPORT_BATCH_SIZE):
+    store = chat_core.user_store()
+    started = time.perf_counter()
+    counts = {"imported": 0, "skipped": 0, "invalid": 0, "batches": 0}
+    batch = {}
+    for record in records:
+        found = user_from_record(record)
+        if found is None:
+            counts["invalid"] += 1
+            continue
+        batch[found[0]] = found[1]
+        if len(batch) >= batch_size:
+            _commit_users(store, batch, counts)
+    if batch:
+        _commit_users(store, batch, counts)
+    counts["seconds"] = round(time.perf_counter() - started, 3)
+    return counts
+
+
+def _commit_users(store, batch, counts):
+    created = store.create_users_bulk(batch)
+    counts["imported"] += created
+    counts["skipped"] += len(batch) - created
+    counts["batches"] += 1
+    batch.clear()
+
+
+def guess_format(path, fmt=None):
+    if fmt:
+        return fmt
+    return "csv" if path and path.lower().endswith(".csv") else "jsonl"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write messages or users to a file")
+    export_parser.add_argument("kind", choices=("messages", "users"))
+    export_parser.add_argument("--format", choices=FORMATS,
+                               help="default: from the output file name, else jsonl")
+    export_parser.add_argument("-o", "--output", help="default: standard output")
+    export_parser.add_argument("--room", help="room to export (default: global)")
+    export_parser.add_argument("--user", help="only this user's messages")
+    export_parser.add_argument("--since", type=parse_time,
+                               help="only messages sent at or after this ISO date/time")
+    export_parser.add_argument("--until", type=parse_time,
+                               help="only messages sent before this ISO date/time")
+    import_parser = commands.add_parser("import", help="add messages or users from a file")
+    import_parser.add_argument("kind", choices=("messages", "users"))
+    import_parser.add_argument("input", help="file to read, or - for standard input")
+    import_parser.add_argument("--format", choices=FORMATS,
+                               help="default: from the input file name, else jsonl")
+    import_parser.add_argument("--room", help="room to import into (default: global)")
+    import_parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        fmt = guess_format(args.output, args.format)
+        lines = export_lines(args.kind, fmt, room=args.room, user=args.user, since=args.since,
+                             until=args.until)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8", newline="") as f:
+                f.writelines(lines)
+        else:
+            sys.stdout.writelines(lines)
+        return 0
+
+    fmt = guess_format(args.input, args.format)
+    if args.input == "-":
+        source = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="")
+    else:
+        source = open(args.input, "r", encoding="utf-8", newline="")
+    with source:
+        records = read_records(source, fmt)
+        if args.kind == "messages":
+            counts = import_messages(records, args.room, args.batch_size)
+        else:
+            counts = import_users(records, args.batch_size)
+    print(json.dumps(counts))
+    return 1 if counts["invalid"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,357 @@
+import json
+import os
+import threading
+from bisect import bisect_right
+
+import durability
+from locking import FileLock
+
+DATABASE_DIR = "database"
+LOG_DIR = os.path.join(DATABASE_DIR, "global_chat_log")
+LEGACY_CHAT_FILE = os.path.join(DATABASE_DIR, "global_chat.json")
+
+MAX_MESSAGES = 1000
+SEGMENT_MAX_MESSAGES = 250
+SEGMENT_SUFFIX = ".jsonl"
+# Empty marker file whose name changes whenever messages are removed, so every process
+# notices the rewrite with the listdir it already does
+GENERATION_PREFIX = "generation-"
+
+
+def encode_record(record):
+    return json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n"
+
+
+def segment_name(first_seq):
+    return f"{first_seq:012d}{SEGMENT_SUFFIX}"
+
+
+def read_segment(path):
+    messages = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                # Torn write at the tail of the active segment
+                break
+            try:
+                messages.append(json.loads(line))
+            except ValueError:
+                continue
+    return messages
+
+
+class ChatLog:
+    def __init__(self, directory=LOG_DIR, max_messages=MAX_MESSAGES,
+                 segment_max_messages=SEGMENT_MAX_MESSAGES, legacy_file=LEGACY_CHAT_FILE,
+                 archive=None):
+        self.directory = directory
+        # Where compaction moves expired messages instead of deleting them
+        self.archive = archive
+        self.max_messages = max_messages
+        self.segment_max_messages = segment_max_messages
+        self._lock = threading.RLock()
+        # Serialises appends, compaction and clears with other server processes
+        self._file_lock = FileLock(os.path.join(directory, "log"))
+        self._segments = []  # [first_seq, path, message_count], oldest first
+        self._active_size = 0
+        self._last_seq = 0
+        self._generation = 0
+        self._marker = None
+
+        os.makedirs(self.directory, exist_ok=True)
+        with self._file_lock:
+            self._marker = self._scan()[1]
+            self._load_segments()
+            if not self._segments and archive is not None and archive.last_seq:
+                # A new log next to an existing archive continues its seqs
+                open(os.path.join(directory, segment_name(archive.last_seq + 1)), "w").close()
+                self._load_segments()
+            has_messages = any(s[2] for s in self._segments)
+            if not has_messages and legacy_file and os.path.exists(legacy_file):
+                self.import_legacy(legacy_file)
+
+    def _scan(self):
+        names = os.listdir(self.directory)
+        marker = max((n for n in names if n.startswith(GENERATION_PREFIX)), default=None)
+        return sorted(n for n in names if n.endswith(SEGMENT_SUFFIX)), marker
+
+    def _segment_names(self):
+        return self._scan()[0]
+
+    def _load_segments(self):
+        self._segments = []
+        self._active_size = 0
+        for name in self._segment_names():
+            path = os.path.join(self.directory, name)
+            try:
+                messages = read_segment(path)
+                self._active_size = os.path.getsize(path)
+            except FileNotFoundError:
+                continue
+            self._segments.append([int(name[:-len(SEGMENT_SUFFIX)]), path, len(messages)])
+            if messages:
+                self._last_seq = max(self._last_seq, messages[-1].get("seq", 0))
+            else:
+                self._last_seq = max(self._last_seq, self._segments[-1][0] - 1)
+
+    def _sync(self):
+        # Picks up appends, rolls and clears made by other processes. Cheap when nothing
+        # changed: one listdir plus one stat of the active segment.
+        names, marker = self._scan()
+        if marker != self._marker:
+            self._marker = marker
+            self._generation += 1
+            self._load_segments()
+            return
+        known = [os.path.basename(s[1]) for s in self._segments]
+        if names != known:
+            if known and known[-1] not in names:
+                # The active segment only disappears when the log was cleared
+                self._generation += 1
+            self._load_segments()
+            return
+        if not self._segments:
+            return
+        active = self._segments[-1]
+        try:
+            size = os.path.getsize(active[1])
+        except FileNotFoundError:
+            return
+        if size != self._active_size:
+            messages = read_segment(active[1])
+            active[2] = len(messages)
+            if messages:
+                self._last_seq = max(self._last_seq, messages[-1].get("seq", 0))
+            self._active_size = size
+
+    @staticmethod
+    def _repair_tail(path):
+        # Drop a partially written last line so the next append starts clean
+        with open(path, "rb+") as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) == b"\n":
+                return
+            f.seek(0)
+            data = f.read()
+            f.truncate(data.rfind(b"\n") + 1)
+
+    @property
+    def last_seq(self):
+        return self._last_seq
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def version(self):
+        # Compaction only drops messages beyond the cap, so it never changes what readers see
+        with self._lock:
+            self._sync()
+            return (self._generation, self._last_seq)
+
+    def __len__(self):
+        with self._lock:
+            self._sync()
+            return min(sum(s[2] for s in self._segments), self.max_messages)
+
+    def live_count(self):
+        # Messages in the log, including those compaction has yet to move out
+        with self._lock:
+            self._sync()
+            return sum(s[2] for s in self._segments)
+
+    def append(self, message):
+        return self.append_many([message])[0]
+
+    def append_many(self, messages):
+        # One locked write per batch; used by the group-commit writer
+        with self._file_lock, self._lock:
+            self._sync()
+            if self._segments:
+                self._repair_tail(self._segments[-1][1])
+            seqs = []
+            pending = []
+            for message in messages:
+                seq = self._last_seq + 1
+                record = dict(message)
+                record["seq"] = seq
+                if not self._segments or self._segments[-1][2] >= self.segment_max_messages:
+                    self._write_lines(pending)
+                    pending = []
+                    path = os.path.join(self.directory, segment_name(seq))
+                    self._segments.append([seq, path, 0])
+                    self._active_size = 0
+                pending.append(encode_record(record))
+                self._segments[-1][2] += 1
+                self._last_seq = seq
+                seqs.append(seq)
+            self._write_lines(pending)
+            return seqs
+
+    def _write_lines(self, lines):
+        if not lines:
+            return
+        data = "".join(lines).encode("utf-8")
+        with open(self._segments[-1][1], "ab") as f:
+            f.write(data)
+            durability.policy.written(f)
+        self._active_size += len(data)
+
+    def read_all(self):
+        with self._lock:
+            self._sync()
+            paths = [s[1] for s in self._segments]
+        messages = []
+        for path in paths:
+            try:
+                messages.extend(read_segment(path))
+            except FileNotFoundError:
+                # Trimmed by the compactor after we took the segment list
+                continue
+        return messages[-self.max_messages:]
+
+    def read_since(self, seq, limit=None):
+        # Walks segments newest-first, so the cost depends on new traffic, not history size
+        with self._lock:
+            self._sync()
+            if seq >= self._last_seq:
+                return []
+            segments = [(s[0], s[1]) for s in self._segments]
+        messages = []
+        for first_seq, path in reversed(segments):
+            try:
+                batch = read_segment(path)
+            except FileNotFoundError:
+                continue
+            messages[:0] = [m for m in batch if m.get("seq", 0) > seq]
+            if first_seq <= seq + 1 or (limit and len(messages) >= limit):
+                break
+        return messages[-limit:] if limit else messages
+
+    def read_tail(self, count):
+        return self.read_since(0, limit=count)
+
+    def read_before(self, seq, limit):
+        # Newest-first like read_since; only the segments that overlap the page are read
+        with self._lock:
+            self._sync()
+            segments = [(s[0], s[1]) for s in self._segments if s[0] < seq]
+        messages = []
+        for first_seq, path in reversed(segments):
+            try:
+                batch = read_segment(path)
+            except FileNotFoundError:
+                continue
+            messages[:0] = [m for m in batch if m.get("seq", 0) < seq]
+            if len(messages) >= limit:
+                break
+        return messages[-limit:]
+
+    def clear(self):
+        with self._file_lock, self._lock:
+            self._sync()
+            for segment in self._segments:
+                try:
+                    os.remove(segment[1])
+                except FileNotFoundError:
+                    pass
+            # Numbering carries on after a clear, so the archive never sees a seq twice
+            open(os.path.join(self.directory, segment_name(self._last_seq + 1)), "w").close()
+            self._bump_generation()
+            self._load_segments()
+
+    def _bump_generation(self):
+        number = int(self._marker[len(GENERATION_PREFIX):]) + 1 if self._marker else 1
+        marker = f"{GENERATION_PREFIX}{number:012d}"
+        open(os.path.join(self.directory, marker), "w").close()
+        if self._marker:
+            try:
+                os.remove(os.path.join(self.directory, self._marker))
+            except FileNotFoundError:
+                pass
+        self._marker = marker
+        self._generation += 1
+
+    def remove_messages(self, predicate, new_generation=True):
+        # Rewrites only the segments that hold matching messages, then starts a new generation
+        # so every reader drops its cursor (unless readers already hid the messages)
+        with self._file_lock, self._lock:
+            self._sync()
+            removed = 0
+            last_kept = 0
+            for first_seq, path, _count in self._segments:
+                try:
+                    messages = read_segment(path)
+                except FileNotFoundError:
+                    continue
+                kept = [m for m in messages if not predicate(m)]
+                if kept:
+                    last_kept = kept[-1].get("seq", 0)
+                if len(kept) == len(messages):
+                    continue
+                removed += len(messages) - len(kept)
+                if not kept:
+                    os.remove(path)
+                    continue
+                with durability.atomic_write(path, encoding="utf-8") as f:
+                    f.writelines(encode_record(m) for m in kept)
+            if removed:
+                if last_kept < self._last_seq:
+                    # Segment names carry the numbering across processes, so an empty segment
+                    # keeps removed tail seqs from being handed out again
+                    open(os.path.join(self.directory, segment_name(self._last_seq + 1)), "w").close()
+                if new_generation:
+                    self._bump_generation()
+                self._load_segments()
+            return removed
+
+    def import_legacy(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            messages = json.load(f).get("messages", [])
+        self.append_many(messages[-self.max_messages:])
+        # Keep the original around, but never import it a second time
+        os.replace(path, path + ".imported")
+        return len(messages)
+
+    def read_live(self):
+        # Every message in the log, past the cap too; for the retention engine
+        with self._lock:
+            self._sync()
+            paths = [s[1] for s in self._segments]
+        messages = []
+        for path in paths:
+            try:
+                messages.extend(read_segment(path))
+            except FileNotFoundError:
+                continue
+        return messages
+
+    def compact(self, through_seq=0, archive=True):
+        # Moves out everything up to through_seq plus whatever is over the cap, oldest first,
+        # to the archive or nowhere. Whole segments are deleted and at most one is rewritten.
+        # Returns the number of messages moved out.
+        with self._file_lock, self._lock:
+            self._sync()
+            excess = sum(s[2] for s in self._segments) - self.max_messages
+            expired = 0
+            for index, (first_seq, path, count) in enumerate(self._segments):
+                messages = read_segment(path)
+                seqs = [m.get("seq", 0) for m in messages]
+                drop = min(len(messages), max(excess - expired, bisect_right(seqs, through_seq)))
+                if drop <= 0:
+                    break
+                if archive and self.archive is not None:
+                    self.archive.append(messages[:drop])
+                expired += drop
+                if drop < len(messages):
+                    with durability.atomic_write(path, encoding="utf-8") as f:
+                        f.writelines(encode_record(m) for m in messages[drop:])
+                    break
+                if index == len(self._segments) - 1:
+                    # An empty segment named after the next seq keeps the numbering
+                    open(os.path.join(self.directory, segment_name(self._last_seq + 1)), "w").close()
+                os.remove(path)
+            self._load_segments()
+        return expired
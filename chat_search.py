@@ -0,0 +1,281 @@
+import base64
+import heapq
+import json
+import os
+import re
+import threading
+from array import array
+from bisect import bisect_left, insort
+from itertools import groupby, islice
+
+import durability
+from chat_cache import file_version
+from locking import FileLock
+
+# Journal entries folded into the base file once the journal grows past this, or past the
+# number of messages already in the base, whichever is larger (so rewrites stay amortised)
+JOURNAL_COMPACT_ENTRIES = 10000
+
+# Messages pulled from the store per catch-up read
+CATCH_UP_BATCH = 1000
+
+# Prefixes matching more terms than this are probed through a set instead of binary searches
+PROBE_ARRAYS = 16
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(str(text).lower())
+
+
+def parse_query(query):
+    # "word" must match a whole term, "wor*" any term with that prefix, "from:bob" the sender
+    terms, prefixes, user = [], [], None
+    for part in str(query).split():
+        if part.lower().startswith("from:") and len(part) > 5:
+            user = part[5:]
+        elif part.endswith("*"):
+            prefixes.extend(tokenize(part[:-1]))
+        else:
+            terms.extend(tokenize(part))
+    return terms, prefixes, user
+
+
+def _encode_postings(postings):
+    return {key: base64.b64encode(seqs.tobytes()).decode("ascii") for key, seqs in postings.items()}
+
+
+def _decode_postings(data):
+    postings = {}
+    for key, encoded in data.items():
+        seqs = array("q")
+        seqs.frombytes(base64.b64decode(encoded))
+        postings[key] = seqs
+    return postings
+
+
+def _contains(seqs, seq):
+    index = bisect_left(seqs, seq)
+    return index < len(seqs) and seqs[index] == seq
+
+
+class SearchIndex:
+    # Inverted index over every message the store has ever held (retained and archived):
+    # term -> seqs and sender -> seqs, each an ascending array of 8-byte ints. Persisted like
+    # the user directory: a base file plus an append-only journal with one line per message.
+    def __init__(self, directory, compact_entries=JOURNAL_COMPACT_ENTRIES):
+        self.directory = directory
+        self.base_file = os.path.join(directory, "index.json")
+        self.journal_file = os.path.join(directory, "index.journal.jsonl")
+        self.compact_entries = compact_entries
+        self._file_lock = FileLock(os.path.join(directory, "index"))
+        self._lock = threading.RLock()
+        self._terms = {}
+        self._users = {}
+        self._vocabulary = []  # sorted terms, for prefix queries
+        self._last_seq = 0
+        self._base_messages = 0
+        self._base_version = None
+        self._journal_offset = 0
+        self._journal_entries = 0
+        os.makedirs(directory, exist_ok=True)
+
+    # -- loading
+
+    def _add(self, seq, user, terms):
+        if seq <= self._last_seq:
+            return
+        for term in terms:
+            seqs = self._terms.get(term)
+            if seqs is None:
+                seqs = self._terms[term] = array("q")
+                insort(self._vocabulary, term)
+            seqs.append(seq)
+        if user is not None:
+            self._users.setdefault(user, array("q")).append(seq)
+        self._last_seq = seq
+
+    def _replay_journal(self, offset):
+        try:
+            with open(self.journal_file, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return offset
+        # Only whole lines; a line still being written is picked up next time
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line)
+                self._add(entry["seq"], entry.get("user"), entry["terms"])
+            except (ValueError, KeyError):
+                continue
+            self._journal_entries += 1
+        return offset + end
+
+    def _full_reload(self, base_version):
+        base = {}
+        if base_version is not None:
+            try:
+                with open(self.base_file, "r") as f:
+                    base = json.load(f)
+            except (OSError, ValueError):
+                base = {}
+        self._terms = _decode_postings(base.get("terms", {}))
+        self._users = _decode_postings(base.get("users", {}))
+        self._vocabulary = sorted(self._terms)
+        self._last_seq = base.get("last_seq", 0)
+        self._base_messages = base.get("messages", 0)
+        self._base_version = base_version
+        self._journal_entries = 0
+        self._journal_offset = self._replay_journal(0)
+
+    def refresh(self):
+        # Two stats when nothing changed
+        with self._lock:
+            base_version = file_version(self.base_file)
+            try:
+                journal_size = os.path.getsize(self.journal_file)
+            except FileNotFoundError:
+                journal_size = 0
+            if base_version != self._base_version or journal_size < self._journal_offset:
+                self._full_reload(base_version)
+            elif journal_size > self._journal_offset:
+                self._journal_offset = self._replay_journal(self._journal_offset)
+
+    @property
+    def last_seq(self):
+        with self._lock:
+            self.refresh()
+            return self._last_seq
+
+    def stats(self):
+        with self._lock:
+            self.refresh()
+            return {
+                "terms": len(self._terms),
+                "postings": sum(len(seqs) for seqs in self._terms.values()),
+                "last_seq": self._last_seq,
+            }
+
+    # -- writing
+
+    def add_messages(self, messages):
+        # Messages must come in seq order; ones already indexed (by any process) are skipped
+        with self._file_lock, self._lock:
+            self.refresh()
+            entries = []
+            for message in messages:
+                seq = message.get("seq", 0)
+                if seq <= self._last_seq:
+                    continue
+                terms = sorted(set(tokenize(message.get("content", ""))))
+                entries.append({"seq": seq, "user": message.get("user_id"), "terms": terms})
+                self._add(seq, message.get("user_id"), terms)
+            if not entries:
+                return 0
+            data = "".join(json.dumps(e, separators=(",", ":"), ensure_ascii=False) + "\n"
+                           for e in entries).encode("utf-8")
+            with open(self.journal_file, "ab") as f:
+                f.write(data)
+            self._journal_offset += len(data)
+            self._journal_entries += len(entries)
+            if self._journal_entries >= max(self.compact_entries, self._base_messages):
+                self._write_base()
+            return len(entries)
+
+    def catch_up(self, read_after):
+        # read_after(seq, limit) returns the next stored messages; only new ones are read
+        added = 0
+        while True:
+            messages = read_after(self.last_seq, CATCH_UP_BATCH)
+            if not messages:
+                return added
+            added += self.add_messages(messages)
+            if len(messages) < CATCH_UP_BATCH:
+                return added
+
+    def _write_base(self):
+        self._base_messages += self._journal_entries
+        base = {"last_seq": self._last_seq, "messages": self._base_messages,
+                "terms": _encode_postings(self._terms), "users": _encode_postings(self._users)}
+        with durability.atomic_write(self.base_file) as f:
+            json.dump(base, f, separators=(",", ":"))
+        with open(self.journal_file, "w"):
+            pass
+        self._base_version = file_version(self.base_file)
+        self._journal_offset = 0
+        self._journal_entries = 0
+
+    def clear(self):
+        # Drops every posting but keeps last_seq, so cleared messages are not indexed again
+        with self._file_lock, self._lock:
+            self.refresh()
+            self._terms = {}
+            self._users = {}
+            self._vocabulary = []
+            self._base_messages = 0
+            self._journal_entries = 0
+            self._write_base()
+
+    # -- querying
+
+    def _prefix_postings(self, prefix):
+        matched = []
+        for term in islice(self._vocabulary, bisect_left(self._vocabulary, prefix), None):
+            if not term.startswith(prefix):
+                break
+            matched.append(self._terms[term])
+        return _Postings(matched)
+
+    def search(self, query, user=None, limit=50, before=None):
+        # Newest matching seqs first, below `before` when given. Every word must match: the
+        # smallest postings list is walked backwards and stops after `limit` hits; the
+        # others are only probed.
+        terms, prefixes, query_user = parse_query(query)
+        user = user or query_user
+        with self._lock:
+            self.refresh()
+            lists = [_Postings([self._terms.get(term, array("q"))]) for term in terms]
+            lists += [self._prefix_postings(prefix) for prefix in prefixes]
+            if user:
+                lists.append(_Postings([self._users.get(user, array("q"))]))
+            if not lists:
+                return []
+            lists.sort(key=len)
+            driver, others = lists[0], lists[1:]
+            matches = []
+            for seq in driver.newest_first():
+                if before is not None and seq >= before:
+                    continue
+                if all(seq in postings for postings in others):
+                    matches.append(seq)
+                    if len(matches) >= limit:
+                        break
+            return matches
+
+
+class _Postings:
+    # The seqs of one query word: a single term, or every term sharing a prefix
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self._size = sum(len(seqs) for seqs in arrays)
+        self._members = None
+
+    def __len__(self):
+        return self._size
+
+    def newest_first(self):
+        if len(self.arrays) == 1:
+            return reversed(self.arrays[0])
+        # Lazy k-way merge, so a broad prefix costs only as much as the page it fills
+        merged = heapq.merge(*(reversed(seqs) for seqs in self.arrays), reverse=True)
+        return (seq for seq, _ in groupby(merged))
+
+    def __contains__(self, seq):
+        if len(self.arrays) <= PROBE_ARRAYS:
+            return any(_contains(seqs, seq) for seqs in self.arrays)
+        if self._members is None:
+            self._members = set().union(*self.arrays)
+        return seq in self._members
@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+
+import durability
+from locking import FileLock
+
+# Rebuild the message_id index from the live tail once it holds this many times the cap,
+# since ids of expired messages are only dropped then
+INDEX_SLACK = 2
+
+
+def encode_record(record):
+    return json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n"
+
+
+class TombstoneLog:
+    # Deleted message ids, appended to one small file instead of rewriting the store.
+    # Readers filter with the in-memory set, kept current with one stat per check. The
+    # retention engine purges the messages later and rewrites the log without them.
+    def __init__(self, path):
+        self.path = path
+        self._file_lock = FileLock(path)
+        self._lock = threading.Lock()
+        self._seqs = {}  # message_id -> seq
+        self._order = []  # message ids, in the order they were deleted
+        self._offset = 0
+        self._ino = None
+
+    def _sync(self):
+        # Caller holds self._lock
+        try:
+            st = os.stat(self.path)
+            ino, size = st.st_ino, st.st_size
+        except FileNotFoundError:
+            ino, size = None, 0
+        if ino != self._ino or size < self._offset:
+            self._ino = ino
+            self._seqs = {}
+            self._order = []
+            self._offset = 0
+        if size > self._offset:
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                data = f.read()
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                try:
+                    record = json.loads(line)
+                    message_id = record["message_id"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if message_id not in self._seqs:
+                    self._seqs[message_id] = record.get("seq")
+                    self._order.append(message_id)
+            self._offset += end
+
+    def version(self):
+        with self._lock:
+            self._sync()
+            return (self._ino, self._offset)
+
+    def generation(self):
+        # Changes only when a purge rewrites the log or a clear removes it, not per deletion
+        with self._lock:
+            self._sync()
+            return self._ino
+
+    def __len__(self):
+        with self._lock:
+            self._sync()
+            return len(self._seqs)
+
+    def deleted_ids(self):
+        # {message_id: seq} of every pending deletion; a mapping the caller must not change
+        with self._lock:
+            self._sync()
+            return self._seqs
+
+    def since(self, position):
+        # (ids deleted after `position`, new position, reset). reset means the log was
+        # rewritten by a purge, and the ids are every one still pending instead.
+        with self._lock:
+            self._sync()
+            current = (self._ino, len(self._order))
+            if position is None or position == (None, 0):
+                return list(self._order), current, False
+            if position[0] != self._ino or position[1] > len(self._order):
+                return list(self._order), current, True
+            return self._order[position[1]:], current, False
+
+    def add(self, message_id, seq=None):
+        # One short append, whatever the size of the chat
+        with self._file_lock, self._lock:
+            self._sync()
+            if message_id in self._seqs:
+                return False
+            data = encode_record({"message_id": message_id, "seq": seq}).encode("utf-8")
+            with open(self.path, "ab") as f:
+                f.write(data)
+                durability.policy.written(f)
+            self._sync()
+            return True
+
+    def discard(self, message_ids):
+        # Drops ids whose messages were purged from storage; tombstones added meanwhile stay
+        message_ids = set(message_ids)
+        with self._file_lock, self._lock:
+            self._sync()
+            kept = [message_id for message_id in self._order if message_id not in message_ids]
+            if len(kept) == len(self._order):
+                return
+            with durability.atomic_write(self.path, encoding="utf-8") as f:
+                f.writelines(encode_record({"message_id": message_id, "seq": self._seqs[message_id]})
+                             for message_id in kept)
+            self._sync()
+
+    def clear(self):
+        with self._file_lock, self._lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self._sync()
+
+
+class MessageIndex:
+    # message_id -> seq for live messages, kept current through messages_since so that a
+    # lookup only reads what was committed since the previous one
+    def __init__(self, read_since, capacity):
+        self.read_since = read_since
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._cursor = None
+        self._seqs = {}
+
+    def lookup(self, message_id):
+        with self._lock:
+            if len(self._seqs) > INDEX_SLACK * self.capacity():
+                self._cursor = None
+            messages, self._cursor, reset = self.read_since(self._cursor, 1 << 30)
+            if reset:
+                self._seqs = {}
+            for message in messages:
+                self._seqs[message.get("message_id")] = message.get("seq")
+            return self._seqs.get(message_id)
@@ -0,0 +1,162 @@
+import threading
+import time
+from functools import partial
+
+import broker_client
+import live_updates
+import retention
+import rooms
+import stores
+
+# Messages that arrive within this window are written in one commit
+GROUP_COMMIT_WINDOW = 0.002
+MAX_BATCH_SIZE = 500
+
+
+class WriteFailed(Exception):
+    pass
+
+
+class _PendingWrite:
+    __slots__ = ("message", "done", "error", "callback")
+
+    def __init__(self, message, callback=None):
+        self.message = message
+        self.done = threading.Event()
+        self.error = None
+        self.callback = callback
+
+
+class GroupCommitWriter:
+    def __init__(self, commit, window=GROUP_COMMIT_WINDOW, max_batch_size=MAX_BATCH_SIZE,
+                 on_commit=None):
+        self._commit = commit
+        self._on_commit = on_commit
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._cond = threading.Condition()
+        self._queue = []
+        self._thread = None
+        self.commits = 0
+        self.committed_messages = 0
+
+    def submit(self, message):
+        # Blocks until the message is on disk; a failed commit is raised to every caller
+        # in the batch instead of being dropped
+        pending = self.enqueue(message)
+        pending.done.wait()
+        if pending.error is not None:
+            raise WriteFailed(f"Message could not be saved: {pending.error}") from pending.error
+
+    def enqueue(self, message, callback=None):
+        # Non-blocking form of submit: callback(error) runs on the writer thread once the
+        # batch holding the message was committed (error is None) or failed
+        pending = _PendingWrite(message, callback)
+        with self._cond:
+            self._queue.append(pending)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="chat-group-commit",
+                                                daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return pending
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+            if self.window:
+                time.sleep(self.window)
+            with self._cond:
+                batch = self._queue[:self.max_batch_size]
+                del self._queue[:len(batch)]
+            error = None
+            try:
+                self._commit([p.message for p in batch])
+            except Exception as e:
+                error = e
+            else:
+                self.commits += 1
+                self.committed_messages += len(batch)
+            # Senders are released first: nothing after the commit may hold them up, and
+            # nothing that fails after it may kill this thread and leave them waiting
+            for pending in batch:
+                pending.error = error
+                pending.done.set()
+                if pending.callback is not None:
+                    try:
+                        pending.callback(error)
+                    except Exception:
+                        pass
+            if error is None and self._on_commit is not None:
+                try:
+                    self._on_commit()
+                except Exception:
+                    pass
+
+    def stats(self):
+        return {
+            "commits": self.commits,
+            "messages": self.committed_messages,
+            "avg_batch": self.committed_messages / self.commits if self.commits else 0.0,
+        }
+
+
+def _commit(room, messages):
+    rooms.get_room_store(room).append_messages(messages)
+
+
+def _after_commit(room):
+    live_updates.notifier_for(room).notify()
+    retention.engine.request(room)
+    # Keeps the search index current; a failure here is retried by the next search
+    try:
+        rooms.get_room_store(room).update_search_index()
+    except stores.StoreError:
+        pass
+
+
+class BrokerWriter:
+    # Stands in for the room's GroupCommitWriter when CHAT_BROKER is set: the broker batches,
+    # sequences and commits, and its commit event notifies every app process, this one too
+    def __init__(self, client, room):
+        self.client = client
+        self.room = room
+        self.commits = 0
+        self.committed_messages = 0
+
+    def submit(self, message):
+        try:
+            self.client.append(self.room, [message])
+        except broker_client.BrokerError as e:
+            raise WriteFailed(f"Message could not be saved: {e}") from e
+        self.commits += 1
+        self.committed_messages += 1
+
+    def stats(self):
+        return {
+            "commits": self.commits,
+            "messages": self.committed_messages,
+            "avg_batch": 1.0 if self.commits else 0.0,
+        }
+
+
+# One writer thread per room, so rooms commit to their own shards in parallel
+_chat_writers = {}
+_chat_writer_lock = threading.Lock()
+
+
+def get_chat_writer(room=rooms.DEFAULT_ROOM):
+    writer = _chat_writers.get(room)
+    if writer is None:
+        with _chat_writer_lock:
+            writer = _chat_writers.get(room)
+            if writer is None:
+                if live_updates.broker is not None:
+                    writer = BrokerWriter(live_updates.broker, room)
+                else:
+                    writer = GroupCommitWriter(partial(_commit, room),
+                                               on_commit=partial(_after_commit, room))
+                _chat_writers[room] = writer
+    return writer
@@ -0,0 +1,167 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# How hard a write tries to reach the disk before the commit returns:
+#   "commit":   every commit is fsynced first; nothing acknowledged is lost to a power cut
+#   "interval": files are fsynced in the background every DURABILITY_INTERVAL_MS, so a
+#               power cut loses at most that much
+#   "never":    the OS writes back in its own time
+# Rewritten files go through atomic_write (temp file, then rename), so a crashed process
+# leaves the old or the new contents, never a truncated file. Under "commit" and "interval"
+# the temp file is fsynced before the rename, which makes that hold for a power cut too;
+# under "never" a power cut can leave a rewritten file empty or truncated.
+# Presence files (presence.py) are the exception: one per process, rewritten every few
+# seconds and stale within a minute anyway, so they are never synced.
+DURABILITY_MODES = ("commit", "interval", "never")
+DURABILITY_MODE = os.environ.get("CHAT_DURABILITY", "interval")
+DURABILITY_INTERVAL_MS = float(os.environ.get("CHAT_DURABILITY_INTERVAL_MS", "100"))
+
+# PRAGMA synchronous for SQLite databases under each mode
+SQLITE_SYNCHRONOUS = {"commit": "FULL", "interval": "NORMAL", "never": "OFF"}
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_directory(directory):
+    # Makes a rename durable; directories cannot be opened for this on Windows
+    if os.name != "nt":
+        _fsync_path(directory or ".")
+
+
+class SyncPolicy:
+    # One per process. Writers call written() after writing a file they keep (appends) and
+    # use atomic_write() for files they rewrite. Under "commit" a failed fsync raises from
+    # the commit itself; one that fails in the background is counted and kept in last_error
+    # for the admin panel, since the commits it covers have already returned.
+    def __init__(self, mode=DURABILITY_MODE, interval_ms=DURABILITY_INTERVAL_MS):
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self.last_error = None
+        self._thread = None
+        self.syncs = 0
+        self.sync_seconds = 0.0
+        self.errors = 0
+        self.configure(mode, interval_ms)
+
+    def configure(self, mode, interval_ms=None):
+        if mode not in DURABILITY_MODES:
+            raise ValueError(f"Durability mode must be one of {', '.join(DURABILITY_MODES)}, "
+                             f"not {mode!r}")
+        if mode != "interval":
+            self.flush()
+        self.mode = mode
+        if interval_ms is not None:
+            self.interval = interval_ms / 1000
+
+    def _sync(self, sync, target):
+        started = time.perf_counter()
+        sync(target)
+        with self._lock:
+            self.syncs += 1
+            self.sync_seconds += time.perf_counter() - started
+
+    def mark(self, path):
+        # `path` was written through some other handle (e.g. a SQLite WAL file)
+        if self.mode == "interval":
+            with self._lock:
+                self._dirty.add(path)
+            self._start()
+
+    def written(self, f):
+        # Call after writing to the open file `f`, before closing it
+        if self.mode == "commit":
+            f.flush()
+            self._sync(os.fsync, f.fileno())
+        elif self.mode == "interval":
+            self.mark(f.name)
+
+    def replacing(self, f):
+        # Call on a temp file once written, before renaming it over the file it replaces
+        if self.mode != "never":
+            f.flush()
+            self._sync(os.fsync, f.fileno())
+
+    def replaced(self, path):
+        # Call after renaming a file to `path`: the rename itself is durable once its
+        # directory is synced
+        directory = os.path.dirname(path)
+        if self.mode == "commit":
+            self._sync(_fsync_directory, directory)
+        elif self.mode == "interval":
+            with self._lock:
+                self._dirty.add((directory,))
+            self._start()
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._loop, name="chat-fsync",
+                                                    daemon=True)
+                    self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        # Syncs everything written so far; returns how many files that took
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for target in dirty:
+            try:
+                if isinstance(target, tuple):
+                    self._sync(_fsync_directory, target[0])
+                else:
+                    self._sync(_fsync_path, target)
+            except FileNotFoundError:
+                continue  # Replaced or removed since; the replacement is queued itself
+            except OSError as e:
+                with self._lock:
+                    self.errors += 1
+                    self.last_error = f"{target}: {e}"
+        return len(dirty)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "interval_ms": round(self.interval * 1000, 3),
+                "syncs": self.syncs,
+                "sync_seconds": self.sync_seconds,
+                "pending": len(self._dirty),
+                "errors": self.errors,
+                "last_error": self.last_error,
+            }
+
+
+@contextmanager
+def atomic_write(path, mode="w", encoding=None):
+    # Writes `path` through a temp file renamed over it once complete; on an error the
+    # original stays and the temp file is removed
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, mode, encoding=encoding) as f:
+            yield f
+            policy.replacing(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    policy.replaced(path)
+
+
+# One policy per process, for every store
+policy = SyncPolicy()
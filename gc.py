@@ -1,82 +1,101 @@
 import streamlit as st
-import json
-import os
 from datetime import datetime
 from uuid import uuid4
-import time
-
-# Page configuration
-st.set_page_config(
-    page_title="Global Chat",
-    page_icon="🌐",
-    layout="wide",
-    initial_sidebar_state="expanded"
+from collections import deque
+
+import chat_core
+import chat_writer
+import live_updates
+import message_render
+import rate_limit
+import stores
+from chat_core import (
+    clear_global_chat, count_global_chat, load_deleted_since, save_global_chat_message,
 )
 
+# Messages each session keeps in its rolling display window
+CHAT_WINDOW_SIZE = 50
 
-def format_message_time():
-    return datetime.now().strftime("%H:%M:%S")
 
+def load_global_chat_since(cursor):
+    return chat_core.load_global_chat_since(cursor, CHAT_WINDOW_SIZE)
 
-def save_global_chat_message(message):
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
 
-        global_chat_file = "database/global_chat.json"
-
-        if os.path.exists(global_chat_file):
-            with open(global_chat_file, "r") as f:
-                global_chat = json.load(f)
-        else:
-            global_chat = {"messages": []}
-
-        global_chat["messages"].append(message)
-
-        # Keep only last 1000 messages
-        if len(global_chat["messages"]) > 1000:
-            global_chat["messages"] = global_chat["messages"][-1000:]
-
-        with open(global_chat_file, "w") as f:
-            json.dump(global_chat, f, indent=2)
-    except Exception:
-        pass
-
-
-def load_global_chat():
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-
-        global_chat_file = "database/global_chat.json"
-
-        if os.path.exists(global_chat_file):
-            with open(global_chat_file, "r") as f:
-                global_chat = json.load(f)
-            return global_chat.get("messages", [])
-        return []
-    except Exception:
-        return []
-
-
-def clear_global_chat():
-    try:
-        global_chat_file = "database/global_chat.json"
-        if os.path.exists(global_chat_file):
-            with open(global_chat_file, "w") as f:
-                json.dump({"messages": []}, f, indent=2)
-    except Exception:
-        pass
+def sync_chat_window():
+    # Keeps the last CHAT_WINDOW_SIZE messages in session state, pulling only what is new;
+    # messages deleted by an admin since the last sync are dropped from it
+    deleted, st.session_state.tombstone_position, purged = \
+        load_deleted_since(st.session_state.tombstone_position)
+    if purged:
+        st.session_state.chat_cursor = None
+    elif deleted:
+        deleted = set(deleted)
+        st.session_state.chat_window = deque(
+            (m for m in st.session_state.chat_window if m.get("message_id") not in deleted),
+            maxlen=CHAT_WINDOW_SIZE)
+    new_messages, cursor, reset = load_global_chat_since(st.session_state.chat_cursor)
+    if reset:
+        st.session_state.chat_window = deque(maxlen=CHAT_WINDOW_SIZE)
+    st.session_state.chat_window.extend(new_messages)
+    st.session_state.chat_cursor = cursor
+    return st.session_state.chat_window
 
 
 def initialize_session():
     if "current_user" not in st.session_state:
         st.session_state.current_user = f"User_{str(uuid4())[:8]}"
-    if "last_global_check" not in st.session_state:
-        st.session_state.last_global_check = time.time()
+    if "chat_cursor" not in st.session_state:
+        st.session_state.chat_cursor = None
+        st.session_state.tombstone_position = None
+        st.session_state.chat_window = deque(maxlen=CHAT_WINDOW_SIZE)
+        st.session_state.chat_version = None
+
+
+def chat_messages(current_user, auto_refresh):
+    # Runs as a fragment. Ticks where nothing was committed only compare a counter and
+    # redraw the session's window; the store is read only after a change notification.
+    version = live_updates.notifier.version
+    if version != st.session_state.chat_version:
+        st.session_state.chat_version = version
+        sync_chat_window()
+        st.session_state.chat_total = count_global_chat()
+        st.session_state.chat_updated_at = datetime.now().strftime("%H:%M:%S")
+        st.session_state.chat_html = message_render.render_transcript(
+            st.session_state.chat_window, current_user, time_prefix="🕐 "
+        )
+    chat_window = st.session_state.chat_window
+
+    if chat_window:
+        st.subheader("💬 Global Conversation")
+
+        # Status info
+        col1_status, col2_status = st.columns([2, 1])
+        with col1_status:
+            refresh_status = "ON" if auto_refresh else "OFF"
+            st.info(f"📊 {st.session_state.chat_total} messages • 🔄 Live updates: {refresh_status}")
+        with col2_status:
+            st.caption(f"Last update: {st.session_state.chat_updated_at}")
+
+        # Message display: the last 50 messages as one pre-rendered block
+        st.markdown(st.session_state.chat_html, unsafe_allow_html=True)
+        st.markdown("<div style='height: 20px;'></div>", unsafe_allow_html=True)
+    else:
+        st.info("🌟 Be the first to start the global conversation!")
+        st.markdown("**Welcome to Global Chat!**")
+        st.markdown("- Chat with all users in real-time")
+        st.markdown("- Your messages appear on the right")
+        st.markdown("- Others' messages appear on the left")
+        st.markdown("- New messages appear automatically")
 
 
 def main():
+    # Page configuration
+    st.set_page_config(
+        page_title="Global Chat",
+        page_icon="🌐",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
     initialize_session()
 
     # Custom CSS for chat styling
@@ -155,10 +174,14 @@ def main():
         st.title("🌐 Global Chat")
         st.caption("Chat with all users in real-time • Your messages on right, others on left")
     with col2:
-        if st.button("Clear Chat", use_container_width=True):
-            clear_global_chat()
-            st.success("Global chat cleared!")
-            st.rerun()
+        if st.button("Clear Chat", width="stretch"):
+            try:
+                clear_global_chat()
+            except stores.StoreError as e:
+                st.error(f"Could not clear chat: {e}")
+            else:
+                st.success("Global chat cleared!")
+                st.rerun()
 
     st.markdown("---")
 
@@ -170,102 +193,41 @@ def main():
         current_user = st.text_input("Your Username", value=st.session_state.current_user)
         if current_user != st.session_state.current_user:
             st.session_state.current_user = current_user
+            st.session_state.chat_version = None
             st.rerun()
 
         st.markdown("---")
 
         # Chat statistics
-        global_messages = load_global_chat()
-        st.metric("Total Messages", len(global_messages))
+        total_messages = count_global_chat()
+        st.metric("Total Messages", total_messages)
 
         # Auto-refresh control
-        auto_refresh = st.checkbox("Auto-refresh (3s)", value=True)
+        auto_refresh = st.checkbox("Live updates", value=True)
 
         if st.button("Refresh Now"):
+            st.session_state.chat_version = None
             st.rerun()
 
-    # Auto-refresh logic
-    current_time = time.time()
-    time_since_last_check = current_time - st.session_state.last_global_check
-
-    if auto_refresh and time_since_last_check >= 3:
-        st.session_state.last_global_check = current_time
-        st.rerun()
-
-    # Load and display messages
-    global_messages = load_global_chat()
+    # Live updates: only the message area reruns, and only reads the store after a commit
+    live_updates.watch_store(stores.get_store())
     current_user = st.session_state.current_user
+    run_every = live_updates.LIVE_CHECK_INTERVAL if auto_refresh else None
 
-    if global_messages:
-        st.subheader("💬 Global Conversation")
-
-        # Status info
-        col1_status, col2_status = st.columns([2, 1])
-        with col1_status:
-            refresh_status = "ON" if auto_refresh else "OFF"
-            st.info(f"📊 {len(global_messages)} messages • 🔄 Auto-refresh: {refresh_status}")
-        with col2_status:
-            current_time_str = datetime.now().strftime("%H:%M:%S")
-            st.caption(f"Last update: {current_time_str}")
-
-        # Message display
-        st.markdown('<div class="chat-container">', unsafe_allow_html=True)
-
-        # Show last 50 messages
-        for message in global_messages[-50:]:
-            content = message.get("content", "")
-            timestamp = message.get("timestamp", "")
-            message_user = message.get("user_id", "")
-
-            is_current_user = (message_user == current_user)
-
-            if is_current_user:
-                st.markdown(f"""
-                <div class="message-row-right">
-                    <div class="message-content">
-                        <div>{content}</div>
-                        <div class="message-time">🕐 {timestamp}</div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-            else:
-                st.markdown(f"""
-                <div class="message-row-left">
-                    <div class="message-content">
-                        <div><strong>{message_user}:</strong> {content}</div>
-                        <div class="message-time">🕐 {timestamp}</div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-
-        st.markdown('</div>', unsafe_allow_html=True)
-        st.markdown("<div style='height: 20px;'></div>", unsafe_allow_html=True)
-    else:
-        st.info("🌟 Be the first to start the global conversation!")
-        st.markdown("**Welcome to Global Chat!**")
-        st.markdown("- Chat with all users in real-time")
-        st.markdown("- Your messages appear on the right")
-        st.markdown("- Others' messages appear on the left")
-        st.markdown("- Messages refresh automatically every 3 seconds")
+    st.fragment(chat_messages, run_every=run_every)(current_user, auto_refresh)
 
     # Chat input
     if global_prompt := st.chat_input("Type your message to the global chat..."):
-        user_message = {
-            "role": "user",
-            "content": global_prompt,
-            "timestamp": format_message_time(),
-            "message_id": str(uuid4()),
-            "user_id": current_user
-        }
-
-        save_global_chat_message(user_message)
-        st.session_state.last_global_check = time.time()
-        st.rerun()
-
-    # Auto-refresh at the end
-    if auto_refresh:
-        time.sleep(3)
-        st.rerun()
+        user_message = chat_core.new_message(current_user, global_prompt)
+
+        try:
+            save_global_chat_message(user_message)
+        except rate_limit.RateLimited as e:
+            st.warning(f"Message not sent. {e}")
+        except chat_writer.WriteFailed as e:
+            st.error(str(e))
+        else:
+            st.rerun()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,133 @@
+import os
+import threading
+
+import broker_client
+import rooms
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # watchdog ships with Streamlit, but polling works without it
+    FileSystemEventHandler = object
+    Observer = None
+
+# How often a session's message fragment checks the change counter
+LIVE_CHECK_INTERVAL = float(os.environ.get("CHAT_LIVE_CHECK_INTERVAL", "1.0"))
+
+# Fallback poll of the store version when watchdog is not installed
+WATCH_POLL_INTERVAL = 0.5
+
+CHANGE_EVENTS = ("created", "modified", "deleted", "moved")
+
+
+class ChangeNotifier:
+    # Process-wide counter bumped after every committed change. Sessions compare it with the
+    # value they last rendered, which is O(1) and touches no files.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def notify(self):
+        with self._lock:
+            self.version += 1
+
+
+class _StoreEventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        # Reads and lock-file churn never change the store version
+        if event.event_type in CHANGE_EVENTS and not event.src_path.endswith(".lock"):
+            self.watcher.check()
+
+
+class StoreWatcher:
+    # Turns commits made by other server processes into notifications
+    def __init__(self, store, notifier, poll_interval=WATCH_POLL_INTERVAL):
+        self.store = store
+        self.notifier = notifier
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._last_version = store.change_version()
+        self._observer = None
+
+    def start(self):
+        if Observer is not None:
+            self._observer = Observer()
+            self._observer.schedule(_StoreEventHandler(self), self.store.directory, recursive=True)
+            self._observer.daemon = True
+            self._observer.start()
+        else:
+            threading.Thread(target=self._poll, name="chat-store-watcher", daemon=True).start()
+
+    def _poll(self):
+        stop = threading.Event()
+        while not stop.wait(self.poll_interval):
+            self.check()
+
+    def check(self):
+        try:
+            version = self.store.change_version()
+        except Exception:
+            return
+        with self._lock:
+            if version == self._last_version:
+                return
+            self._last_version = version
+        self.notifier.notify()
+
+
+# The default room's notifier; every other room gets its own from notifier_for
+notifier = ChangeNotifier()
+
+_notifiers = {rooms.DEFAULT_ROOM: notifier}
+_notifiers_lock = threading.Lock()
+_watchers = {}
+_watcher_lock = threading.Lock()
+
+
+def notifier_for(room=rooms.DEFAULT_ROOM):
+    # Sessions only re-read the store after commits to the room they are in
+    found = _notifiers.get(room)
+    if found is None:
+        with _notifiers_lock:
+            found = _notifiers.setdefault(room, ChangeNotifier())
+    return found
+
+
+def _broker_commit(room):
+    # A commit event from the broker; None after a reconnect, when events may have been lost.
+    # Going through the room's watcher keeps the file event that follows from notifying twice.
+    if room is None:
+        for room in list(_notifiers):
+            notifier_for(room).notify()
+        return
+    watcher = _watchers.get(room)
+    if watcher is not None:
+        watcher.check()
+    else:
+        notifier_for(room).notify()
+
+
+# Connection to the local broker (see broker.py) when CHAT_BROKER is set. Its commit events
+# wake sessions right away; the store watchers stay for changes made outside the broker,
+# such as deletions by an admin.
+broker = broker_client.BrokerClient(broker_client.BROKER_ADDRESS, on_commit=_broker_commit) \
+    if broker_client.BROKER_ADDRESS else None
+_broker_started = False
+
+
+def watch_store(store, room=rooms.DEFAULT_ROOM):
+    global _broker_started
+    watcher = _watchers.get(room)
+    if watcher is None:
+        with _watcher_lock:
+            watcher = _watchers.get(room)
+            if watcher is None:
+                watcher = _watchers[room] = StoreWatcher(store, notifier_for(room))
+                watcher.start()
+            if broker is not None and not _broker_started:
+                _broker_started = True
+                broker.start()
+    return watcher
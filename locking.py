@@ -0,0 +1,66 @@
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+_states = {}
+_states_lock = threading.Lock()
+
+
+class _LockState:
+    def __init__(self):
+        self.rlock = threading.RLock()
+        self.depth = 0
+        self.fd = None
+
+
+def _state_for(lock_path):
+    key = os.path.abspath(lock_path)
+    with _states_lock:
+        state = _states.get(key)
+        if state is None:
+            state = _states[key] = _LockState()
+        return state
+
+
+class FileLock:
+    # Exclusive across threads (RLock) and processes (flock on "<path>.lock"). Re-entrant
+    # within a thread, so update helpers can call the plain load/save functions inside it.
+    def __init__(self, path):
+        self.lock_path = path + ".lock"
+        self._state = _state_for(self.lock_path)
+
+    def acquire(self):
+        state = self._state
+        state.rlock.acquire()
+        if state.depth == 0 and fcntl is not None:
+            try:
+                directory = os.path.dirname(self.lock_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except BaseException:
+                state.rlock.release()
+                raise
+            state.fd = fd
+        state.depth += 1
+
+    def release(self):
+        state = self._state
+        state.depth -= 1
+        if state.depth == 0 and state.fd is not None:
+            fcntl.flock(state.fd, fcntl.LOCK_UN)
+            os.close(state.fd)
+            state.fd = None
+        state.rlock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
@@ -0,0 +1,76 @@
+import threading
+from collections import OrderedDict
+from html import escape
+
+# Rendered messages kept per process, shared by every session
+RENDER_CACHE_SIZE = 4096
+
+
+class RenderCache:
+    def __init__(self, maxsize=RENDER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        with self._lock:
+            html = self._items.get(key)
+            if html is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+        html = render()
+        with self._lock:
+            self._items[key] = html
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return html
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
+
+
+render_cache = RenderCache()
+
+
+def _escape_text(text):
+    # Blank lines would end the HTML block in Markdown, so keep message text on one line
+    return escape(str(text)).replace("\r\n", "\n").replace("\n", "<br>")
+
+
+def _render_message(message, own, time_prefix):
+    content = _escape_text(message.get("content", ""))
+    timestamp = escape(str(message.get("timestamp", "")))
+    if own:
+        return (
+            '<div class="message-row-right"><div class="message-content">'
+            f'<div>{content}</div>'
+            f'<div class="message-time">{time_prefix}{timestamp}</div>'
+            '</div></div>'
+        )
+    message_user = escape(str(message.get("user_id", "")))
+    return (
+        '<div class="message-row-left"><div class="message-content">'
+        f'<div><strong>{message_user}:</strong> {content}</div>'
+        f'<div class="message-time">{time_prefix}{timestamp}</div>'
+        '</div></div>'
+    )
+
+
+def render_message(message, own, time_prefix=""):
+    message_id = message.get("message_id")
+    if message_id is None:
+        return _render_message(message, own, time_prefix)
+    return render_cache.get((message_id, own, time_prefix),
+                            lambda: _render_message(message, own, time_prefix))
+
+
+def render_transcript(messages, current_user, time_prefix=""):
+    # The whole visible window as one HTML block, so a rerun sends one element
+    parts = [render_message(m, m.get("user_id", "") == current_user, time_prefix)
+             for m in messages]
+    return '<div class="chat-container">' + "".join(parts) + "</div>"
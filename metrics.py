@@ -0,0 +1,238 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+import durability
+
+# Histogram bucket upper bounds in seconds: 50 µs doubling up to ~13 s, then +Inf
+BUCKET_BOUNDS = tuple(0.00005 * 2 ** i for i in range(19))
+
+# Rolling window shown in the admin panel, kept as fixed slots that are reset when reused
+WINDOW_SECONDS = 300
+SLOT_SECONDS = 10
+
+# Periodic export: CHAT_METRICS_EXPORT is "json", "prometheus" or both, comma separated
+METRICS_EXPORT = os.environ.get("CHAT_METRICS_EXPORT", "")
+METRICS_EXPORT_INTERVAL = float(os.environ.get("CHAT_METRICS_EXPORT_INTERVAL", "15"))
+
+# Streamlit names the thread that runs each session's script this way
+SCRIPT_THREAD_PREFIX = "ScriptRunner.scriptThread"
+
+# Order phases are listed in; anything else recorded follows alphabetically
+PHASES = ("script", "fragment", "load_users", "load_global_chat", "load_admin_settings",
+          "sync_chat", "render", "sleep")
+
+
+class Histogram:
+    # Counts per bucket over a rolling window, plus lifetime counts for the Prometheus export
+    def __init__(self, window=WINDOW_SECONDS, slot=SLOT_SECONDS):
+        self.slot = slot
+        self._slots = [[None, [0] * (len(BUCKET_BOUNDS) + 1), 0.0] for _ in range(window // slot)]
+        self.total_buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.total_sum = 0.0
+        self.total_count = 0
+
+    def add(self, seconds, now):
+        tick = int(now // self.slot)
+        entry = self._slots[tick % len(self._slots)]
+        if entry[0] != tick:
+            entry[0] = tick
+            entry[1] = [0] * (len(BUCKET_BOUNDS) + 1)
+            entry[2] = 0.0
+        bucket = bisect_left(BUCKET_BOUNDS, seconds)
+        entry[1][bucket] += 1
+        entry[2] += seconds
+        self.total_buckets[bucket] += 1
+        self.total_sum += seconds
+        self.total_count += 1
+
+    def window(self, now):
+        # (bucket counts, sum) over the slots still inside the window
+        oldest = int(now // self.slot) - len(self._slots) + 1
+        buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        total = 0.0
+        for tick, counts, seconds in self._slots:
+            if tick is not None and tick >= oldest:
+                buckets = [a + b for a, b in zip(buckets, counts)]
+                total += seconds
+        return buckets, total
+
+
+def bucket_percentile(buckets, fraction):
+    # Upper bound of the bucket holding the percentile; the last bucket reports its lower bound
+    count = sum(buckets)
+    if not count:
+        return 0.0
+    rank = fraction * count
+    seen = 0
+    for index, n in enumerate(buckets):
+        seen += n
+        if seen >= rank:
+            return BUCKET_BOUNDS[min(index, len(BUCKET_BOUNDS) - 1)]
+    return BUCKET_BOUNDS[-1]
+
+
+class _Timer:
+    __slots__ = ("registry", "name", "started")
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        # Recorded even when the phase ends in st.rerun() or st.stop()
+        self.registry.record(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class MetricsRegistry:
+    # Process-wide phase timings shared by every session. Recording costs two perf_counter
+    # calls and a bisect under one lock; percentiles are only worked out when someone looks.
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started_at = clock()
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._reruns = Histogram()
+
+    def phase(self, name):
+        return _Timer(self, name)
+
+    def record(self, name, seconds):
+        now = self.clock()
+        with self._lock:
+            histogram = self._phases.get(name)
+            if histogram is None:
+                histogram = self._phases[name] = Histogram()
+            histogram.add(seconds, now)
+
+    def percentile(self, name, fraction):
+        # One phase's percentile over the window, in seconds; 0.0 before anything was recorded
+        now = self.clock()
+        with self._lock:
+            histogram = self._phases.get(name)
+            if histogram is None:
+                return 0.0
+            buckets, _ = histogram.window(now)
+        return bucket_percentile(buckets, fraction)
+
+    def count_rerun(self):
+        with self._lock:
+            self._reruns.add(0.0, self.clock())
+
+    def reruns_per_second(self):
+        now = self.clock()
+        with self._lock:
+            buckets, _ = self._reruns.window(now)
+        span = min(WINDOW_SECONDS, max(now - self.started_at, SLOT_SECONDS))
+        return sum(buckets) / span
+
+    def snapshot(self):
+        # {"phases": {name: summary}, ...} over the rolling window
+        now = self.clock()
+        with self._lock:
+            windows = {name: h.window(now) for name, h in self._phases.items()}
+        order = {name: index for index, name in enumerate(PHASES)}
+        phases = {}
+        for name in sorted(windows, key=lambda n: (order.get(n, len(order)), n)):
+            buckets, total = windows[name]
+            count = sum(buckets)
+            phases[name] = {
+                "count": count,
+                "mean_ms": total / count * 1000 if count else 0.0,
+                "p50_ms": bucket_percentile(buckets, 0.50) * 1000,
+                "p95_ms": bucket_percentile(buckets, 0.95) * 1000,
+                "p99_ms": bucket_percentile(buckets, 0.99) * 1000,
+                "buckets": buckets,
+            }
+        return {
+            "window_seconds": WINDOW_SECONDS,
+            "bucket_bounds_ms": [bound * 1000 for bound in BUCKET_BOUNDS],
+            "reruns_per_second": self.reruns_per_second(),
+            "active_script_threads": active_script_threads(),
+            "phases": phases,
+        }
+
+    def prometheus_text(self):
+        # Lifetime histograms in the Prometheus text exposition format
+        with self._lock:
+            totals = {name: (list(h.total_buckets), h.total_sum, h.total_count)
+                      for name, h in self._phases.items()}
+            reruns = self._reruns.total_count
+        lines = ["# HELP chat_phase_seconds Time spent per rerun phase.",
+                 "# TYPE chat_phase_seconds histogram"]
+        for name, (buckets, total, count) in sorted(totals.items()):
+            cumulative = 0
+            for bound, n in zip(BUCKET_BOUNDS + (float("inf"),), buckets):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'chat_phase_seconds_bucket{{phase="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'chat_phase_seconds_sum{{phase="{name}"}} {total}')
+            lines.append(f'chat_phase_seconds_count{{phase="{name}"}} {count}')
+        lines += ["# HELP chat_reruns_total Script and fragment runs.",
+                  "# TYPE chat_reruns_total counter",
+                  f"chat_reruns_total {reruns}",
+                  "# HELP chat_active_script_threads Streamlit script threads alive.",
+                  "# TYPE chat_active_script_threads gauge",
+                  f"chat_active_script_threads {active_script_threads()}"]
+        return "\n".join(lines) + "\n"
+
+
+def active_script_threads():
+    return sum(1 for t in threading.enumerate() if t.name.startswith(SCRIPT_THREAD_PREFIX))
+
+
+class MetricsExporter:
+    # Rewrites metrics-<pid>.json and/or metrics-<pid>.prom every `interval` seconds
+    def __init__(self, registry, directory, formats, interval=METRICS_EXPORT_INTERVAL):
+        self.registry = registry
+        self.directory = directory
+        self.formats = formats
+        self.interval = interval
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="chat-metrics-export", daemon=True)
+        self._thread.start()
+
+    def export(self):
+        base = os.path.join(self.directory, f"metrics-{os.getpid()}")
+        if "json" in self.formats:
+            with durability.atomic_write(base + ".json") as f:
+                f.write(json.dumps(self.registry.snapshot()))
+        if "prometheus" in self.formats:
+            with durability.atomic_write(base + ".prom") as f:
+                f.write(self.registry.prometheus_text())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.export()
+            except OSError:
+                pass  # Tried again on the next tick
+
+
+registry = MetricsRegistry()
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def start_export(directory):
+    # Starts the periodic file export once per process when CHAT_METRICS_EXPORT is set
+    global _exporter
+    formats = {f.strip().lower() for f in METRICS_EXPORT.split(",") if f.strip()}
+    if not formats or _exporter is not None:
+        return _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = MetricsExporter(registry, os.path.join(directory, "metrics"), formats)
+            _exporter.start()
+    return _exporter
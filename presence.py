@@ -0,0 +1,213 @@
+import heapq
+import json
+import os
+import socket
+import threading
+import time
+
+# A session counts as online for this long after its last heartbeat. Sessions heartbeat from
+# the chat fragment, so the slowest refresh interval is capped at a third of this
+# (refresh_scheduler.MAX_INTERVAL).
+PRESENCE_TTL = float(os.environ.get("CHAT_PRESENCE_TTL", "30"))
+
+# Share presence between server processes through small files in database/presence/
+PRESENCE_MIRROR = os.environ.get("CHAT_PRESENCE_MIRROR", "").lower() in ("1", "true", "yes")
+MIRROR_INTERVAL = 5.0
+
+
+class PresenceTracker:
+    # Sessions -> (username, expiry) plus a heap with one entry per session. A heartbeat only
+    # moves the expiry; when an entry reaches the top of the heap it is either dropped or
+    # pushed back with the newer expiry, so nothing is ever scanned. The sorted user list is
+    # rebuilt only when someone comes online or goes offline.
+    def __init__(self, ttl=PRESENCE_TTL, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._sessions = {}  # session id -> [username, expires]
+        self._heap = []  # (expires, session id)
+        self._online = {}  # username -> live sessions
+        self.version = 0
+        self._users = ()
+        self._users_version = 0
+        self.mirror = None
+
+    def _add_user(self, username):
+        count = self._online.get(username, 0)
+        self._online[username] = count + 1
+        if count == 0:
+            self.version += 1
+
+    def _remove_user(self, username):
+        count = self._online[username] - 1
+        if count:
+            self._online[username] = count
+        else:
+            del self._online[username]
+            self.version += 1
+
+    def _expire(self, now):
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, session_id = heapq.heappop(heap)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                continue
+            if entry[1] > now:
+                heapq.heappush(heap, (entry[1], session_id))
+                continue
+            del self._sessions[session_id]
+            self._remove_user(entry[0])
+
+    def heartbeat(self, session_id, username):
+        with self._lock:
+            now = self.clock()
+            expires = now + self.ttl
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                self._sessions[session_id] = [username, expires]
+                heapq.heappush(self._heap, (expires, session_id))
+                self._add_user(username)
+            else:
+                if entry[0] != username:
+                    self._remove_user(entry[0])
+                    self._add_user(username)
+                    entry[0] = username
+                entry[1] = expires
+            self._expire(now)
+        if self.mirror is not None:
+            self.mirror.publish()
+
+    def leave(self, session_id):
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is not None:
+                self._remove_user(entry[0])
+        if self.mirror is not None:
+            self.mirror.publish(force=True)
+
+    def local_users(self):
+        # {username: seconds left} for this process, used by the mirror
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            left = {}
+            for username, expires in self._sessions.values():
+                left[username] = max(left.get(username, 0), expires - now)
+            return left
+
+    def users(self):
+        # Sorted tuple of online usernames; rebuilt only after the membership changed. The
+        # mirror is read before taking the lock, so heartbeats never wait on its files.
+        remote_version, remote = (self.mirror.remote() if self.mirror is not None
+                                  else (0, frozenset()))
+        with self._lock:
+            self._expire(self.clock())
+            version = (self.version, remote_version)
+            if version != self._users_version:
+                self._users = tuple(sorted(remote.union(self._online)))
+                self._users_version = version
+            return self._users
+
+    def count(self):
+        return len(self.users())
+
+    def session_count(self):
+        # Live sessions in this process, counting every tab of the same user
+        with self._lock:
+            self._expire(self.clock())
+            return len(self._sessions)
+
+
+class PresenceMirror:
+    # Each process writes its online users with wall-clock expiries to its own file and reads
+    # the other processes' files at most every MIRROR_INTERVAL seconds
+    def __init__(self, tracker, directory, interval=MIRROR_INTERVAL):
+        self.tracker = tracker
+        self.directory = directory
+        self.interval = interval
+        self.path = os.path.join(directory, f"{socket.gethostname()}-{os.getpid()}.json")
+        self._lock = threading.Lock()
+        self._published_version = None
+        self._published_at = 0.0
+        self._read_at = 0.0
+        self._files = {}  # name -> (mtime_ns, {username: expires})
+        self._remote = frozenset()
+        self._remote_version = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def publish(self, force=False):
+        # Rewritten when membership changed, and often enough to keep expiries fresh
+        now = time.time()
+        with self._lock:
+            if (not force and self._published_version == self.tracker.version
+                    and now - self._published_at < self.tracker.ttl / 3):
+                return
+            self._published_version = self.tracker.version
+            self._published_at = now
+        users = {username: now + left for username, left in self.tracker.local_users().items()}
+        # Not through durability.atomic_write: the file is this process's own and worthless
+        # after a power cut, so it is never fsynced
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(users, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass  # Presence is best effort; the next heartbeat tries again
+
+    def remote(self):
+        # (version, frozenset of usernames online in other processes)
+        now = time.time()
+        with self._lock:
+            if now - self._read_at >= self.interval:
+                self._read_at = now
+                self._read(now)
+            return self._remote_version, self._remote
+
+    def _read(self, now):
+        own = os.path.basename(self.path)
+        files = {}
+        try:
+            names = [n for n in os.listdir(self.directory) if n.endswith(".json") and n != own]
+        except OSError:
+            names = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                cached = self._files.get(name)
+                if cached is not None and cached[0] == mtime:
+                    files[name] = cached
+                else:
+                    with open(path, "r") as f:
+                        files[name] = (mtime, json.load(f))
+            except (OSError, ValueError):
+                continue
+            users = files[name][1]
+            if not any(expires > now for expires in users.values()) and \
+                    now - mtime / 1e9 > self.tracker.ttl * 10:
+                # Left behind by a process that is gone
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self._files = files
+        remote = frozenset(username for _, users in files.values()
+                           for username, expires in users.items() if expires > now)
+        if remote != self._remote:
+            self._remote = remote
+            self._remote_version += 1
+
+
+tracker = PresenceTracker()
+_mirror_lock = threading.Lock()
+
+
+def get_tracker(directory):
+    # The process-wide tracker, with the file mirror attached when CHAT_PRESENCE_MIRROR is set
+    if PRESENCE_MIRROR and tracker.mirror is None:
+        with _mirror_lock:
+            if tracker.mirror is None:
+                tracker.mirror = PresenceMirror(tracker, os.path.join(directory, "presence"))
+    return tracker
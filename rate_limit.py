@@ -0,0 +1,110 @@
+import threading
+import time
+
+# Idle buckets are dropped once the table has doubled since the last sweep; a bucket that
+# has refilled is the same as no bucket, so nothing is lost
+SWEEP_MIN_BUCKETS = 1024
+
+
+class RateLimited(Exception):
+    def __init__(self, scope, retry_after):
+        self.scope = scope
+        self.retry_after = retry_after
+        if scope == "user":
+            reason = "You are sending messages too fast."
+        else:
+            reason = "The chat is very busy right now."
+        super().__init__(f"{reason} Try again in {max(1, round(retry_after))} s.")
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated_at = now
+
+    def refill(self, rate, burst, now):
+        self.tokens = min(burst, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+        return self.tokens
+
+
+class RateLimiter:
+    # One bucket per user plus one for the whole process. A check refills and takes from at
+    # most two buckets under one lock, so it is O(1) whatever the number of users.
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._swept_size = SWEEP_MIN_BUCKETS
+        self.user_rate = 0.0  # tokens per second; 0 means unlimited
+        self.user_burst = 1.0
+        self.global_rate = 0.0
+        self.global_burst = 1.0
+        self._global = TokenBucket(0.0, clock())
+        self.allowed = 0
+        self.throttled = {"user": 0, "global": 0}
+        self._throttled_users = {}
+
+    def configure(self, settings):
+        # Limits come from the admin settings, as messages per minute and burst size
+        user_rate = float(settings.get("rate_limit_user_per_minute", 0)) / 60
+        user_burst = max(1.0, float(settings.get("rate_limit_user_burst", 1)))
+        global_rate = float(settings.get("rate_limit_global_per_minute", 0)) / 60
+        global_burst = max(1.0, float(settings.get("rate_limit_global_burst", 1)))
+        with self._lock:
+            if global_rate != self.global_rate or global_burst != self.global_burst:
+                self._global = TokenBucket(global_burst, self.clock())
+            self.user_rate, self.user_burst = user_rate, user_burst
+            self.global_rate, self.global_burst = global_rate, global_burst
+
+    def acquire(self, username):
+        # Takes one token from the user's bucket and the global one, or raises RateLimited
+        # without taking either
+        with self._lock:
+            now = self.clock()
+            bucket = None
+            if self.user_rate:
+                bucket = self._buckets.get(username)
+                if bucket is None:
+                    bucket = self._buckets[username] = TokenBucket(self.user_burst, now)
+                    if len(self._buckets) >= 2 * self._swept_size:
+                        self._sweep(now)
+                if bucket.refill(self.user_rate, self.user_burst, now) < 1:
+                    self._throttle("user", username)
+                    raise RateLimited("user", (1 - bucket.tokens) / self.user_rate)
+            if self.global_rate:
+                if self._global.refill(self.global_rate, self.global_burst, now) < 1:
+                    self._throttle("global", username)
+                    raise RateLimited("global", (1 - self._global.tokens) / self.global_rate)
+                self._global.tokens -= 1
+            if bucket is not None:
+                bucket.tokens -= 1
+            self.allowed += 1
+
+    def _throttle(self, scope, username):
+        self.throttled[scope] += 1
+        self._throttled_users[username] = self._throttled_users.get(username, 0) + 1
+
+    def _sweep(self, now):
+        full = [username for username, bucket in self._buckets.items()
+                if bucket.refill(self.user_rate, self.user_burst, now) >= self.user_burst]
+        for username in full:
+            del self._buckets[username]
+        self._swept_size = max(SWEEP_MIN_BUCKETS, len(self._buckets))
+
+    def stats(self, top=10):
+        with self._lock:
+            users = sorted(self._throttled_users.items(), key=lambda item: -item[1])[:top]
+            return {
+                "allowed": self.allowed,
+                "throttled_user": self.throttled["user"],
+                "throttled_global": self.throttled["global"],
+                "tracked_users": len(self._buckets),
+                "top_throttled": users,
+            }
+
+
+# One limiter per process, shared by every session
+limiter = RateLimiter()
@@ -0,0 +1,85 @@
+import math
+import threading
+import time
+
+import metrics
+import presence
+
+# Load signals are re-read at most this often, whatever the number of sessions
+LOAD_CHECK_INTERVAL = 5.0
+
+# Phase whose p95 stands for rerun latency
+LATENCY_PHASE = "fragment"
+
+# Sessions heartbeat from the chat fragment, so the slowest interval stays well inside the
+# presence TTL; otherwise idle sessions would drop offline between two refreshes
+MAX_INTERVAL = presence.PRESENCE_TTL / 3
+
+
+def refresh_bounds(settings):
+    # (fastest, slowest) interval in seconds from the admin settings, at most MAX_INTERVAL
+    low = min(float(settings.get("auto_refresh_min_interval", 1.0)), MAX_INTERVAL)
+    high = min(float(settings.get("auto_refresh_max_interval", 10.0)), MAX_INTERVAL)
+    return low, max(low, high)
+
+
+class LoadMonitor:
+    # Turns rerun latency and the live session count into one stretch factor (>= 1),
+    # recomputed at most every LOAD_CHECK_INTERVAL seconds and shared by every session
+    def __init__(self, registry, tracker, interval=LOAD_CHECK_INTERVAL, clock=time.monotonic):
+        self.registry = registry
+        self.tracker = tracker
+        self.interval = interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._checked_at = None
+        self._key = None
+        self._state = (1.0, 0.0, 0)
+
+    def state(self, latency_threshold_ms, session_threshold):
+        # (factor, p95 rerun latency in ms, live sessions)
+        now = self.clock()
+        key = (latency_threshold_ms, session_threshold)
+        with self._lock:
+            if (self._checked_at is not None and key == self._key
+                    and now - self._checked_at < self.interval):
+                return self._state
+            self._checked_at = now
+            self._key = key
+        latency_ms = self.registry.percentile(LATENCY_PHASE, 0.95) * 1000
+        sessions = self.tracker.session_count()
+        factor = 1.0
+        if latency_threshold_ms:
+            factor = max(factor, latency_ms / latency_threshold_ms)
+        if session_threshold:
+            factor = max(factor, sessions / session_threshold)
+        state = (factor, latency_ms, sessions)
+        with self._lock:
+            self._state = state
+        return state
+
+    def factor(self, latency_threshold_ms, session_threshold):
+        return self.state(latency_threshold_ms, session_threshold)[0]
+
+
+def next_level(level, active):
+    # Back to the fastest rate on activity, one doubling per idle tick otherwise
+    return 0 if active else level + 1
+
+
+def refresh_interval(level, low, high, load_factor=1.0):
+    # low * 2**level stretched by the load factor, rounded up to a power-of-two multiple of
+    # `low` so a session's interval only takes a handful of distinct values, and clamped to
+    # the admin bounds
+    stretched = low * 2 ** level * max(1.0, load_factor)
+    if stretched >= high:
+        return high
+    return min(high, low * 2 ** math.ceil(math.log2(stretched / low) - 1e-9))
+
+
+def max_level(low, high):
+    # Idle ticks past this level no longer change the interval
+    return max(0, math.ceil(math.log2(high / low))) if low > 0 else 0
+
+
+monitor = LoadMonitor(metrics.registry, presence.tracker)
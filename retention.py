@@ -0,0 +1,233 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_right
+
+import chat_archive
+import durability
+import rooms
+import stores
+from locking import FileLock
+
+# How often every room is checked against the age and size limits, in seconds
+RETENTION_INTERVAL = float(os.environ.get("CHAT_RETENTION_INTERVAL", "60"))
+
+# After a commit, a room is only compacted once it is this fraction over its cap, so a busy
+# room pays for one rewrite per tenth of its cap instead of one per commit
+COMPACT_SLACK = 0.1
+
+# Commits are collected for this long before the rooms they touched are looked at
+COMPACT_DELAY = 1.0
+
+# Next to each room's store: when each seq was reached, for the age limit. Messages only
+# carry a time of day, so this is what tells how old they are.
+SEQ_MARKS_FILE = "retention_marks.json"
+
+# Marks are taken at most once per this fraction of the age limit
+MARK_RESOLUTION = 0.01
+
+
+def retention_policy(settings):
+    return {
+        "max_age": float(settings.get("retention_max_age_days", 0)) * 86400,
+        "max_bytes": int(settings.get("retention_max_live_kb", 0)) * 1024,
+        "archive": bool(settings.get("retention_archive", True)),
+        "compress": bool(settings.get("archive_compression", False)),
+    }
+
+
+def message_bytes(message):
+    return len(chat_archive.encode_record(dict(message)).encode("utf-8"))
+
+
+def expiry_seq(messages, max_messages, max_bytes=0, age_seq=0):
+    # The highest seq to move out so that what stays is within every limit; 0 for none.
+    # `messages` are the live ones, oldest first.
+    drop = max(0, len(messages) - max_messages)
+    if age_seq:
+        drop = max(drop, bisect_right([m.get("seq", 0) for m in messages], age_seq))
+    if max_bytes:
+        total = 0
+        for index in range(len(messages) - 1, drop - 1, -1):
+            total += message_bytes(messages[index])
+            if total > max_bytes:
+                drop = index + 1
+                break
+    return messages[drop - 1].get("seq", 0) if drop else 0
+
+
+class SeqMarks:
+    # [time, last seq] pairs, oldest first: every message up to that seq existed by then.
+    # Re-read before every change, under a lock, since each server process adds marks of
+    # its own.
+    def __init__(self, path):
+        self.path = path
+        self._file_lock = FileLock(path)
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def _save(self, marks):
+        with durability.atomic_write(self.path) as f:
+            json.dump(marks, f, separators=(",", ":"))
+
+    def update(self, now, last_seq, max_age, min_spacing):
+        # Records last_seq and returns the highest seq that is older than max_age
+        with self._file_lock:
+            marks = self.load()
+            changed = False
+            if last_seq and (not marks or (now - marks[-1][0] >= min_spacing
+                                           and last_seq > marks[-1][1])):
+                marks.append([now, last_seq])
+                changed = True
+            index = bisect_right([mark[0] for mark in marks], now - max_age)
+            if index > 1:
+                # Only the newest mark past the limit still matters
+                del marks[:index - 1]
+                changed = True
+            if changed:
+                self._save(marks)
+        return marks[0][1] if marks and marks[0][0] <= now - max_age else 0
+
+
+class RetentionEngine:
+    # One background thread per process that applies the retention policy to every room:
+    # shortly after commits that take a room past its cap, and every RETENTION_INTERVAL
+    # seconds for the age and size limits. Sends never wait for it.
+    def __init__(self, room_stores=rooms.room_stores, settings=None,
+                 interval=RETENTION_INTERVAL, clock=time.time):
+        self.room_stores = room_stores
+        self.settings = settings or (lambda: stores.get_store().cached_settings())
+        self.interval = interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._dirty = set()
+        self._thread = None
+        self.last_results = {}  # room -> result of its last compaction
+        self.runs = 0
+        self.expired = 0
+        self.purged = 0
+        self.bytes_reclaimed = 0
+        self.seconds = 0.0
+        self.errors = 0
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._loop, name="chat-retention",
+                                                    daemon=True)
+                    self._thread.start()
+
+    def request(self, room):
+        # Called after a commit to `room`; cheap, the check happens on the engine's thread
+        with self._lock:
+            self._dirty.add(room)
+        self._wake.set()
+        self.start()
+
+    def _loop(self):
+        next_full = self.clock()
+        while True:
+            if self._wake.wait(max(0.0, next_full - self.clock())):
+                time.sleep(COMPACT_DELAY)
+            self._wake.clear()
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+            full = self.clock() >= next_full
+            if full:
+                next_full = self.clock() + self.interval
+            try:
+                self.run(None if full else dirty, full)
+            except Exception:
+                self.errors += 1
+
+    def run(self, only=None, full=True, force=False):
+        # Checks every room (or those in `only`); returns the results of the compactions
+        # that ran. A full check applies the age and size limits as well as the cap, and a
+        # forced one compacts every room whether it looks due or not.
+        policy = retention_policy(self.settings())
+        results = []
+        with self._run_lock:
+            for room, store in list(self.room_stores()):
+                if only is not None and room not in only:
+                    continue
+                try:
+                    if force or self._needs_compaction(store, policy, full):
+                        results.append(self.compact(room, store, policy))
+                except stores.StoreError:
+                    self.errors += 1
+        return results
+
+    @staticmethod
+    def _needs_compaction(store, policy, full):
+        if full and (policy["max_age"] or policy["max_bytes"] or policy["compress"]
+                     or len(store.tombstones)):
+            return True
+        cap = store.max_messages if full else store.max_messages * (1 + COMPACT_SLACK)
+        return store.live_count() > cap
+
+    def compact(self, room, store, policy):
+        started = time.perf_counter()
+        now = self.clock()
+        bytes_before = store.storage_bytes()
+        # Deleted messages first, so they neither count towards the limits nor get archived
+        purged = store.purge_deleted()
+        messages = store.live_messages()
+        age_seq = 0
+        if policy["max_age"]:
+            marks = SeqMarks(os.path.join(store.directory, SEQ_MARKS_FILE))
+            age_seq = marks.update(now, messages[-1].get("seq", 0) if messages else 0,
+                                   policy["max_age"],
+                                   max(self.interval, policy["max_age"] * MARK_RESOLUTION))
+        through_seq = expiry_seq(messages, store.max_messages, policy["max_bytes"], age_seq)
+        # Segments sealed by this expiry already take the configured format
+        store.archive.compress = policy["compress"]
+        expired = store.expire_messages(through_seq, policy["archive"]) if through_seq else 0
+        compressed = store.archive.compress_segments() if policy["compress"] else 0
+        if expired or purged:
+            store.vacuum()
+        bytes_after = store.storage_bytes()
+        result = {
+            "room": room,
+            "at": now,
+            "seconds": time.perf_counter() - started,
+            "expired": expired,
+            "archived": expired if policy["archive"] else 0,
+            "purged": purged,
+            "compressed_segments": compressed,
+            "bytes_before": bytes_before,
+            "bytes_after": bytes_after,
+            "bytes_reclaimed": max(0, bytes_before - bytes_after),
+        }
+        with self._lock:
+            self.last_results[room] = result
+            self.runs += 1
+            self.expired += expired
+            self.purged += purged
+            self.bytes_reclaimed += result["bytes_reclaimed"]
+            self.seconds += result["seconds"]
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "runs": self.runs,
+                "expired": self.expired,
+                "purged": self.purged,
+                "bytes_reclaimed": self.bytes_reclaimed,
+                "seconds": self.seconds,
+                "errors": self.errors,
+                "rooms": dict(self.last_results),
+            }
+
+
+# One engine per process, for every room
+engine = RetentionEngine()
@@ -0,0 +1,111 @@
+import os
+import re
+import shutil
+import threading
+from datetime import datetime
+
+import chat_cache
+import chat_log
+import stores
+
+# The original chat; its messages stay where they always were, in database/ itself
+DEFAULT_ROOM = "global"
+
+# Every other room is a shard of its own: a full store of the configured backend with its
+# own files, locks, cache, archive, search index and writer
+ROOMS_DIR_NAME = "rooms"
+
+ROOM_NAME_RE = re.compile(r"[a-z0-9][a-z0-9_-]{0,31}")
+
+
+def room_directory(room, directory=stores.DATABASE_DIR):
+    return os.path.join(directory, ROOMS_DIR_NAME, room)
+
+
+def room_configs(settings):
+    # {room: {"max_messages": ..., "created_at": ...}}, the default room first
+    configs = {DEFAULT_ROOM: {"max_messages": chat_log.MAX_MESSAGES}}
+    configs.update(settings.get("rooms", {}))
+    return configs
+
+
+def list_rooms():
+    return list(room_configs(stores.get_store().cached_settings()))
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_room_store(room=DEFAULT_ROOM):
+    # Raises ValueError for a room that does not exist (or was deleted by another process)
+    config = room_configs(stores.get_store().cached_settings()).get(room)
+    if config is None:
+        with _stores_lock:
+            _stores.pop(room, None)
+        raise ValueError(f"Unknown room: {room!r}")
+    if room == DEFAULT_ROOM:
+        store = stores.get_store()
+    else:
+        store = _stores.get(room)
+        if store is None:
+            with _stores_lock:
+                store = _stores.get(room)
+                if store is None:
+                    store = _stores[room] = stores.create_store(
+                        stores.STORE_BACKEND, room_directory(room),
+                        cache=chat_cache.VersionedCache())
+    max_messages = config.get("max_messages", chat_log.MAX_MESSAGES)
+    if store.max_messages != max_messages:
+        store.set_max_messages(max_messages)
+    return store
+
+
+def room_stores():
+    # (room, store) for every room, for moderation that spans all of them
+    for room in list_rooms():
+        try:
+            yield room, get_room_store(room)
+        except ValueError:
+            continue
+
+
+def _update_rooms(change):
+    store = stores.get_store()
+    rooms = dict(store.load_settings().get("rooms", {}))
+    change(rooms)
+    store.update_settings({"rooms": rooms})
+
+
+def create_room(room, max_messages=chat_log.MAX_MESSAGES):
+    if not ROOM_NAME_RE.fullmatch(room):
+        raise ValueError("Room names are 1-32 lowercase letters, digits, '-' or '_', "
+                         "starting with a letter or digit")
+    if room in list_rooms():
+        raise ValueError(f"Room {room!r} already exists")
+
+    def add(rooms):
+        rooms[room] = {"max_messages": int(max_messages),
+                       "created_at": datetime.now().isoformat()}
+    _update_rooms(add)
+
+
+def set_room_retention(room, max_messages):
+    if room == DEFAULT_ROOM:
+        # The default room has no entry of its own until its retention is changed
+        _update_rooms(lambda rooms: rooms.setdefault(DEFAULT_ROOM, {}).update(
+            max_messages=int(max_messages)))
+        return
+    if room not in list_rooms():
+        raise ValueError(f"Unknown room: {room!r}")
+    _update_rooms(lambda rooms: rooms[room].update(max_messages=int(max_messages)))
+
+
+def delete_room(room):
+    # Removes the room and its whole shard, archive and search index included
+    if room == DEFAULT_ROOM:
+        raise ValueError("The default room cannot be deleted")
+    _update_rooms(lambda rooms: rooms.pop(room, None))
+    with _stores_lock:
+        _stores.pop(room, None)
+    shutil.rmtree(room_directory(room), ignore_errors=True)
@@ -0,0 +1,1037 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from types import MappingProxyType
+
+import chat_archive
+import chat_cache
+import chat_log
+import chat_search
+import chat_tombstones
+import durability
+from locking import FileLock
+from user_directory import UserDirectory, normalize_email
+
+try:
+    from dotenv import load_dotenv
+except ImportError:
+    load_dotenv = None
+
+if load_dotenv is not None:
+    load_dotenv()
+
+DATABASE_DIR = chat_log.DATABASE_DIR
+ARCHIVE_DIR_NAME = "global_chat_archive"
+SEARCH_DIR_NAME = "global_chat_search"
+TOMBSTONES_FILE_NAME = "global_chat_tombstones.jsonl"
+
+# "json" (default), "jsonl" (segmented message log) or "sqlite"
+STORE_BACKEND = os.environ.get("CHAT_STORAGE_MODE", "json")
+
+# Auto-refresh bounds in seconds, and the load past which sessions refresh more slowly
+DEFAULT_SETTINGS = {
+    "auto_refresh_min_interval": 1.0,
+    "auto_refresh_max_interval": 10.0,
+    "refresh_latency_threshold_ms": 250,
+    "refresh_session_threshold": 200,
+    # Messages per minute and burst size per server process; 0 per minute means unlimited
+    "rate_limit_user_per_minute": 20,
+    "rate_limit_user_burst": 5,
+    "rate_limit_global_per_minute": 600,
+    "rate_limit_global_burst": 100,
+    # Retention on top of each room's message cap; 0 turns a limit off. Expired messages go
+    # to the room's archive (gzipped when compression is on) or, without archiving, away.
+    "retention_max_age_days": 0,
+    "retention_max_live_kb": 0,
+    "retention_archive": True,
+    "archive_compression": False,
+}
+
+# What a failed read or write can raise, whichever backend is configured
+StoreError = (OSError, ValueError, sqlite3.Error)
+
+
+class ChatStore:
+    # Storage interface shared by app.py and gc.py. Message cursors are opaque to callers:
+    # messages_since returns (new_messages, new_cursor, reset), where reset means the cursor
+    # was stale and the returned messages are the latest tail instead. Deleted messages stay
+    # stored, behind a tombstone, until the next compaction; every read meant for display
+    # leaves them out.
+    name = None
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else chat_cache.VersionedCache()
+        # Set by each backend: messages expired by retention end up here instead of being lost
+        self.archive = None
+        self.search_index = None
+        self.tombstones = None
+        # Messages kept in the live store; older ones move out when retention.py compacts it
+        self.max_messages = chat_log.MAX_MESSAGES
+        self._settings_cache = chat_cache.VersionedCache(freeze=MappingProxyType)
+        self._visible_cache = chat_cache.VersionedCache(freeze=tuple)
+        self.message_index = chat_tombstones.MessageIndex(self._read_since,
+                                                          lambda: self.max_messages)
+
+    def set_max_messages(self, count):
+        # Takes effect with the next compaction
+        self.max_messages = count
+
+    def load_users(self):
+        raise NotImplementedError
+
+    def save_users(self, users):
+        raise NotImplementedError
+
+    def update_users(self, change):
+        raise NotImplementedError
+
+    def count_users(self):
+        raise NotImplementedError
+
+    def get_user(self, username):
+        raise NotImplementedError
+
+    def find_user_by_email(self, email):
+        raise NotImplementedError
+
+    def search_users(self, query="", status=None, offset=0, limit=25):
+        raise NotImplementedError
+
+    def create_user(self, username, user):
+        raise NotImplementedError
+
+    def update_user(self, username, changes):
+        raise NotImplementedError
+
+    def delete_user(self, username):
+        raise NotImplementedError
+
+    def update_users_bulk(self, usernames, changes):
+        # One commit for the whole batch; returns how many users actually changed
+        raise NotImplementedError
+
+    def delete_users_bulk(self, usernames):
+        raise NotImplementedError
+
+    def create_users_bulk(self, users):
+        # One commit for {username: user}; existing usernames are left alone. Returns how
+        # many were created.
+        raise NotImplementedError
+
+    def load_settings(self):
+        raise NotImplementedError
+
+    def save_settings(self, settings):
+        raise NotImplementedError
+
+    def update_settings(self, changes):
+        raise NotImplementedError
+
+    def settings_version(self):
+        raise NotImplementedError
+
+    def cached_settings(self):
+        # Read-only settings shared by every session, re-read only after they change
+        return self._settings_cache.get(self.settings_version(), self.load_settings)
+
+    def append_messages(self, messages):
+        raise NotImplementedError
+
+    def load_messages(self):
+        raise NotImplementedError
+
+    def messages_version(self):
+        raise NotImplementedError
+
+    def change_version(self):
+        # Changes with every commit, clear, removal and deletion; for the store watchers
+        return (self.messages_version(), self.tombstones.version())
+
+    def _read_since(self, cursor, limit):
+        # messages_since with deleted messages still in
+        raise NotImplementedError
+
+    def messages_since(self, cursor, limit):
+        messages, cursor, reset = self._read_since(cursor, limit)
+        return self._visible(messages), cursor, reset
+
+    def _visible(self, messages):
+        deleted = self.tombstones.deleted_ids()
+        if not deleted:
+            return messages
+        return type(messages)(m for m in messages if m.get("message_id") not in deleted)
+
+    def count_messages(self):
+        return min(len(self.snapshot()), self.max_messages)
+
+    def count_archived_messages(self):
+        return len(self.archive)
+
+    # -- retention; used by retention.py, off the request path
+
+    def live_messages(self):
+        # Every message in the live store, including those past the cap that are still
+        # waiting for compaction
+        return self.load_messages()
+
+    def live_count(self):
+        return len(self.live_messages())
+
+    def expire_messages(self, through_seq, archive=True):
+        # Moves every live message up to through_seq to the archive, or drops it; returns
+        # how many were moved out
+        raise NotImplementedError
+
+    def live_bytes(self):
+        raise NotImplementedError
+
+    def storage_bytes(self):
+        # Live store plus archive, in bytes on disk
+        return self.live_bytes() + self.archive.size_bytes()
+
+    def vacuum(self):
+        # Gives space freed by expiry back to the file system where the backend needs it
+        pass
+
+    def _retained_after(self, seq):
+        # Messages still in the live store with a seq above `seq`
+        return [m for m in self._raw_snapshot() if m.get("seq", 0) > seq]
+
+    def _read_before(self, seq, limit):
+        # One page older than `seq`, oldest first: retained messages, then archive
+        page = [m for m in self._raw_snapshot() if m.get("seq", 0) < seq][-limit:]
+        if len(page) < limit:
+            oldest = page[0].get("seq", 0) if page else seq
+            page = self.archive.read_before(oldest, limit - len(page)) + page
+        return page
+
+    def messages_before(self, seq, limit):
+        # One page of history older than `seq`, oldest first. Pages stay full when some of
+        # their messages were deleted, since a short page means the start of the history.
+        page = []
+        while len(page) < limit:
+            raw = self._read_before(seq, limit)
+            page[:0] = self._visible(raw)
+            if len(raw) < limit:
+                break
+            seq = raw[0]["seq"]
+        return page[-limit:]
+
+    def messages_after(self, seq, limit):
+        # The oldest `limit` messages above `seq`, archive first. Storage order, deleted
+        # messages included: this feeds the search index, not the screen.
+        page = self.archive.read_after(seq, limit)
+        if len(page) < limit:
+            after = page[-1]["seq"] if page else seq
+            page += self._retained_after(after)[:limit - len(page)]
+        return page
+
+    def update_search_index(self):
+        # Indexes whatever was committed since the last call, by this or any other process
+        return self.search_index.catch_up(self.messages_after)
+
+    def search_messages(self, query, user=None, limit=50):
+        # Newest matches first. Messages deleted since they were indexed are skipped, and
+        # the index is asked for more until the page is full or it has no older matches.
+        self.update_search_index()
+        page = []
+        before = None
+        while len(page) < limit:
+            seqs = self.search_index.search(query, user, limit, before)
+            page += self._visible_matches(seqs)
+            if len(seqs) < limit:
+                break
+            before = seqs[-1]
+        return page[:limit]
+
+    def _visible_matches(self, seqs):
+        # The messages behind `seqs`, in the same order, without deleted or missing ones
+        if not seqs:
+            return []
+        # The cached snapshot first, then the archive, then anything retained past the cap
+        wanted = set(seqs)
+        found = {m["seq"]: m for m in self.snapshot() if m.get("seq") in wanted}
+        missing = [seq for seq in seqs if seq not in found]
+        if missing:
+            found.update(self.archive.read_seqs(missing))
+            missing = [seq for seq in missing if seq not in found]
+        if missing:
+            found.update((m["seq"], m) for m in self._retained_after(min(missing) - 1)
+                         if m.get("seq") in wanted)
+        deleted = self.tombstones.deleted_ids()
+        return [found[seq] for seq in seqs
+                if seq in found and found[seq].get("message_id") not in deleted]
+
+    def clear_messages(self):
+        raise NotImplementedError
+
+    def delete_messages_by_users(self, user_ids):
+        # One commit; returns the number of messages removed. Readers get a reset cursor.
+        raise NotImplementedError
+
+    def _snapshot_version(self):
+        # A purge removes messages without a new messages_version, so the tombstone log's
+        # generation is part of the key: once it drops their ids, the messages must be gone
+        return (self.messages_version(), self.tombstones.generation())
+
+    def _raw_snapshot(self):
+        return self.cache.get(self._snapshot_version(), self.load_messages)
+
+    def snapshot(self):
+        # Read-only messages shared by every session, re-read only after the store changes.
+        # A deletion only filters the cached messages again, in memory.
+        version = self._snapshot_version()
+        messages = self.cache.get(version, self.load_messages)
+        tombstones_version = self.tombstones.version()
+        if not self.tombstones.deleted_ids():
+            return messages
+        return self._visible_cache.get((version, tombstones_version),
+                                       lambda: self._visible(messages))
+
+    # -- deletion
+
+    def _find_message(self, message_id):
+        # seq of a live message, from the message_id index
+        return self.message_index.lookup(message_id)
+
+    def delete_message(self, message_id):
+        # O(1) whatever the size of the chat: one tombstone append. Returns False when the
+        # message is not in the live store or was already deleted.
+        if message_id in self.tombstones.deleted_ids():
+            return False
+        seq = self._find_message(message_id)
+        if seq is None:
+            return False
+        return self.tombstones.add(message_id, seq)
+
+    def _purge_live(self, message_ids):
+        # Removes the messages from the live store without resetting readers' cursors
+        raise NotImplementedError
+
+    def purge_deleted(self):
+        # Reclaims the space of deleted messages, live and archived; run by compaction
+        deleted = dict(self.tombstones.deleted_ids())
+        if not deleted:
+            return 0
+        removed = self._purge_live(deleted)
+        removed += self.archive.remove_messages(lambda m: m.get("message_id") in deleted,
+                                                seqs=[seq for seq in deleted.values() if seq])
+        self.tombstones.discard(deleted)
+        return removed
+
+
+class JsonStore(ChatStore):
+    name = "json"
+
+    def __init__(self, directory=DATABASE_DIR, cache=None):
+        super().__init__(cache)
+        self.directory = directory
+        self.users_file = os.path.join(directory, "users.json")
+        self.settings_file = os.path.join(directory, "admin_settings.json")
+        self.chat_file = os.path.join(directory, "global_chat.json")
+        os.makedirs(directory, exist_ok=True)
+        self.users = UserDirectory(self.users_file)
+        self.archive = chat_archive.ChatArchive(os.path.join(directory, ARCHIVE_DIR_NAME))
+        self.search_index = chat_search.SearchIndex(os.path.join(directory, SEARCH_DIR_NAME))
+        self.tombstones = chat_tombstones.TombstoneLog(os.path.join(directory, TOMBSTONES_FILE_NAME))
+        # Generation of the file behind the current snapshot; bumped by clears and removals
+        self._generation = 0
+
+    def _read_json(self, path, default):
+        try:
+            with FileLock(path):
+                if os.path.exists(path):
+                    with open(path, "r") as f:
+                        return json.load(f)
+            return default
+        except (OSError, ValueError):
+            return default
+
+    def _write_json(self, path, data):
+        with FileLock(path), durability.atomic_write(path) as f:
+            json.dump(data, f, separators=(",", ":"))
+
+    def load_users(self):
+        return self.users.all()
+
+    def save_users(self, users):
+        self.users.replace_all(users)
+
+    def update_users(self, change):
+        # Re-reads under the lock so a concurrent update from another session is not overwritten
+        return self.users.modify_all(change)
+
+    def count_users(self):
+        return len(self.users)
+
+    def get_user(self, username):
+        return self.users.get(username)
+
+    def find_user_by_email(self, email):
+        return self.users.find_by_email(email)
+
+    def search_users(self, query="", status=None, offset=0, limit=25):
+        return self.users.search(query, status, offset, limit)
+
+    def create_user(self, username, user):
+        return self.users.create(username, user)
+
+    def update_user(self, username, changes):
+        # One journal line, not a users.json rewrite
+        return self.users.update(username, changes)
+
+    def delete_user(self, username):
+        return self.users.delete(username)
+
+    def update_users_bulk(self, usernames, changes):
+        return self.users.update_many(usernames, changes)
+
+    def delete_users_bulk(self, usernames):
+        return self.users.delete_many(usernames)
+
+    def create_users_bulk(self, users):
+        return self.users.create_many(users)
+
+    def load_settings(self):
+        return dict(DEFAULT_SETTINGS, **self._read_json(self.settings_file, {}))
+
+    def save_settings(self, settings):
+        self._write_json(self.settings_file, settings)
+
+    def update_settings(self, changes):
+        with FileLock(self.settings_file):
+            settings = self.load_settings()
+            settings.update(changes)
+            self.save_settings(settings)
+        return settings
+
+    def settings_version(self):
+        return chat_cache.file_version(self.settings_file)
+
+    def append_messages(self, messages):
+        # One read-modify-write for the whole batch, under the cross-process lock
+        with FileLock(self.chat_file):
+            if os.path.exists(self.chat_file):
+                with open(self.chat_file, "r") as f:
+                    global_chat = json.load(f)
+            else:
+                global_chat = {"messages": []}
+
+            # Numbering continues after the archive too, e.g. one left by another backend
+            archived_seq = self.archive.last_seq
+            last_seq = global_chat.get("last_seq")
+            if last_seq is None:
+                # Files written before messages were numbered
+                last_seq = archived_seq
+                for message in global_chat["messages"]:
+                    last_seq += 1
+                    message["seq"] = last_seq
+            last_seq = max(last_seq, archived_seq)
+            for message in messages:
+                last_seq += 1
+                global_chat["messages"].append(dict(message, seq=last_seq))
+            global_chat["last_seq"] = last_seq
+
+            with durability.atomic_write(self.chat_file) as f:
+                json.dump(global_chat, f, separators=(",", ":"))
+
+    def load_messages(self):
+        with FileLock(self.chat_file):
+            if not os.path.exists(self.chat_file):
+                return []
+            with open(self.chat_file, "r") as f:
+                global_chat = json.load(f)
+        self._generation = global_chat.get("generation", 0)
+        return global_chat.get("messages", [])
+
+    def messages_version(self):
+        return chat_cache.file_version(self.chat_file)
+
+    def _read_since(self, cursor, limit):
+        # The cursor is (generation, last seen message_id); the id is found by scanning the
+        # shared snapshot backwards
+        messages = self._raw_snapshot()
+        generation = self._generation
+        new_messages = None
+        if cursor is not None and cursor[0] == generation:
+            new_messages = chat_cache.messages_after(messages, cursor[1])
+        reset = new_messages is None
+        if reset:
+            new_messages = messages[-limit:]
+        new_cursor = (generation, messages[-1].get("message_id") if messages else None)
+        return new_messages[-limit:], new_cursor, reset
+
+    def live_messages(self):
+        return self._raw_snapshot()
+
+    def _purge_live(self, message_ids):
+        # Same generation: sessions already dropped these messages through the tombstones
+        with FileLock(self.chat_file):
+            if not os.path.exists(self.chat_file):
+                return 0
+            with open(self.chat_file, "r") as f:
+                global_chat = json.load(f)
+            messages = global_chat.get("messages", [])
+            kept = [m for m in messages if m.get("message_id") not in message_ids]
+            if len(kept) == len(messages):
+                return 0
+            global_chat["messages"] = kept
+            with durability.atomic_write(self.chat_file) as f:
+                json.dump(global_chat, f, separators=(",", ":"))
+            return len(messages) - len(kept)
+
+    def expire_messages(self, through_seq, archive=True):
+        # One read-modify-write; the generation stays, since only the oldest messages go
+        with FileLock(self.chat_file):
+            if not os.path.exists(self.chat_file):
+                return 0
+            with open(self.chat_file, "r") as f:
+                global_chat = json.load(f)
+            messages = global_chat.get("messages", [])
+            expired = [m for m in messages if m.get("seq", 0) <= through_seq]
+            if not expired:
+                return 0
+            if archive:
+                self.archive.append(expired)
+            global_chat["messages"] = messages[len(expired):]
+            with durability.atomic_write(self.chat_file) as f:
+                json.dump(global_chat, f, separators=(",", ":"))
+            return len(expired)
+
+    def live_bytes(self):
+        try:
+            return os.path.getsize(self.chat_file)
+        except FileNotFoundError:
+            return 0
+
+    def _rewrite_messages(self, change):
+        # Read-modify-write of the whole file that also starts a new generation
+        with FileLock(self.chat_file):
+            if not os.path.exists(self.chat_file):
+                return 0
+            with open(self.chat_file, "r") as f:
+                global_chat = json.load(f)
+            messages = global_chat.get("messages", [])
+            kept = change(messages)
+            global_chat["messages"] = kept
+            global_chat["generation"] = global_chat.get("generation", 0) + 1
+            with durability.atomic_write(self.chat_file) as f:
+                json.dump(global_chat, f, separators=(",", ":"))
+            return len(messages) - len(kept)
+
+    def clear_messages(self):
+        self._rewrite_messages(lambda messages: [])
+        self.archive.clear()
+        self.search_index.clear()
+        self.tombstones.clear()
+
+    def delete_messages_by_users(self, user_ids):
+        user_ids = set(user_ids)
+        removed = self._rewrite_messages(
+            lambda messages: [m for m in messages if m.get("user_id") not in user_ids])
+        return removed + self.archive.remove_messages(lambda m: m.get("user_id") in user_ids)
+
+
+class JsonlStore(JsonStore):
+    # Users and settings stay in JSON files; messages go to the segmented append-only log
+    name = "jsonl"
+
+    def __init__(self, directory=DATABASE_DIR, cache=None):
+        super().__init__(directory, cache)
+        self.log = chat_log.ChatLog(os.path.join(directory, "global_chat_log"),
+                                    legacy_file=self.chat_file, archive=self.archive)
+
+    def set_max_messages(self, count):
+        super().set_max_messages(count)
+        self.log.max_messages = count
+
+    def append_messages(self, messages):
+        self.log.append_many(messages)
+
+    def load_messages(self):
+        return self.log.read_all()
+
+    def messages_version(self):
+        return self.log.version()
+
+    def _read_since(self, cursor, limit):
+        # The cursor is (generation, seq); a clear bumps the generation
+        generation = self.log.version()[0]
+        if cursor is None or cursor[0] != generation:
+            messages = chat_cache.freeze_messages(self.log.read_tail(limit))
+            last_seq = messages[-1]["seq"] if messages else 0
+            return messages, (generation, last_seq), True
+        messages = chat_cache.freeze_messages(self.log.read_since(cursor[1], limit=limit))
+        last_seq = messages[-1]["seq"] if messages else cursor[1]
+        return messages, (generation, last_seq), False
+
+    def count_messages(self):
+        return len(self.log)
+
+    def _retained_after(self, seq):
+        return self.log.read_since(seq)
+
+    def _read_before(self, seq, limit):
+        # The log holds a little more than the cap until compaction, so page it directly
+        page = self.log.read_before(seq, limit)
+        if len(page) < limit:
+            oldest = page[0]["seq"] if page else seq
+            page = self.archive.read_before(oldest, limit - len(page)) + page
+        return page
+
+    def live_messages(self):
+        return self.log.read_live()
+
+    def live_count(self):
+        return self.log.live_count()
+
+    def expire_messages(self, through_seq, archive=True):
+        # The log also moves out whatever is over the cap in the same pass
+        return self.log.compact(through_seq, archive)
+
+    def _purge_live(self, message_ids):
+        return self.log.remove_messages(lambda m: m.get("message_id") in message_ids,
+                                        new_generation=False)
+
+    def live_bytes(self):
+        total = 0
+        for entry in os.scandir(self.log.directory):
+            try:
+                total += entry.stat().st_size
+            except FileNotFoundError:
+                continue
+        return total
+
+    def clear_messages(self):
+        self.log.clear()
+        self.archive.clear()
+        self.search_index.clear()
+        self.tombstones.clear()
+
+    def delete_messages_by_users(self, user_ids):
+        user_ids = set(user_ids)
+        removed = self.log.remove_messages(lambda m: m.get("user_id") in user_ids)
+        return removed + self.archive.remove_messages(lambda m: m.get("user_id") in user_ids)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    name TEXT,
+    email TEXT,
+    password TEXT,
+    status TEXT NOT NULL DEFAULT 'active',
+    created_at TEXT,
+    last_login TEXT
+);
+DROP INDEX IF EXISTS users_email;
+CREATE INDEX IF NOT EXISTS users_email_nocase ON users(email COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS users_username_nocase ON users(username COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS users_name_nocase ON users(name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS users_status ON users(status, username);
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id TEXT UNIQUE,
+    role TEXT,
+    content TEXT,
+    timestamp TEXT,
+    user_id TEXT,
+    sent_at TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_user_id ON messages(user_id);
+CREATE INDEX IF NOT EXISTS messages_timestamp ON messages(timestamp);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('settings', 0);
+"""
+
+USER_COLUMNS = ("name", "email", "password", "status", "created_at", "last_login")
+MESSAGE_COLUMNS = ("seq", "message_id", "role", "content", "timestamp", "user_id", "sent_at")
+
+
+class SqliteStore(ChatStore):
+    # WAL mode lets sessions keep reading while a writer commits
+    name = "sqlite"
+
+    def __init__(self, path=os.path.join(DATABASE_DIR, "global_chat.db"), cache=None):
+        super().__init__(cache)
+        self.path = path
+        self.directory = os.path.dirname(path) or "."
+        self._local = threading.local()
+        os.makedirs(self.directory, exist_ok=True)
+        self.archive = chat_archive.ChatArchive(os.path.join(self.directory, ARCHIVE_DIR_NAME))
+        self.search_index = chat_search.SearchIndex(os.path.join(self.directory, SEARCH_DIR_NAME))
+        self.tombstones = chat_tombstones.TombstoneLog(os.path.join(self.directory,
+                                                                    TOMBSTONES_FILE_NAME))
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SQLITE_SCHEMA)
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(messages)")}
+        if "sent_at" not in columns:
+            # Databases from before messages carried their date
+            try:
+                conn.execute("ALTER TABLE messages ADD COLUMN sent_at TEXT")
+            except sqlite3.OperationalError:
+                pass  # Another process added it first
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None,
+                                   check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            synchronous = durability.SQLITE_SYNCHRONOUS[durability.policy.mode]
+            conn.execute(f"PRAGMA synchronous={synchronous}")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        # Under "interval" the WAL is fsynced in the background; SQLite does the rest
+        durability.policy.mark(self.path + "-wal")
+
+    @staticmethod
+    def _user_from_row(row):
+        return {column: row[column] for column in USER_COLUMNS}
+
+    @staticmethod
+    def _message_from_row(row):
+        return {column: row[column] for column in MESSAGE_COLUMNS}
+
+    def resume_numbering(self, last_seq):
+        # A new database next to an existing archive continues its seqs
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM sqlite_sequence WHERE name = 'messages'")
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('messages', ?)",
+                         (last_seq,))
+
+    def is_empty(self):
+        conn = self._connect()
+        return (conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+                and conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 0
+                and conn.execute("SELECT COUNT(*) FROM settings").fetchone()[0] == 0)
+
+    def load_users(self):
+        rows = self._connect().execute("SELECT * FROM users")
+        return {row["username"]: self._user_from_row(row) for row in rows}
+
+    def _write_users(self, conn, users):
+        conn.executemany(
+            "INSERT OR REPLACE INTO users (username, name, email, password, status, created_at, "
+            "last_login) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(username, data.get("name"), data.get("email"), data.get("password"),
+              data.get("status", "active"), data.get("created_at"), data.get("last_login"))
+             for username, data in users.items()]
+        )
+
+    def save_users(self, users):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM users")
+            self._write_users(conn, users)
+
+    def update_users(self, change):
+        with self._transaction() as conn:
+            before = {row["username"]: self._user_from_row(row)
+                      for row in conn.execute("SELECT * FROM users")}
+            users = {username: dict(data) for username, data in before.items()}
+            result = change(users)
+            removed = [(username,) for username in before if username not in users]
+            conn.executemany("DELETE FROM users WHERE username = ?", removed)
+            self._write_users(conn, {username: data for username, data in users.items()
+                                     if before.get(username) != data})
+        return result
+
+    def count_users(self):
+        return self._connect().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def get_user(self, username):
+        row = self._connect().execute("SELECT * FROM users WHERE username = ?",
+                                      (username,)).fetchone()
+        return self._user_from_row(row) if row is not None else None
+
+    def find_user_by_email(self, email):
+        row = self._connect().execute(
+            "SELECT * FROM users WHERE email = ? COLLATE NOCASE LIMIT 1", (normalize_email(email),)
+        ).fetchone()
+        return (row["username"], self._user_from_row(row)) if row is not None else None
+
+    def search_users(self, query="", status=None, offset=0, limit=25):
+        # Prefix LIKE on the NOCASE indexes; the escape keeps % and _ in the query literal
+        clauses = []
+        params = []
+        query = query.strip()
+        if query:
+            pattern = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            clauses.append("(username LIKE ? ESCAPE '\\' OR name LIKE ? ESCAPE '\\' "
+                           "OR email LIKE ? ESCAPE '\\')")
+            params += [pattern, pattern, pattern]
+        if status is not None:
+            clauses.append("status = ?")
+            params.append(status)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        conn = self._connect()
+        total = conn.execute(f"SELECT COUNT(*) FROM users {where}", params).fetchone()[0]
+        rows = conn.execute(f"SELECT * FROM users {where} ORDER BY username LIMIT ? OFFSET ?",
+                            params + [limit, offset])
+        return total, [(row["username"], self._user_from_row(row)) for row in rows]
+
+    def create_user(self, username, user):
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone():
+                return False
+            self._write_users(conn, {username: user})
+            return True
+
+    def update_user(self, username, changes):
+        columns = [c for c in changes if c in USER_COLUMNS]
+        if not columns:
+            return self.get_user(username) is not None
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                f"UPDATE users SET {', '.join(f'{c} = ?' for c in columns)} WHERE username = ?",
+                [changes[c] for c in columns] + [username]
+            )
+            return cursor.rowcount > 0
+
+    def delete_user(self, username):
+        with self._transaction() as conn:
+            return conn.execute("DELETE FROM users WHERE username = ?", (username,)).rowcount > 0
+
+    def update_users_bulk(self, usernames, changes):
+        columns = [c for c in changes if c in USER_COLUMNS]
+        if not columns:
+            return 0
+        # IS NOT skips rows that already hold the new values, so they are not counted
+        sql = (f"UPDATE users SET {', '.join(f'{c} = ?' for c in columns)} WHERE username = ? "
+               f"AND NOT ({' AND '.join(f'{c} IS ?' for c in columns)})")
+        values = [changes[c] for c in columns]
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(sql, [values + [username] + values
+                                   for username in dict.fromkeys(usernames)])
+            return conn.total_changes - before
+
+    def delete_users_bulk(self, usernames):
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany("DELETE FROM users WHERE username = ?",
+                             [(username,) for username in dict.fromkeys(usernames)])
+            return conn.total_changes - before
+
+    def create_users_bulk(self, users):
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO users (username, name, email, password, status, "
+                "created_at, last_login) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(username, data.get("name"), data.get("email"), data.get("password"),
+                  data.get("status", "active"), data.get("created_at"), data.get("last_login"))
+                 for username, data in users.items()]
+            )
+            return conn.total_changes - before
+
+    def load_settings(self):
+        settings = dict(DEFAULT_SETTINGS)
+        for row in self._connect().execute("SELECT key, value FROM settings"):
+            settings[row["key"]] = json.loads(row["value"])
+        return settings
+
+    def save_settings(self, settings):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM settings")
+            conn.executemany("INSERT INTO settings (key, value) VALUES (?, ?)",
+                             [(key, json.dumps(value)) for key, value in settings.items()])
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'settings'")
+
+    def update_settings(self, changes):
+        with self._transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                             [(key, json.dumps(value)) for key, value in changes.items()])
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'settings'")
+        return self.load_settings()
+
+    def settings_version(self):
+        # Bumped with every settings write, so the check is one indexed lookup
+        return self._connect().execute(
+            "SELECT value FROM meta WHERE key = 'settings'").fetchone()[0]
+
+    def append_messages(self, messages):
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO messages (message_id, role, content, timestamp, user_id, "
+                "sent_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(m.get("message_id"), m.get("role"), m.get("content"), m.get("timestamp"),
+                  m.get("user_id"), m.get("sent_at")) for m in messages]
+            )
+
+    def load_messages(self):
+        rows = self._connect().execute("SELECT * FROM messages ORDER BY seq DESC LIMIT ?",
+                                       (self.max_messages,)).fetchall()
+        return [self._message_from_row(row) for row in reversed(rows)]
+
+    def messages_version(self):
+        row = self._connect().execute(
+            "SELECT (SELECT value FROM meta WHERE key = 'generation'), "
+            "(SELECT MAX(seq) FROM messages)"
+        ).fetchone()
+        return (row[0], row[1])
+
+    def _read_since(self, cursor, limit):
+        conn = self._connect()
+        generation = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+        reset = cursor is None or cursor[0] != generation
+        after = 0 if reset else cursor[1]
+        rows = conn.execute("SELECT * FROM messages WHERE seq > ? ORDER BY seq DESC LIMIT ?",
+                            (after, limit)).fetchall()
+        messages = chat_cache.freeze_messages(self._message_from_row(row) for row in reversed(rows))
+        last_seq = messages[-1]["seq"] if messages else after
+        return messages, (generation, last_seq), reset
+
+    def count_messages(self):
+        return min(self.live_count(), self.max_messages)
+
+    def _retained_after(self, seq):
+        # Straight from the table, which holds a little more than the cap until compaction
+        rows = self._connect().execute("SELECT * FROM messages WHERE seq > ? ORDER BY seq",
+                                       (seq,)).fetchall()
+        return [self._message_from_row(row) for row in rows]
+
+    def _read_before(self, seq, limit):
+        rows = self._connect().execute(
+            "SELECT * FROM messages WHERE seq < ? ORDER BY seq DESC LIMIT ?", (seq, limit)
+        ).fetchall()
+        page = [self._message_from_row(row) for row in reversed(rows)]
+        if len(page) < limit:
+            oldest = page[0]["seq"] if page else seq
+            page = self.archive.read_before(oldest, limit - len(page)) + page
+        return page
+
+    def live_messages(self):
+        rows = self._connect().execute("SELECT * FROM messages ORDER BY seq").fetchall()
+        return [self._message_from_row(row) for row in rows]
+
+    def live_count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def expire_messages(self, through_seq, archive=True):
+        # A failed commit leaves the messages in both places, and the archive skips seqs it
+        # already has
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT * FROM messages WHERE seq <= ? ORDER BY seq",
+                                (through_seq,)).fetchall()
+            if rows and archive:
+                self.archive.append([self._message_from_row(row) for row in rows])
+            conn.execute("DELETE FROM messages WHERE seq <= ?", (through_seq,))
+        return len(rows)
+
+    def _find_message(self, message_id):
+        # The UNIQUE constraint on message_id is the index
+        row = self._connect().execute("SELECT seq FROM messages WHERE message_id = ?",
+                                      (message_id,)).fetchone()
+        return row[0] if row else None
+
+    def _purge_live(self, message_ids):
+        # Same generation: sessions already dropped these messages through the tombstones
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany("DELETE FROM messages WHERE message_id = ?",
+                             [(message_id,) for message_id in message_ids])
+            return conn.total_changes - before
+
+    def live_bytes(self):
+        total = 0
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                total += os.path.getsize(self.path + suffix)
+            except FileNotFoundError:
+                continue
+        return total
+
+    def vacuum(self):
+        # Deleted rows only become free pages; rebuild the file once a quarter of it is free
+        conn = self._connect()
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        pages = conn.execute("PRAGMA page_count").fetchone()[0]
+        if pages and free * 4 >= pages:
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def clear_messages(self):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM messages")
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+        self.archive.clear()
+        self.search_index.clear()
+        self.tombstones.clear()
+
+    def delete_messages_by_users(self, user_ids):
+        user_ids = set(user_ids)
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany("DELETE FROM messages WHERE user_id = ?",
+                             [(user_id,) for user_id in user_ids])
+            removed = conn.total_changes - before
+            if removed:
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+        return removed + self.archive.remove_messages(lambda m: m.get("user_id") in user_ids)
+
+
+def migrate_store(source, target):
+    # Copies users, settings and retained messages; used to seed a new backend from JSON
+    target.save_users(source.load_users())
+    target.save_settings(source.load_settings())
+    messages = source.load_messages()
+    if messages:
+        target.append_messages(messages)
+    return len(messages)
+
+
+def legacy_json_store(directory=DATABASE_DIR):
+    # Whichever file-based store holds the existing data
+    if os.path.isdir(os.path.join(directory, "global_chat_log")):
+        return JsonlStore(directory)
+    return JsonStore(directory)
+
+
+def create_store(backend=STORE_BACKEND, directory=DATABASE_DIR, cache=None):
+    if backend == "json":
+        return JsonStore(directory, cache)
+    if backend == "jsonl":
+        return JsonlStore(directory, cache)
+    if backend == "sqlite":
+        store = SqliteStore(os.path.join(directory, "global_chat.db"), cache)
+        if store.is_empty():
+            store.resume_numbering(store.archive.last_seq)
+            migrate_store(legacy_json_store(directory), store)
+        return store
+    raise ValueError(f"Unknown CHAT_STORAGE_MODE: {backend!r}")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_store(cache=chat_cache.global_chat_cache)
+    return _store
@@ -0,0 +1,59 @@
+import os
+import time
+
+import pytest
+
+import durability
+
+
+@pytest.fixture
+def policy(monkeypatch):
+    policy = durability.SyncPolicy("commit", interval_ms=10)
+    monkeypatch.setattr(durability, "policy", policy)
+    return policy
+
+
+@pytest.mark.parametrize("mode", durability.DURABILITY_MODES)
+def test_atomic_write_replaces_the_file(tmp_path, policy, mode):
+    policy.configure(mode)
+    path = str(tmp_path / "settings.json")
+
+    with durability.atomic_write(path) as f:
+        f.write("new")
+
+    assert open(path).read() == "new"
+    assert not os.path.exists(path + ".tmp")
+    policy.flush()
+    assert (policy.stats()["syncs"] > 0) == (mode != "never")
+
+
+def test_failed_atomic_write_keeps_the_original(tmp_path, policy):
+    path = str(tmp_path / "settings.json")
+    with open(path, "w") as f:
+        f.write("old")
+
+    with pytest.raises(RuntimeError):
+        with durability.atomic_write(path) as f:
+            f.write("half")
+            raise RuntimeError("interrupted")
+
+    assert open(path).read() == "old"
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_interval_mode_syncs_renames_in_the_background(tmp_path, policy):
+    policy.configure("interval")
+    path = str(tmp_path / "users.json")
+    with open(path, "w") as f:
+        f.write("{}")
+
+    policy.replaced(path)
+
+    time.sleep(0.3)
+    assert policy.stats()["pending"] == 0
+    assert policy.stats()["syncs"] == 1
+
+
+def test_unknown_mode_is_rejected(policy):
+    with pytest.raises(ValueError):
+        policy.configure("sometimes")
@@ -0,0 +1,54 @@
+from conftest import compact, make_messages, stored_messages
+
+
+def test_compaction_moves_overflow_to_the_archive_without_losing_any(store):
+    store.set_max_messages(20)
+    messages = make_messages(75)
+    store.append_messages(messages)
+
+    compact(store)
+
+    assert store.live_count() == 20
+    assert store.count_archived_messages() == 55
+    kept = stored_messages(store)
+    assert [m["message_id"] for m in kept] == [m["message_id"] for m in messages]
+    assert [m["seq"] for m in kept] == list(range(1, 76))
+
+
+def test_cursor_continues_across_compaction(store):
+    store.set_max_messages(20)
+    store.append_messages(make_messages(50))
+    _, cursor, _ = store.messages_since(None, 100)
+
+    compact(store)
+    new = make_messages(5, content="after {n}")
+    store.append_messages(new)
+    messages, cursor, reset = store.messages_since(cursor, 100)
+
+    assert not reset
+    assert [m["message_id"] for m in messages] == [m["message_id"] for m in new]
+    assert store.messages_since(cursor, 100)[0] == ()
+
+
+def test_cursor_is_reset_by_a_clear(store):
+    store.append_messages(make_messages(10))
+    _, cursor, _ = store.messages_since(None, 100)
+
+    store.clear_messages()
+    new = make_messages(3)
+    store.append_messages(new)
+    messages, _, reset = store.messages_since(cursor, 100)
+
+    assert reset
+    assert [m["message_id"] for m in messages] == [m["message_id"] for m in new]
+
+
+def test_history_pages_reach_into_the_archive(store):
+    store.set_max_messages(10)
+    messages = make_messages(40)
+    store.append_messages(messages)
+    compact(store)
+
+    page = store.messages_before(11, 100)
+
+    assert [m["message_id"] for m in page] == [m["message_id"] for m in messages[:10]]
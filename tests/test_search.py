@@ -0,0 +1,22 @@
+from conftest import make_messages
+
+
+def test_search_page_stays_full_with_a_deleted_hit(store):
+    messages = make_messages(120, content="needle {n}")
+    store.append_messages(messages)
+    store.delete_message(messages[-3]["message_id"])
+
+    hits = store.search_messages("needle", limit=50)
+
+    assert len(hits) == 50
+    assert messages[-3]["message_id"] not in {m["message_id"] for m in hits}
+    seqs = [m["seq"] for m in hits]
+    assert seqs == sorted(seqs, reverse=True)
+
+
+def test_search_returns_every_match_when_fewer_than_the_limit(store):
+    messages = make_messages(10, content="needle {n}")
+    store.append_messages(messages)
+    store.delete_message(messages[0]["message_id"])
+
+    assert len(store.search_messages("needle", limit=50)) == 9
@@ -0,0 +1,24 @@
+import os
+
+import pytest
+
+import stores
+from conftest import BACKENDS, compact, make_messages
+
+
+@pytest.mark.parametrize("new_backend", BACKENDS)
+def test_numbering_continues_after_an_archive_left_by_another_backend(tmp_path, new_backend):
+    directory = str(tmp_path / "db")
+    old = stores.create_store("sqlite", directory)
+    old.set_max_messages(10)
+    old.append_messages(make_messages(50))
+    compact(old)
+    archived = old.archive.last_seq
+    os.remove(os.path.join(directory, "global_chat.db"))
+
+    store = stores.create_store(new_backend, directory)
+    store.append_messages(make_messages(1, content="findme"))
+
+    assert archived == 40
+    assert [m["seq"] for m in store.snapshot()] == [archived + 1]
+    assert len(store.search_messages("findme")) == 1
@@ -0,0 +1,40 @@
+from conftest import compact, make_messages, stored_messages
+
+
+def test_deleted_message_stays_hidden_after_compaction(store):
+    messages = make_messages(5, content="secret {n}")
+    store.append_messages(messages)
+    store.snapshot()
+    store.delete_message(messages[3]["message_id"])
+
+    compact(store)
+
+    assert messages[3]["message_id"] not in {m["message_id"] for m in store.snapshot()}
+    assert store.search_messages("secret3") == []
+    assert len(store.tombstones) == 0
+    assert len(stored_messages(store)) == 4
+
+
+def test_readers_drop_a_deletion_without_a_reset(store):
+    messages = make_messages(5)
+    store.append_messages(messages)
+    _, position, _ = store.tombstones.since(None)
+
+    assert store.delete_message(messages[1]["message_id"])
+    assert not store.delete_message(messages[1]["message_id"])
+    deleted, _, purged = store.tombstones.since(position)
+
+    assert deleted == [messages[1]["message_id"]]
+    assert not purged
+
+
+def test_history_pages_stay_full_around_deleted_messages(store):
+    messages = make_messages(30)
+    store.append_messages(messages)
+    for message in messages[10:15]:
+        store.delete_message(message["message_id"])
+
+    page = store.messages_before(31, 20)
+
+    assert len(page) == 20
+    assert [m["seq"] for m in page] == list(range(6, 11)) + list(range(16, 31))
@@ -0,0 +1,70 @@
+import threading
+
+import chat_writer
+from conftest import make_messages, stored_messages
+
+SENDERS = 8
+MESSAGES_PER_SENDER = 40
+
+
+def send_concurrently(writer, batches):
+    errors = []
+
+    def send(messages):
+        for message in messages:
+            try:
+                writer.submit(message)
+            except chat_writer.WriteFailed as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=send, args=(batch,)) for batch in batches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert not any(thread.is_alive() for thread in threads), "a sender never returned"
+    return errors
+
+
+def test_concurrent_sends_lose_no_messages(store):
+    writer = chat_writer.GroupCommitWriter(store.append_messages)
+    batches = [make_messages(MESSAGES_PER_SENDER, user_id=f"user{i}") for i in range(SENDERS)]
+
+    errors = send_concurrently(writer, batches)
+
+    assert errors == []
+    stored = stored_messages(store)
+    sent = {m["message_id"] for batch in batches for m in batch}
+    lost = sent - {m["message_id"] for m in stored}
+    assert len(lost) == 0
+    assert len(stored) == len(sent)
+    assert [m["seq"] for m in stored] == list(range(1, len(sent) + 1))
+    for batch in batches:
+        # Each sender's messages keep the order they were sent in
+        ids = [m["message_id"] for m in stored if m["user_id"] == batch[0]["user_id"]]
+        assert ids == [m["message_id"] for m in batch]
+    assert writer.stats()["messages"] == len(sent)
+
+
+def test_a_failed_commit_is_raised_to_every_sender():
+    def commit(messages):
+        raise OSError("disk full")
+
+    writer = chat_writer.GroupCommitWriter(commit)
+
+    errors = send_concurrently(writer, [make_messages(5) for _ in range(4)])
+
+    assert len(errors) == 20
+
+
+def test_senders_return_when_on_commit_fails(store):
+    def on_commit():
+        raise RuntimeError("notifier broke")
+
+    writer = chat_writer.GroupCommitWriter(store.append_messages, on_commit=on_commit)
+
+    errors = send_concurrently(writer, [make_messages(10) for _ in range(3)])
+
+    assert errors == []
+    assert store.live_count() == 30
+
@@ -0,0 +1,306 @@
+import json
+import os
+import threading
+from bisect import bisect_left, insort
+from itertools import islice
+
+from chat_cache import file_version
+import durability
+from locking import FileLock
+
+# Journal entries folded back into users.json once the journal grows past this
+JOURNAL_COMPACT_ENTRIES = 1000
+
+
+def normalize_email(email):
+    return (email or "").strip().lower()
+
+
+def search_keys(username, user):
+    # Lower-cased strings a user can be found by prefix: username, full name and email
+    keys = {username.lower(), (user.get("name") or "").strip().lower(),
+            normalize_email(user.get("email"))}
+    keys.discard("")
+    return keys
+
+
+def user_status(user):
+    return user.get("status", "active")
+
+
+class UserDirectory:
+    # users.json plus an append-only journal of single-user changes. Lookups hit an in-memory
+    # dict (by username) and an email index; both are shared by every session and caught up
+    # incrementally by replaying only the journal lines written since the last check.
+    def __init__(self, users_file, compact_entries=JOURNAL_COMPACT_ENTRIES):
+        self.users_file = users_file
+        self.journal_file = os.path.splitext(users_file)[0] + ".journal.jsonl"
+        self.compact_entries = compact_entries
+        self._file_lock = FileLock(users_file)
+        self._lock = threading.RLock()
+        self._users = {}
+        self._emails = {}
+        # Sorted indexes for admin search; rebuilt lazily after a full reload, otherwise
+        # maintained in place
+        self._usernames = []
+        self._keys = []  # (search key, username)
+        self._by_status = {}  # status -> sorted usernames
+        self._sorted = False
+        self._base_version = None
+        self._journal_offset = 0
+        self._journal_entries = 0
+        self.reloads = 0
+
+    # -- reading
+
+    def _index_put(self, username, user):
+        old = self._users.get(username)
+        if old is not None:
+            self._unindex(username, old)
+        elif self._sorted:
+            insort(self._usernames, username)
+        self._users[username] = user
+        email = normalize_email(user.get("email"))
+        if email:
+            self._emails[email] = username
+        if self._sorted:
+            insort(self._by_status.setdefault(user_status(user), []), username)
+            for key in search_keys(username, user):
+                insort(self._keys, (key, username))
+
+    def _index_delete(self, username):
+        old = self._users.pop(username, None)
+        if old is not None:
+            self._unindex(username, old)
+            if self._sorted:
+                del self._usernames[bisect_left(self._usernames, username)]
+
+    def _unindex(self, username, user):
+        self._emails.pop(normalize_email(user.get("email")), None)
+        if self._sorted:
+            same_status = self._by_status[user_status(user)]
+            del same_status[bisect_left(same_status, username)]
+            for key in search_keys(username, user):
+                index = bisect_left(self._keys, (key, username))
+                if index < len(self._keys) and self._keys[index] == (key, username):
+                    del self._keys[index]
+
+    def _reset_indexes(self):
+        self._users = {}
+        self._emails = {}
+        self._usernames = []
+        self._keys = []
+        self._by_status = {}
+        self._sorted = False
+
+    def _ensure_sorted(self):
+        if not self._sorted:
+            self._usernames = sorted(self._users)
+            self._keys = sorted((key, username) for username, user in self._users.items()
+                                for key in search_keys(username, user))
+            self._by_status = {}
+            for username in self._usernames:
+                self._by_status.setdefault(user_status(self._users[username]), []).append(username)
+            self._sorted = True
+
+    def _apply(self, entry):
+        if entry.get("op") == "put":
+            self._index_put(entry["username"], entry["user"])
+        elif entry.get("op") == "delete":
+            self._index_delete(entry["username"])
+
+    def _replay_journal(self, offset):
+        try:
+            with open(self.journal_file, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return offset
+        # Only whole lines; a line still being written is picked up next time
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                self._apply(json.loads(line))
+            except (ValueError, KeyError):
+                continue
+            self._journal_entries += 1
+        return offset + end
+
+    def _full_reload(self, base_version):
+        users = {}
+        if base_version is not None:
+            try:
+                with open(self.users_file, "r") as f:
+                    users = json.load(f)
+            except (OSError, ValueError):
+                users = {}
+        self._reset_indexes()
+        for username, user in users.items():
+            self._index_put(username, user)
+        self._base_version = base_version
+        self._journal_entries = 0
+        self._journal_offset = self._replay_journal(0)
+        self.reloads += 1
+
+    def refresh(self):
+        # Two stats when nothing changed
+        with self._lock:
+            base_version = file_version(self.users_file)
+            try:
+                journal_size = os.path.getsize(self.journal_file)
+            except FileNotFoundError:
+                journal_size = 0
+            if base_version != self._base_version or journal_size < self._journal_offset:
+                self._full_reload(base_version)
+            elif journal_size > self._journal_offset:
+                self._journal_offset = self._replay_journal(self._journal_offset)
+
+    def get(self, username):
+        with self._lock:
+            self.refresh()
+            user = self._users.get(username)
+            return dict(user) if user is not None else None
+
+    def find_by_email(self, email):
+        with self._lock:
+            self.refresh()
+            username = self._emails.get(normalize_email(email))
+            if username is None:
+                return None
+            return username, dict(self._users[username])
+
+    def all(self):
+        with self._lock:
+            self.refresh()
+            return {username: dict(user) for username, user in self._users.items()}
+
+    def search(self, query="", status=None, offset=0, limit=25):
+        # Returns (total, [(username, user), ...]) for one page, ordered by username
+        with self._lock:
+            self.refresh()
+            self._ensure_sorted()
+            query = query.strip().lower()
+            if query:
+                matched = set()
+                for key, username in islice(self._keys, bisect_left(self._keys, (query,)), None):
+                    if not key.startswith(query):
+                        break
+                    matched.add(username)
+                candidates = sorted(u for u in matched
+                                    if status is None or user_status(self._users[u]) == status)
+                total = len(candidates)
+            elif status is None:
+                candidates = self._usernames
+                total = len(candidates)
+            else:
+                candidates = self._by_status.get(status, [])
+                total = len(candidates)
+            page = candidates[offset:offset + limit]
+            return total, [(username, dict(self._users[username])) for username in page]
+
+    def __len__(self):
+        with self._lock:
+            self.refresh()
+            return len(self._users)
+
+    # -- writing (write-through: the journal line and the in-memory index change together)
+
+    def _append(self, entries):
+        data = "".join(json.dumps(e, separators=(",", ":")) + "\n" for e in entries).encode("utf-8")
+        with open(self.journal_file, "ab") as f:
+            f.write(data)
+            durability.policy.written(f)
+        for entry in entries:
+            self._apply(entry)
+        self._journal_offset += len(data)
+        self._journal_entries += len(entries)
+        if self._journal_entries >= self.compact_entries:
+            self._write_base(self._users)
+
+    def _write_base(self, users):
+        with durability.atomic_write(self.users_file) as f:
+            json.dump(users, f, separators=(",", ":"))
+        with open(self.journal_file, "w"):
+            pass
+        if users is not self._users:
+            self._reset_indexes()
+            for username, user in users.items():
+                self._index_put(username, user)
+        self._base_version = file_version(self.users_file)
+        self._journal_offset = 0
+        self._journal_entries = 0
+
+    def create(self, username, user):
+        with self._file_lock, self._lock:
+            self.refresh()
+            if username in self._users:
+                return False
+            self._append([{"op": "put", "username": username, "user": dict(user)}])
+            return True
+
+    def update(self, username, changes):
+        with self._file_lock, self._lock:
+            self.refresh()
+            user = self._users.get(username)
+            if user is None:
+                return False
+            user = dict(user)
+            user.update(changes)
+            self._append([{"op": "put", "username": username, "user": user}])
+            return True
+
+    def delete(self, username):
+        with self._file_lock, self._lock:
+            self.refresh()
+            if username not in self._users:
+                return False
+            self._append([{"op": "delete", "username": username}])
+            return True
+
+    def update_many(self, usernames, changes):
+        # One journal write for the whole batch; users already in the target state are skipped
+        with self._file_lock, self._lock:
+            self.refresh()
+            entries = []
+            for username in dict.fromkeys(usernames):
+                user = self._users.get(username)
+                if user is None or all(user.get(k) == v for k, v in changes.items()):
+                    continue
+                user = dict(user)
+                user.update(changes)
+                entries.append({"op": "put", "username": username, "user": user})
+            if entries:
+                self._append(entries)
+            return len(entries)
+
+    def create_many(self, users):
+        # One journal write for the whole batch; usernames that already exist are skipped
+        with self._file_lock, self._lock:
+            self.refresh()
+            entries = [{"op": "put", "username": username, "user": dict(user)}
+                       for username, user in users.items() if username not in self._users]
+            if entries:
+                self._append(entries)
+            return len(entries)
+
+    def delete_many(self, usernames):
+        with self._file_lock, self._lock:
+            self.refresh()
+            entries = [{"op": "delete", "username": username}
+                       for username in dict.fromkeys(usernames) if username in self._users]
+            if entries:
+                self._append(entries)
+            return len(entries)
+
+    def replace_all(self, users):
+        with self._file_lock, self._lock:
+            self._write_base(users)
+
+    def modify_all(self, change):
+        # Whole-directory edit for callers that need it; writes one compacted users.json
+        with self._file_lock, self._lock:
+            self.refresh()
+            users = {username: dict(user) for username, user in self._users.items()}
+            result = change(users)
+            self._write_base(users)
+        return result